@@ -0,0 +1,289 @@
+import time
+import sys
+import argparse
+import json
+sys.path.append("../")
+import lib.Common as Common
+
+import lib.DomainDecompositionGPU as DomDecGPU
+
+import torch
+import numpy as np
+
+from lib.header_params import *
+
+
+###############################################################################
+# # GPU multiscale domain decomposition on 3D grids
+# =============================================================================
+#
+# Benchmark of the bounding box pipeline of DomainDecompositionGPU on volumetric
+# densities of shape (N, N, N). The measures are synthetic mixtures of
+# gaussians, so no input files are needed. 3D grids are always handled by the
+# pure PyTorch backend (see DomDecGPU.get_backend), so this also runs without
+# CUDA.
+#
+# Unlike example-domdec-gpu.py, the cell potentials are not stitched into a
+# global potential between layers (DomDec.getAlphaGraph is only implemented
+# in 2D), so every layer starts from zero potentials and no dual score is
+# reported.
+###############################################################################
+
+# read parameters from command line
+print("setting script parameters")
+params = getDefaultParams()
+
+# Problem size: grids of shape (N, N, N)
+params["setup_N"] = 16
+params["setup_seed"] = 0
+
+# Domdec parameters
+params["domdec_cellsize"] = 2
+cellsize = params["domdec_cellsize"]
+params["batchsize"] = np.inf
+params["clustering"] = True
+params["number_clusters"] = "smart"
+params["clustering_method"] = "bucketing" # options are kmeans | bucketing
+params["balance"] = True
+params["streaming"] = False # store basic cell marginals ragged
+params["memory_budget"] = np.inf # bytes per minibatch, implies streaming
+
+# Subproblem Sinkhorn parameters
+params["sinkhorn_max_iter"] = 10000
+params["sinkhorn_inner_iter"] = 10
+params["sinkhorn_error"] = 1e-4
+params["sinkhorn_error_rel"] = True
+
+# Multiscale parameters
+params["hierarchy_top"] = int(np.log2(params["domdec_cellsize"])) + 1
+
+params["setup_resultfile"] = "results-domdec-gpu-3d.txt"
+
+# Allow all parameters to be overriden on the command line
+args = argparse.ArgumentParser()
+for key in params.keys():
+    args.add_argument(f"--{key}", dest = key,
+            default = params[key], type = type(params[key]))
+params = vars(args.parse_args())
+cellsize = params["domdec_cellsize"]
+
+# Print parameters
+print("final parameter settings")
+for k in sorted(params.keys()):
+    print("\t", k, params[k])
+
+##########################################################
+# Torch parameters
+device = "cuda" if torch.cuda.is_available() else "cpu"
+torch_dtype = torch.float64
+
+torch_options = dict(dtype=torch_dtype, device=device)
+torch_options_int = dict(dtype=torch.int32, device=device)
+
+##########################################################
+# Synthetic input measures
+def get_gaussian_mixture(N, n_bumps, generator):
+    x = torch.arange(N, dtype=torch_dtype) / N
+    rho = torch.full((N, N, N), 1e-4, dtype=torch_dtype)
+    for _ in range(n_bumps):
+        center = torch.rand(3, generator=generator, dtype=torch_dtype)
+        width = 0.05 + 0.1 * torch.rand(1, generator=generator,
+                                        dtype=torch_dtype)
+        d2 = (x.view(-1, 1, 1) - center[0])**2 \
+            + (x.view(1, -1, 1) - center[1])**2 \
+            + (x.view(1, 1, -1) - center[2])**2
+        rho += torch.exp(-d2 / (2*width**2))
+    return (rho / rho.sum()).to(device)
+
+N = params["setup_N"]
+generator = torch.Generator().manual_seed(params["setup_seed"])
+muX_final = get_gaussian_mixture(N, 3, generator)
+muY_final = get_gaussian_mixture(N, 3, generator)
+shapeX = shapeY = (N, N, N)
+dim = len(shapeX)
+C = 2**dim # basic cells per composite cell
+params["hierarchy_depth"] = DomDecGPU.get_hierarchy_depth(shapeX)
+
+muX_layers = DomDecGPU.get_multiscale_layers(
+    muX_final, shapeX, params["hierarchy_depth"])
+muY_layers = DomDecGPU.get_multiscale_layers(
+    muY_final, shapeY, params["hierarchy_depth"])
+
+# setup eps scaling
+params["eps_list"] = Common.getEpsListDefault(params["hierarchy_depth"], params["hierarchy_top"],
+                                              params["eps_base"], params["eps_layerFactor"], params["eps_layerSteps"], params["eps_stepsFinal"],
+                                              nIterations=params["eps_nIterations"], nIterationsLayerInit=params[
+                                                  "eps_nIterationsLayerInit"], nIterationsGlobalInit=params["eps_nIterationsGlobalInit"],
+                                              nIterationsFinal=params["eps_nIterationsFinal"])
+
+def get_composite_cells(mu, composite_shape):
+    # Cut `mu` into composite cells of size 2*cellsize along every axis
+    s = 2*cellsize
+    return mu.view(DomDecGPU.get_children_shape(composite_shape, s)) \
+        .permute(*range(0, 2*dim, 2), *range(1, 2*dim, 2)) \
+        .reshape(-1, *[s]*dim)
+
+def get_composite_offsets(composite_shape, shift):
+    # Global offsets of the composite cells
+    grids = torch.meshgrid(
+        *(torch.arange(c, **torch_options_int)*2*cellsize - shift
+          for c in composite_shape), indexing="ij")
+    return torch.stack(grids, -1).view(-1, dim)
+
+def get_partition(basic_index):
+    # Group the basic cells in `basic_index` into blocks of 2 along every axis
+    composite_shape = tuple(b//2 for b in basic_index.shape)
+    return basic_index.view(DomDecGPU.get_children_shape(composite_shape)) \
+        .permute(*range(0, 2*dim, 2), *range(1, 2*dim, 2)) \
+        .reshape(-1, C)
+
+evaluationData = {}
+evaluationData["time_iterate"] = 0.
+evaluationData["time_sinkhorn"] = 0.
+evaluationData["time_refine"] = 0.
+evaluationData["time_measureBalancing"] = 0.
+evaluationData["time_bounding_box"] = 0.
+evaluationData["time_clustering"] = 0.
+evaluationData["sinkhorn_iters"] = []
+evaluationData["timeList_global"] = []
+
+globalTime1 = time.perf_counter()
+
+nLayerTop = params["hierarchy_top"]
+nLayerFinest = params["hierarchy_depth"]
+nLayer = nLayerTop
+while nLayer <= nLayerFinest:
+
+    timeRefine1 = time.perf_counter()
+    print("layer: {:d}".format(nLayer))
+    # setup hiarchy layer
+
+    # keep old info for a little bit longer
+    if nLayer > nLayerTop:
+        muY_basic_box_old = muY_basic_box
+        muYLOld = muYL
+        basic_mass_old = basic_mass
+
+    muXL = muX_layers[nLayer]
+    muYL = muY_layers[nLayer]
+    shapeYL = muYL.shape
+    # Pad X to a whole number of composite cells; no-op if N is a power of 2
+    shapeXL = DomDecGPU.get_padded_shape(muXL.shape, 2*cellsize)
+    muXL = DomDecGPU.pad_to_shape(muXL, shapeXL, pad_value=1e-40)
+
+    # Create padding for partition B
+    shapeXL_pad = tuple(s + 2*cellsize for s in shapeXL)
+    muXLpad = DomDecGPU.pad_tensor(muXL, cellsize, pad_value=1e-40)
+
+    basic_shape = tuple(i//cellsize for i in shapeXL)
+    composite_shape_A = tuple(i//(2*cellsize) for i in shapeXL)
+    composite_shape_B = tuple(c+1 for c in composite_shape_A)
+
+    muXA = get_composite_cells(muXL, composite_shape_A)
+    muXB = get_composite_cells(muXLpad, composite_shape_B)
+
+    # Get X grid coordinates
+    dx = 2.0**(nLayerFinest - nLayer)
+    dxs = torch.tensor([dx]*dim)
+    dys = torch.tensor([dx]*dim)
+    dxs_dys = (dxs, dys)
+
+    muXA_box = DomDecGPU.BoundingBox(
+        muXA, get_composite_offsets(composite_shape_A, 0), shapeXL)
+    muXB_box = DomDecGPU.BoundingBox(
+        muXB, get_composite_offsets(composite_shape_B, cellsize), shapeXL_pad)
+    posXA = DomDecGPU.get_grid_cartesian_coordinates(muXA_box, dxs)
+    posXB = DomDecGPU.get_grid_cartesian_coordinates(muXB_box, dxs)
+
+    basic_mass = muXL.view(DomDecGPU.get_children_shape(basic_shape, cellsize)) \
+        .sum(tuple(range(1, 2*dim, 2)))
+
+    # Generate partitions
+    basic_index = torch.arange(int(np.prod(basic_shape)),
+                               **torch_options_int).reshape(basic_shape)
+    partA = get_partition(basic_index)
+    partB = get_partition(DomDecGPU.pad_tensor(basic_index, 1, pad_value = -1))
+
+    if nLayer == nLayerTop:
+        muY_basic = basic_mass.view(-1, *[1]*dim) * muYL.view(1, *shapeYL)
+        B = muY_basic.shape[0]
+        offsets = torch.zeros((B, dim), **torch_options_int)
+        muY_basic_box = DomDecGPU.BoundingBox(muY_basic, offsets, shapeYL)
+    else:
+        # refine atomic Y marginals from previous layer
+        muY_basic_box = DomDecGPU.refine_marginals_CUDA(
+            muY_basic_box_old, basic_mass_old, basic_mass, muYLOld, muYL)
+
+    # Potentials of partitions A and B
+    alphas = [torch.zeros(muXA.shape, **torch_options),
+              torch.zeros(muXB.shape, **torch_options)]
+
+    # Buffers reused by all iterations on this layer
+    workspace = DomDecGPU.Workspace()
+    bucket_cache_A = dict()
+    bucket_cache_B = dict()
+
+    timeRefine2 = time.perf_counter()
+    evaluationData["time_refine"] += timeRefine2-timeRefine1
+
+    # run algorithm at layer
+    for nEps, (eps, nIterationsMax) in enumerate(params["eps_list"][nLayer]):
+        print("eps: {:f}".format(eps))
+        for nIterations in range(nIterationsMax):
+            for (k, (muXJ, posXJ, part, bucket_cache)) in enumerate([
+                    (muXA, posXA, partA, bucket_cache_A),
+                    (muXB, posXB, partB, bucket_cache_B)]):
+                time1 = time.perf_counter()
+                # Y coordinates are generated from the bounding boxes
+                alphas[k], muY_basic_box, info = DomDecGPU.MiniBatchIterate(
+                    muYL, None, dxs_dys, eps,
+                    muXJ, posXJ, alphas[k], muY_basic_box, shapeYL, part,
+                    SinkhornError=params["sinkhorn_error"],
+                    SinkhornErrorRel=params["sinkhorn_error_rel"],
+                    SinkhornMaxIter=params["sinkhorn_max_iter"],
+                    SinkhornInnerIter=params["sinkhorn_inner_iter"],
+                    batchsize=params["batchsize"],
+                    clustering = params["clustering"],
+                    N_clusters = params["number_clusters"],
+                    balance = params["balance"],
+                    workspace = workspace,
+                    clustering_method = params["clustering_method"],
+                    bucket_cache = bucket_cache,
+                    streaming = params["streaming"],
+                    memory_budget = params["memory_budget"]
+                )
+                time2 = time.perf_counter()
+                evaluationData["time_iterate"] += time2-time1
+                evaluationData["time_sinkhorn"] += info["time_sinkhorn"]
+                evaluationData["time_measureBalancing"] += info["time_balance"]
+                evaluationData["time_bounding_box"] += info["time_bounding_box"]
+                evaluationData["time_clustering"] += info["time_clustering"]
+                Niter_per_batch = [solver.Niter for solver in info["solver"]]
+                print(f"Niter = {Niter_per_batch}, "
+                      f"bounding box = {info['bounding_box']}")
+                evaluationData["sinkhorn_iters"].append(
+                    [nLayer, nEps, nIterations, eps, sum(Niter_per_batch)])
+                globalTime2 = time.perf_counter()
+                print("time:", globalTime2-globalTime1)
+                evaluationData["timeList_global"].append(
+                    [nLayer, nEps, nIterations, k, globalTime2-globalTime1])
+
+    nLayer += 1
+
+#####################################
+# evaluate primal score and marginal errors of the last B half-iteration
+solution_infos = DomDecGPU.get_primal_infos(info, eps)
+current_muY = DomDecGPU.get_current_Y_marginal(muY_basic_box, shapeYL)
+solution_infos["errorMargY"] = \
+    torch.abs(current_muY.ravel() - muYL.ravel()).sum().item()
+print("===================")
+print("solution infos")
+print(json.dumps(solution_infos, indent = 4))
+print("===================")
+for k in solution_infos.keys():
+    evaluationData["solution_"+k] = solution_infos[k]
+
+#####################################
+# dump evaluationData into json result file:
+with open(params["setup_resultfile"], "w") as f:
+    json.dump(evaluationData, f)
@@ -7,9 +7,7 @@ import lib.Common as Common
 
 import lib.DomainDecomposition as DomDec
 import lib.DomainDecompositionGPU as DomDecGPU
-import lib.DomainDecompositionHybrid as DomDecHybrid
 import lib.MultiScaleOT as MultiScaleOT
-import LogSinkhornGPU
 
 import os
 import psutil
@@ -37,8 +35,9 @@ from lib.AuxConv import *
 # * shape: d-tuple
 #       Shape of grid.
 # 
-# Provided multiscale implementation only support shapes that are power of 2,  
-# and equispaced grids.
+# Grids can be rectangular and of any size: every layer of the multiscale 
+# hierarchy is padded to the next multiple of the composite cell size. Only
+# equispaced grids are supported.
 ###############################################################################
 
 # read parameters from command line and cfg file
@@ -55,7 +54,11 @@ cellsize = params["domdec_cellsize"]
 params["batchsize"] = np.inf
 params["clustering"] = True
 params["number_clusters"] = "smart"
+params["clustering_method"] = "bucketing" # options are kmeans | bucketing
 params["balance"] = True
+params["streaming"] = False # store basic cell marginals ragged
+params["memory_budget"] = np.inf # bytes per minibatch, implies streaming
+params["precision"] = "double" # options are double | mixed | single
 
 # Subproblem Sinkhorn parameters
 params["sinkhorn_max_iter"] = 10000
@@ -71,6 +74,8 @@ params["setup_resultfile"] = "results-domdec-gpu.txt"
 params["setup_dumpfile_finest"] = "dump-domdec-gpu.dat"
 params["aux_dump_finest"] = False 
 params["aux_evaluate_scores"] = True 
+params["aux_validate_precision"] = False # compare final iteration to float64
+params["aux_monitor_Y_marginal"] = False # track Y marginal error per half-iteration
 
 # Allow all parameters to be overriden on the command line
 args = argparse.ArgumentParser()
@@ -86,13 +91,18 @@ for k in sorted(params.keys()):
 
 ##########################################################
 # Torch parameters
-device = "cuda"
+# Without CUDA everything runs on the pure PyTorch backend, see
+# DomDecGPU.get_backend
+device = "cuda" if torch.cuda.is_available() else "cpu"
 # torch_dtype = torch.float32
 torch_dtype = torch.float64
 numpy_dtype = np.float32
 
 torch_options = dict(dtype=torch_dtype, device=device)
 torch_options_int = dict(dtype=torch.int32, device=device)
+# Type of the stored cell marginals and duals, see DomDecGPU.PrecisionPolicy
+precision = DomDecGPU.PrecisionPolicy.from_name(params["precision"])
+storage_options = dict(dtype=precision.storage_dtype, device=device)
 ##########################################################
 
 
@@ -101,14 +111,15 @@ torch_options_int = dict(dtype=torch.int32, device=device)
 muX, posX, shapeX = Common.importMeasure(params["setup_fn1"])
 muY, posY, shapeY = Common.importMeasure(params["setup_fn2"])
 
-N = shapeX[0]
-params["hierarchy_depth"] = int(np.log2(N))
+params["hierarchy_depth"] = DomDecGPU.get_hierarchy_depth(shapeX)
 
 # Get multiscale torch hierarchy
 muX_final = torch.tensor(muX, **torch_options).view(shapeX)
-muY_final = torch.tensor(muY, **torch_options).view(shapeX)
-muX_layers = DomDecGPU.get_multiscale_layers(muX_final, shapeX)
-muY_layers = DomDecGPU.get_multiscale_layers(muY_final, shapeY)
+muY_final = torch.tensor(muY, **torch_options).view(shapeY)
+muX_layers = DomDecGPU.get_multiscale_layers(
+    muX_final, shapeX, params["hierarchy_depth"])
+muY_layers = DomDecGPU.get_multiscale_layers(
+    muY_final, shapeY, params["hierarchy_depth"])
 
 # convert pos arrays to double for c++ compatibility
 posXD = posX.astype(np.float64)
@@ -140,6 +151,7 @@ evaluationData["sparsity_muYAtomicEntries"] = []
 evaluationData["shape_muYAtomicEntries"] = []
 
 evaluationData["sinkhorn_iters"] = []
+evaluationData["errorMargY_tracked"] = []
 
 globalTime1 = time.perf_counter()
 
@@ -168,15 +180,19 @@ while nLayer <= nLayerFinest:
         if params["domdec_refineAlpha"]:
             # Remove dummy basic cells for refinement
             alphaFieldEven = DomDecGPU.get_alpha_field_even_gpu(
-                alphaA, alphaB, shapeXL, shapeXL_pad,
-                cellsize, basic_shape, muXL_np)
+                precision.compute(alphaA), precision.compute(alphaB),
+                shapeXL, shapeXL_pad,
+                cellsize, basic_shape, muXL_np, shapeXL_data)
 
 
     muXL = muX_layers[nLayer]
     muYL = muY_layers[nLayer]
-    muXL_np = muXL.cpu().numpy().ravel()
-    shapeXL = muXL.shape
     shapeYL = muYL.shape
+    # Pad X to a whole number of composite cells; no-op on dyadic grids
+    shapeXL_data = muXL.shape
+    shapeXL = DomDecGPU.get_padded_shape(shapeXL_data, 2*cellsize)
+    muXL = DomDecGPU.pad_to_shape(muXL, shapeXL, pad_value=1e-40)
+    muXL_np = muXL.cpu().numpy().ravel()
 
     # Create padding
     shapeXL_pad = tuple(s + 2*cellsize for s in shapeXL)
@@ -241,19 +257,21 @@ while nLayer <= nLayerFinest:
 
     if nLayer == nLayerTop:
         muY_basic = basic_mass.view(-1, 1, 1) * muYL.view(1, *shapeYL)
+        muY_basic = precision.store(muY_basic)
         B = muY_basic.shape[0]
         offsets = torch.zeros((B, 2), **torch_options_int)
         muY_basic_box = DomDecGPU.BoundingBox(muY_basic, offsets, shapeYL)
 
-        alphaA = torch.zeros(shapeXL, **torch_options)
+        alphaA = torch.zeros(shapeXL, **storage_options)
         alphaA = alphaA.view(-1, 2*cellsize, 2*cellsize)
-        alphaB = torch.zeros(shapeXL_pad, **torch_options)
+        alphaB = torch.zeros(shapeXL_pad, **storage_options)
         alphaB = alphaB.view(-1, 2*cellsize, 2*cellsize)
 
     else:
         # refine atomic Y marginals from previous layer
         muY_basic_box = DomDecGPU.refine_marginals_CUDA(
-            muY_basic_box_old, basic_mass_old, basic_mass, muYLOld, muYL)
+            muY_basic_box_old, basic_mass_old, basic_mass, muYLOld, muYL,
+            precision = precision)
 
         if params["domdec_refineAlpha"]:
             # Inerpolate previous alpha field
@@ -261,6 +279,8 @@ while nLayer <= nLayerFinest:
             alphaA = torch.nn.functional.interpolate(
                 alphaFieldEven[None, None, :, :], scale_factor=2,
                 mode="bilinear").squeeze()
+            # Twice the previous layer may exceed the padded shape
+            alphaA = alphaA[:shapeXL[0], :shapeXL[1]].contiguous()
 
             # Init alphaB, using padding
             alphaB = DomDecGPU.pad_tensor(alphaA, cellsize, 0.0)
@@ -273,10 +293,12 @@ while nLayer <= nLayerFinest:
             alphaB = alphaB.view(c1+1, 2*cellsize, c2+1, 2*cellsize) \
                 .permute(0, 2, 1, 3).contiguous() \
                 .view(-1, 2*cellsize, 2*cellsize)
+            alphaA = precision.store(alphaA)
+            alphaB = precision.store(alphaB)
         else:
-            alphaA = torch.zeros(shapeXL, **torch_options)
+            alphaA = torch.zeros(shapeXL, **storage_options)
             alphaA = alphaA.view(-1, 2*cellsize, 2*cellsize)
-            alphaB = torch.zeros(shapeXL_pad,  **torch_options)
+            alphaB = torch.zeros(shapeXL_pad,  **storage_options)
             alphaB = alphaB.view(-1, 2*cellsize, 2*cellsize)
 
     # set up new empty beta lists:
@@ -284,6 +306,16 @@ while nLayer <= nLayerFinest:
     betaAIndexList = [None for i in range(alphaA.shape[0])]
     betaBDataList = [None for i in range(alphaB.shape[0])]
     betaBIndexList = [None for i in range(alphaB.shape[0])]
+
+    # Buffers reused by all iterations on this layer
+    workspace = DomDecGPU.Workspace()
+    # Minibatch buckets reused over iterations, one for each partition
+    bucket_cache_A = dict()
+    bucket_cache_B = dict()
+    # Incremental Y marginal, updated by the cells touched in each minibatch
+    tracker = None
+    if params["aux_monitor_Y_marginal"]:
+        tracker = DomDecGPU.YMarginalTracker(muY_basic_box, shapeYL, muYL)
     
     timeRefine2 = time.perf_counter()
     evaluationData["time_refine"] += timeRefine2-timeRefine1
@@ -311,7 +343,14 @@ while nLayer <= nLayerFinest:
                 batchsize=params["batchsize"],
                 clustering = params["clustering"],
                 N_clusters = params["number_clusters"], 
-                balance = params["balance"]
+                balance = params["balance"],
+                workspace = workspace,
+                clustering_method = params["clustering_method"],
+                bucket_cache = bucket_cache_A,
+                streaming = params["streaming"],
+                memory_budget = params["memory_budget"],
+                precision = precision,
+                tracker = tracker
             )
             # solverA = info["solver"]
 
@@ -336,6 +375,11 @@ while nLayer <= nLayerFinest:
                 [nLayer, nEps, nIterations, 0, shape_muY_basic])
             evaluationData["sinkhorn_iters"].append(
                 [nLayer, nEps, nIterations, eps, sum(Niter_per_batch)])
+            if tracker is not None:
+                errorMargY = tracker.errorMargY.item()
+                print("errorMargY:", errorMargY)
+                evaluationData["errorMargY_tracked"].append(
+                    [nLayer, nEps, nIterations, 0, errorMargY])
 
             ################################
             # global time
@@ -359,7 +403,14 @@ while nLayer <= nLayerFinest:
                 batchsize=params["batchsize"],
                 clustering = params["clustering"],
                 N_clusters = params["number_clusters"], 
-                balance = params["balance"]
+                balance = params["balance"],
+                workspace = workspace,
+                clustering_method = params["clustering_method"],
+                bucket_cache = bucket_cache_B,
+                streaming = params["streaming"],
+                memory_budget = params["memory_budget"],
+                precision = precision,
+                tracker = tracker
             )
             time2 = time.perf_counter()
             evaluationData["time_iterate"] += time2-time1
@@ -382,6 +433,11 @@ while nLayer <= nLayerFinest:
                 [nLayer, nEps, nIterations, 1, shape_muY_basic])
             evaluationData["sinkhorn_iters"].append(
                 [nLayer, nEps, nIterations, eps, sum(Niter_per_batch)])
+            if tracker is not None:
+                errorMargY = tracker.errorMargY.item()
+                print("errorMargY:", errorMargY)
+                evaluationData["errorMargY_tracked"].append(
+                    [nLayer, nEps, nIterations, 1, errorMargY])
 
             ################################
             # global time
@@ -401,10 +457,11 @@ while nLayer <= nLayerFinest:
 # dump finest
 if params["aux_dump_finest"]:
     print("dumping to file: aux_dump_finest...")
+    muY_basic_box_dump = DomDecGPU.as_bounding_box(muY_basic_box)
     with open(params["setup_dumpfile_finest"], 'wb') as f:
         pickle.dump([muXL, muYL, eps, dxs_dys,
-                     muY_basic_box.data.cpu(), 
-                     muY_basic_box.offsets.cpu(),
+                     muY_basic_box_dump.data.cpu(), 
+                     muY_basic_box_dump.offsets.cpu(),
                      muXA.cpu(), alphaA.cpu(),
                      muXB.cpu(), alphaB.cpu()], f, 2)
     print("dumping done.")
@@ -418,19 +475,23 @@ if params["aux_evaluate_scores"]:
 
     # Get smooth alpha
     alpha_global = DomDecGPU.get_alpha_field_even_gpu(
-        alphaA, alphaB, shapeXL, shapeXL_pad,
-        cellsize, basic_shape, muXL_np)
-
-    # Get beta with sinkhorn iteration
-    solver_global = LogSinkhornGPU.LogSinkhornCudaImage(
-        muXL.view(1, *shapeX), muYL.view(1, *shapeY), dx, eps,
+        precision.compute(alphaA), precision.compute(alphaB),
+        shapeXL, shapeXL_pad,
+        cellsize, basic_shape, muXL_np, shapeX)
+
+    # Get beta with sinkhorn iteration, on the unpadded X grid
+    alpha_global = alpha_global[:shapeX[0], :shapeX[1]].contiguous()
+    solver_global = DomDecGPU.get_backend(device).LogSinkhornCudaImage(
+        muX_final.view(1, *shapeX), muYL.view(1, *shapeY), dx, eps,
         alpha_init = alpha_global.view(1, *shapeX))
     solver_global.iterate(0)
     beta_global = solver_global.beta.squeeze()
 
-    # Dual Score
+    # Dual Score, minus eps times the mass of the plan like the primal score
+    # of get_primal_infos. After the beta update the plan has Y marginal nu.
     dual_score = torch.sum(solver_global.alpha * solver_global.mu) + \
-        torch.sum(solver_global.beta * solver_global.nu)
+        torch.sum(solver_global.beta * solver_global.nu) - \
+        eps * torch.sum(solver_global.nu)
     dual_score = dual_score.item()
     solution_infos["scoreDual"] = dual_score
 
@@ -445,18 +506,16 @@ if params["aux_evaluate_scores"]:
         SinkhornInnerIter=0,
         batchsize=params["batchsize"],
         clustering = params["clustering"],
-        N_clusters = params["number_clusters"]
+        N_clusters = params["number_clusters"],
+        clustering_method = params["clustering_method"],
+        precision = precision
     )
-    # Get primal_score and muX_error
-    primal_score = 0.0
-    muX_error = 0.0
-    for solverB in info["solver"]:
-        primal_score += (torch.sum(solverB.alpha * solverB.mu) + torch.sum(solverB.beta * solverB.nu)).item()
-        new_alpha = solverB.get_new_alpha()
-        current_mu = solverB.mu * torch.exp((solverB.alpha - new_alpha)/eps)
-        muX_error += torch.sum(torch.abs(solverB.mu - current_mu)).item()
+    # Get primal_score, transport cost and muX_error
+    primal_infos = DomDecGPU.get_primal_infos(info, eps)
+    primal_score = primal_infos["scorePrimal"]
     solution_infos["scorePrimal"] = primal_score
-    solution_infos["errorMargX"] = muX_error
+    solution_infos["scorePrimalUnreg"] = primal_infos["scorePrimalUnreg"]
+    solution_infos["errorMargX"] = primal_infos["errorMargX"]
     solution_infos["scoreGap"] = primal_score - dual_score
     solution_infos["scoreGapRel"] = (primal_score - dual_score)/primal_score
     # muY error
@@ -464,6 +523,23 @@ if params["aux_evaluate_scores"]:
     muY_error = torch.abs(current_muY.ravel() - muYL.ravel()).sum().item()
     solution_infos["errorMargY"] = muY_error
 
+    # Compare one more iteration with the chosen precision to float64
+    if params["aux_validate_precision"]:
+        report = DomDecGPU.validate_precision(
+            precision, muYL, posY, dxs_dys, eps,
+            muXB, posXB, alphaB, muY_basic_box, shapeY, partB,
+            SinkhornError=params["sinkhorn_error"],
+            SinkhornErrorRel=params["sinkhorn_error_rel"],
+            SinkhornMaxIter=params["sinkhorn_max_iter"],
+            SinkhornInnerIter=params["sinkhorn_inner_iter"],
+            batchsize=params["batchsize"],
+            clustering = params["clustering"],
+            N_clusters = params["number_clusters"],
+            clustering_method = params["clustering_method"]
+        )
+        for k in report.keys():
+            solution_infos["precision_"+k] = report[k]
+
     print("===================")
     print("solution infos")
     print(json.dumps(solution_infos, indent = 4))
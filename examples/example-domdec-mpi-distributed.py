@@ -0,0 +1,225 @@
+from mpi4py import MPI
+import numpy as np
+import time
+import sys
+sys.path.append("../")
+import lib.DomDecParallelMPI as DomDecParallelMPI
+import argparse
+
+###############################################################################
+# # Distributed MPI multiscale domain decomposition for entropic optimal transport
+# =============================================================================
+#
+# Same problem as example-domdec-mpi.py, but instead of a root process that
+# holds all atomic marginals and sends them to the workers on every
+# half-iteration, all processes run this script. Each process owns a block of
+# atomic cells and keeps their marginals and the duals of its composite cells
+# (see DomDecParallelMPI.DistributedDomDec). Between half-iterations only the
+# marginals at the block boundaries are exchanged with the neighbouring
+# processes. The root process only sets up the parameters and collects
+# reductions (number of entries, scores).
+#
+# The input measures are provided in a .pickle file containing a dictionary
+# with keys:
+# * mu: (N,) array
+#       Weights of the measure.
+# * pos: (N, d) array
+#       Positions of the measure's support. They are supposed to be equispaced
+#       on a regular grid of shape `shapeX`
+# * shape: d-tuple
+#       Shape of grid.
+#
+# Provided multiscale implementation only support shapes that are power of 2,
+# and equispaced grids.
+###############################################################################
+
+comm = MPI.COMM_WORLD
+
+rank=comm.Get_rank()
+nRanks=comm.Get_size()
+
+from lib.header_script import *
+import lib.Common as Common
+
+import lib.DomainDecomposition as DomDec
+import lib.MultiScaleOT as MultiScaleOT
+
+import pickle
+
+from lib.header_params import *
+from lib.AuxConv import *
+
+
+###############################################################
+###############################################################
+
+# read parameters from command line and cfg file on root, all other processes use its settings
+if rank==0:
+    print(f"Solving with {nRanks} processes")
+    print("setting script parameters")
+    params=getDefaultParams()
+
+    # Input data files
+    params["setup_fn1"] = "data/f-000-256.pickle"
+    params["setup_fn2"] = "data/f-001-256.pickle"
+
+    # Domdec parameters
+    params["domdec_cellsize"] = 4
+
+    # Subproblem Sinkhorn parameters
+    params["sinkhorn_max_iter"] = 10000
+    params["sinkhorn_inner_iter"] = 10
+    params["sinkhorn_error"] = 1e-4
+    params["sinkhorn_error_rel"] = True
+
+    # Multiscale parameters
+    params["hierarchy_top"] = int(np.log2(params["domdec_cellsize"])) + 1
+
+    # Dump files
+    params["setup_resultfile"] = "results-domdec-mpi-distributed.txt"
+    params["aux_evaluate_scores"] = True
+
+    # Allow all parameters to be overriden on the command line
+    args = argparse.ArgumentParser()
+    for key in params.keys():
+        args.add_argument(f"--{key}", dest = key,
+                default = params[key], type = type(params[key]))
+    params = vars(args.parse_args())
+
+    print("final parameter settings")
+    for k in sorted(params.keys()):
+        print("\t",k,params[k])
+else:
+    params=None
+
+params=comm.bcast(params,root=0)
+
+###############################################################
+###############################################################
+
+# load input measures from file, each process sets up the multiscale representation
+muX,posX,shapeX=Common.importMeasure(params["setup_fn1"])
+muY,posY,shapeY=Common.importMeasure(params["setup_fn2"])
+muX = muX.ravel()
+muY = muY.ravel()
+N = shapeX[0]
+params["hierarchy_depth"] = int(np.log2(N))
+
+# convert pos arrays to double for c++ compatibility
+posXD=posX.astype(np.double)
+posYD=posY.astype(np.double)
+
+# generate multi-scale representation of muX
+MultiScaleSetupX=MultiScaleOT.TMultiScaleSetup(posXD,muX,params["hierarchy_depth"],childMode=MultiScaleOT.childModeGrid,setup=True,setupDuals=False,setupRadii=False)
+
+MultiScaleSetupY=MultiScaleOT.TMultiScaleSetup(posYD,muY,params["hierarchy_depth"],childMode=MultiScaleOT.childModeGrid,setup=True,setupDuals=False,setupRadii=False)
+
+
+# setup eps scaling
+if params["eps_schedule"]=="default":
+    params["eps_list"]=Common.getEpsListDefault(params["hierarchy_depth"],params["hierarchy_top"],\
+            params["eps_base"],params["eps_layerFactor"],params["eps_layerSteps"],params["eps_stepsFinal"],\
+            nIterations=params["eps_nIterations"],nIterationsLayerInit=params["eps_nIterationsLayerInit"],nIterationsGlobalInit=params["eps_nIterationsGlobalInit"],\
+            nIterationsFinal=params["eps_nIterationsFinal"])
+
+
+evaluationData={}
+evaluationData["time_iterate"]=0.
+evaluationData["time_refine"]=0.
+evaluationData["timeList_global"]=[]
+
+evaluationData["sparsity_muYAtomicEntries"]=[]
+
+globalTime1=time.time()
+
+
+nLayerTop=params["hierarchy_top"]
+nLayerFinest=params["hierarchy_depth"]
+nLayer=nLayerTop
+while nLayer<=nLayerFinest:
+
+
+    ################################################################################################################################
+    timeRefine1=time.time()
+    if rank==0:
+        print("layer: {:d}".format(nLayer))
+
+    # basic data of current layer
+    shapeXL=[2**(nLayer) for i in range(params["setup_dim"])]
+    muXL=MultiScaleSetupX.getMeasure(nLayer)
+    muYL=MultiScaleSetupY.getMeasure(nLayer)
+    posXL=MultiScaleSetupX.getPoints(nLayer)
+    posYL=MultiScaleSetupY.getPoints(nLayer)
+    parentsYL=MultiScaleSetupY.getParents(nLayer)
+
+    # local part of the layer: owned atomic cells, local composite cells and exchange plans
+    layer=DomDecParallelMPI.DistributedDomDec(comm,shapeXL,params["domdec_cellsize"],muXL,posXL,muYL,posYL)
+
+    if nLayer==nLayerTop:
+        layer.initialize()
+    else:
+        # refine atomic Y marginals from previous layer and move them to their new owners
+        alphaField=None
+        if params["domdec_refineAlpha"]:
+            alphaFieldEven=layerOld.getAlphaFieldEven()
+            alphaField=MultiScaleSetupX.refineSignal(alphaFieldEven,nLayer-1,1)
+        layer.refine(layerOld,parentsYL,alphaField)
+    layerOld=None
+
+    timeRefine2=time.time()
+    evaluationData["time_refine"]+=timeRefine2-timeRefine1
+    ################################################################################################################################
+
+    ## run algorithm at layer
+    for nEps,(eps,nIterationsMax) in enumerate(params["eps_list"][nLayer]):
+        if rank==0:
+            print("eps: {:f}".format(eps))
+        for nIterations in range(nIterationsMax):
+            for k in range(2):
+                ################################
+                # iteration, balancing and truncation on partition A (k=0) or B (k=1)
+                time1=time.time()
+                layer.iterate(k,eps,\
+                        SinkhornSubSolver=params["sinkhorn_subsolver"], SinkhornError=params["sinkhorn_error"], SinkhornErrorRel=params["sinkhorn_error_rel"],\
+                        truncationThresh=1E-15)
+                time2=time.time()
+                evaluationData["time_iterate"]+=time2-time1
+                ################################
+
+                ################################
+                # count total entries of atomic marginals
+                nrEntries=layer.getNnz()
+                if rank==0:
+                    print("muYAtomicEntries: {:d}".format(nrEntries))
+                    evaluationData["sparsity_muYAtomicEntries"].append([nLayer,nEps,nIterations,k,nrEntries])
+                ################################
+
+                ################################
+                # global time
+                globalTime2=time.time()
+                if rank==0:
+                    print("time:",globalTime2-globalTime1)
+                    evaluationData["timeList_global"].append([nLayer,nEps,nIterations,k,globalTime2-globalTime1])
+                    printTopic(evaluationData,"time")
+                ################################
+
+    layerOld=layer
+    nLayer+=1
+
+
+#####################################
+# evaluate primal score, summed over all processes
+if params["aux_evaluate_scores"]:
+    solutionInfos=layer.getPrimalInfos(eps)
+    if rank==0:
+        print(solutionInfos)
+        for k in solutionInfos.keys():
+            evaluationData["solution_"+k]=solutionInfos[k]
+
+
+#####################################
+# dump evaluationData into json result file:
+if rank==0:
+    with open(params["setup_resultfile"],"w") as f:
+        json.dump(evaluationData,f)
+    print(evaluationData)
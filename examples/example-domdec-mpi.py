@@ -73,6 +73,9 @@ try:
     cellsize = params["domdec_cellsize"]
     params["parallel_balancing"] = True
     params["parallel_refinement"] = True
+    params["MPI_static_data"] = True
+    # solve, balance and truncate each cell in one worker job
+    params["MPI_fused_halfstep"] = True
 
     # Subproblem Sinkhorn parameters
     params["sinkhorn_max_iter"] = 10000
@@ -101,6 +104,7 @@ try:
         params["parallel_truncation"]=False
         params["parallel_balancing"]=False
         params["parallel_refinement"]=False
+        params["MPI_fused_halfstep"]=False
 
     # Allow all parameters to be overriden on the command line
     args = argparse.ArgumentParser()
@@ -182,7 +186,7 @@ try:
             atomicCellMassesOld=atomicCellMasses
             if params["domdec_refineAlpha"]:
                 alphaFieldEven=DomDec.getAlphaFieldEven(alphaAList,alphaBList,\
-                        partitionDataA[0],partitionDataB[0],shapeXL,metaCellShape,params["domdec_cellsize"],muXL)
+                        partitionA.cells,partitionB.cells,shapeXL,metaCellShape,params["domdec_cellsize"],muXL)
             
         # basic data of current layer
         shapeXL=[2**(nLayer) for i in range(params["setup_dim"])]
@@ -194,36 +198,49 @@ try:
         parentsXL=MultiScaleSetupX.getParents(nLayer)
         parentsYL=MultiScaleSetupY.getParents(nLayer)
 
-        # create partition into atomic cells
-        atomicCells=DomDec.GetPartitionIndices2D(shapeXL,params["domdec_cellsize"],0)
-        # join atomic cells into two stacked partitions
-        metaCellShape=[i//params["domdec_cellsize"] for i in shapeXL]
+        # create partition into atomic cells, joined into two stacked partitions
+        # (cached, so this is only computed once per layer shape)
+        partitionA=DomDec.GetGridPartition(shapeXL,params["domdec_cellsize"],0)
+        partitionB=DomDec.GetGridPartition(shapeXL,params["domdec_cellsize"],1)
+        atomicCells=partitionA.atomicCells
+        metaCellShape=list(partitionA.atomicShape)
 
-        partitionMetaCellsA=DomDec.GetPartitionIndices2D(metaCellShape,2,0)
-        partitionMetaCellsB=DomDec.GetPartitionIndices2D(metaCellShape,2,1)
+        partitionDataACompCells=partitionA.children
+        partitionDataACompCellIndices=partitionA.childRanges
+        partitionDataBCompCells=partitionB.children
+        partitionDataBCompCellIndices=partitionB.childRanges
 
-        partitionDataA=DomDec.GetPartitionData(atomicCells,partitionMetaCellsA)
-        partitionDataB=DomDec.GetPartitionData(atomicCells,partitionMetaCellsB)
 
-        partitionDataACompCells=partitionDataA[1]
-        partitionDataACompCellIndices=[np.array([partitionDataA[2][j][1:3] for j in x],dtype=np.int32) for x in partitionDataACompCells]
-        partitionDataBCompCells=partitionDataB[1]
-        partitionDataBCompCellIndices=[np.array([partitionDataB[2][j][1:3] for j in x],dtype=np.int32) for x in partitionDataBCompCells]
+        muXAList=partitionA.gatherCells(muXL)
+        muXBList=partitionB.gatherCells(muXL)
 
+        posXAList=partitionA.gatherCells(posXL)
+        posXBList=partitionB.gatherCells(posXL)
 
-        muXAList=[muXL[cell].copy() for cell in partitionDataA[0]]
-        muXBList=[muXL[cell].copy() for cell in partitionDataB[0]]
+        atomicCellMasses=partitionA.getAtomicCellMasses(muXL)
 
-        posXAList=[posXL[cell].copy() for cell in partitionDataA[0]]
-        posXBList=[posXL[cell].copy() for cell in partitionDataB[0]]
+        # X-data of the cells and Y-data are registered on the workers once per layer, evict data of the previous layer
+        if params["MPI_static_data"] and (nWorkers>0):
+            ParallelMap.ClearStaticData(comm)
+            staticKeyA=(nLayer,"A")
+            staticKeyB=(nLayer,"B")
+        else:
+            staticKeyA=None
+            staticKeyB=None
 
-        atomicCellMasses=np.array([np.sum(muXL[cell]) for cell in atomicCells])
+        # static, locality-aware assignment of cells to workers, balanced by the measured cost of the last iteration
+        if params["MPI_static_scheduling"] and (nWorkers>0):
+            schedulerA=DomDecParallelMPI.LocalityScheduler(partitionA,metaCellShape,nWorkers)
+            schedulerB=DomDecParallelMPI.LocalityScheduler(partitionB,metaCellShape,nWorkers)
+        else:
+            schedulerA=None
+            schedulerB=None
 
         if nLayer==nLayerTop:
             muYAtomicDataList=[muYL*m for m in atomicCellMasses]
             muYAtomicIndicesList=[np.arange(muYL.shape[0],dtype=np.int32) for i in range(len(atomicCells))]
-            alphaAList=[np.zeros_like(muXAi) for muXAi in muXAList]
-            alphaBList=[np.zeros_like(muXBi) for muXBi in muXBList]
+            alphaAList=DomDec.PackedArrayList(np.zeros_like(muXAList.data),muXAList.indptr)
+            alphaBList=DomDec.PackedArrayList(np.zeros_like(muXBList.data),muXBList.indptr)
             
         else:
             # refine atomic Y marginals from previous layer
@@ -265,11 +282,11 @@ try:
                 
                 alphaFieldEvenNew=MultiScaleSetupX.refineSignal(alphaFieldEven,nLayer-1,1)
                 
-                alphaAList=[alphaFieldEvenNew[indices] for indices in partitionDataA[0]]
-                alphaBList=[alphaFieldEvenNew[indices] for indices in partitionDataB[0]]
+                alphaAList=partitionA.gatherCells(alphaFieldEvenNew)
+                alphaBList=partitionB.gatherCells(alphaFieldEvenNew)
             else:
-                alphaAList=[np.zeros_like(muXAi) for muXAi in muXAList]
-                alphaBList=[np.zeros_like(muXBi) for muXBi in muXBList]
+                alphaAList=DomDec.PackedArrayList(np.zeros_like(muXAList.data),muXAList.indptr)
+                alphaBList=DomDec.PackedArrayList(np.zeros_like(muXBList.data),muXBList.indptr)
 
         # set up new empty beta lists:
         betaADataList=[None for i in range(len(muXAList))]
@@ -299,13 +316,23 @@ try:
                 # iteration A
                 time1=time.time()
 
-                if params["parallel_iteration"]:
+                if params["MPI_fused_halfstep"]:
+                    DomDecParallelMPI.ParallelHalfStep(comm,muYL,posYL,eps,\
+                            partitionDataACompCells,partitionDataACompCellIndices,\
+                            muYAtomicDataList,muYAtomicIndicesList,\
+                            muXAList,posXAList,alphaAList,betaADataList,betaAIndexList,\
+                            atomicCellMasses,truncationThresh=1E-15,\
+                            SinkhornSubSolver=params["sinkhorn_subsolver"], SinkhornError=params["sinkhorn_error"], SinkhornErrorRel=params["sinkhorn_error_rel"],\
+                            MPIchunksize=params["MPI_chunksize"],MPIprobetime=params["MPI_probetime"],MPIscheduler=schedulerA,\
+                            MPIstaticKey=staticKeyA)
+                elif params["parallel_iteration"]:
                     DomDecParallelMPI.ParallelIterate(comm,muYL,posYL,eps,\
                             partitionDataACompCells,partitionDataACompCellIndices,\
                             muYAtomicDataList,muYAtomicIndicesList,\
                             muXAList,posXAList,alphaAList,betaADataList,betaAIndexList,\
                             SinkhornSubSolver=params["sinkhorn_subsolver"], SinkhornError=params["sinkhorn_error"], SinkhornErrorRel=params["sinkhorn_error_rel"],\
-                            MPIchunksize=params["MPI_chunksize"],MPIprobetime=params["MPI_probetime"])
+                            MPIchunksize=params["MPI_chunksize"],MPIprobetime=params["MPI_probetime"],MPIscheduler=schedulerA,\
+                            MPIstaticKey=staticKeyA)
                 else:
                     DomDec.Iterate(muYL,posYL,eps,\
                             partitionDataACompCells,partitionDataACompCellIndices,\
@@ -331,9 +358,12 @@ try:
                 ################################
                 # balancing A
                 time1=time.time()
-                if params["parallel_balancing"]:
+                if params["MPI_fused_halfstep"]:
+                    # already done in ParallelHalfStep
+                    pass
+                elif params["parallel_balancing"]:
                     DomDecParallelMPI.ParallelBalanceMeasures(comm,muYAtomicDataList,atomicCellMasses,partitionDataACompCells,\
-                            MPIchunksize=params["MPI_chunksize"],MPIprobetime=params["MPI_probetime"])
+                            MPIchunksize=params["MPI_chunksize"],MPIprobetime=params["MPI_probetime"],MPIscheduler=schedulerA)
                 else:
                     DomDec.BalanceMeasuresMultiAll(muYAtomicDataList,atomicCellMasses,partitionDataACompCells,verbose=False)
 
@@ -344,7 +374,10 @@ try:
                 ################################
                 # truncation A
                 time1=time.time()
-                if params["parallel_truncation"]:
+                if params["MPI_fused_halfstep"]:
+                    # already done in ParallelHalfStep
+                    pass
+                elif params["parallel_truncation"]:
                     DomDecParallelMPI.ParallelTruncateMeasures(comm,muYAtomicDataList,muYAtomicIndicesList,1E-15,\
     	                    MPIchunksize=params["MPI_chunksize"],MPIprobetime=params["MPI_probetime"])
                 else:
@@ -378,13 +411,23 @@ try:
                 # iteration B
                 time1=time.time()
 
-                if params["parallel_iteration"]:
+                if params["MPI_fused_halfstep"]:
+                    DomDecParallelMPI.ParallelHalfStep(comm,muYL,posYL,eps,\
+                            partitionDataBCompCells,partitionDataBCompCellIndices,\
+                            muYAtomicDataList,muYAtomicIndicesList,\
+                            muXBList,posXBList,alphaBList,betaBDataList,betaBIndexList,\
+                            atomicCellMasses,truncationThresh=1E-15,\
+                            SinkhornSubSolver=params["sinkhorn_subsolver"], SinkhornError=params["sinkhorn_error"], SinkhornErrorRel=params["sinkhorn_error_rel"],\
+                            MPIchunksize=params["MPI_chunksize"],MPIprobetime=params["MPI_probetime"],MPIscheduler=schedulerB,\
+                            MPIstaticKey=staticKeyB)
+                elif params["parallel_iteration"]:
                     DomDecParallelMPI.ParallelIterate(comm,muYL,posYL,eps,\
                             partitionDataBCompCells,partitionDataBCompCellIndices,\
                             muYAtomicDataList,muYAtomicIndicesList,\
                             muXBList,posXBList,alphaBList,betaBDataList,betaBIndexList,\
                             SinkhornSubSolver=params["sinkhorn_subsolver"], SinkhornError=params["sinkhorn_error"], SinkhornErrorRel=params["sinkhorn_error_rel"],\
-                            MPIchunksize=params["MPI_chunksize"],MPIprobetime=params["MPI_probetime"])
+                            MPIchunksize=params["MPI_chunksize"],MPIprobetime=params["MPI_probetime"],MPIscheduler=schedulerB,\
+                            MPIstaticKey=staticKeyB)
                 else:
                     DomDec.Iterate(muYL,posYL,eps,\
                             partitionDataBCompCells,partitionDataBCompCellIndices,\
@@ -400,9 +443,12 @@ try:
                 # balancing B
                 time1=time.time()
 
-                if params["parallel_balancing"]:
+                if params["MPI_fused_halfstep"]:
+                    # already done in ParallelHalfStep
+                    pass
+                elif params["parallel_balancing"]:
                     DomDecParallelMPI.ParallelBalanceMeasures(comm,muYAtomicDataList,atomicCellMasses,partitionDataBCompCells,\
-                            MPIchunksize=params["MPI_chunksize"],MPIprobetime=params["MPI_probetime"])
+                            MPIchunksize=params["MPI_chunksize"],MPIprobetime=params["MPI_probetime"],MPIscheduler=schedulerB)
                 else:
                     DomDec.BalanceMeasuresMultiAll(muYAtomicDataList,atomicCellMasses,partitionDataBCompCells,verbose=False)
 
@@ -414,7 +460,10 @@ try:
                 ################################
                 # truncation B
                 time1=time.time()
-                if params["parallel_truncation"]:
+                if params["MPI_fused_halfstep"]:
+                    # already done in ParallelHalfStep
+                    pass
+                elif params["parallel_truncation"]:
                     DomDecParallelMPI.ParallelTruncateMeasures(comm,muYAtomicDataList,muYAtomicIndicesList,1E-15,\
     	                    MPIchunksize=params["MPI_chunksize"],MPIprobetime=params["MPI_probetime"])
                 else:
@@ -443,7 +492,7 @@ try:
         print("dumping to file: aux_dump_finest...")
         with open(params["setup_dumpfile_finest"], 'wb') as f:
             pickle.dump([muYL,posYL,eps,\
-                    partitionDataA,partitionDataB,\
+                    partitionA.toLists(),partitionB.toLists(),\
                     muYAtomicDataList,muYAtomicIndicesList,\
                     muXAList,posXAList,alphaAList,\
                     muXBList,posXBList,alphaBList,\
@@ -459,7 +508,7 @@ try:
                 getMuYList=True)
 
         alphaFieldEven,alphaGraph=DomDec.getAlphaFieldEven(alphaAList,alphaBList,\
-                partitionDataA[0],partitionDataB[0],shapeXL,metaCellShape,params["domdec_cellsize"],\
+                partitionA.cells,partitionB.cells,shapeXL,metaCellShape,params["domdec_cellsize"],\
                 muX=muXL,requestAlphaGraph=True)
 
         betaFieldEven=DomDec.glueBetaList(\
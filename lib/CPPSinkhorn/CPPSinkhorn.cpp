@@ -179,12 +179,16 @@ py::tuple PySolveSinkhorn(py::array_t<double> muX, py::array_t<double> muY,
 	TSparseCSRContainer resultKernelData;
 
 	int msg;
-	msg=SolveSinkhorn(&muXMat, &muYMat, &posXMat, &posYMat, &rhoXMat, &rhoYMat,
-			&alphaInitMat,
-			SinkhornError, eps,
-			doubleCTransform,
-			&resultAlphaMat, &resultBetaMat,
-			&resultKernelData,test);
+	{
+		// release the GIL during the solve, such that several cells can be solved in parallel threads
+		py::gil_scoped_release release;
+		msg=SolveSinkhorn(&muXMat, &muYMat, &posXMat, &posYMat, &rhoXMat, &rhoYMat,
+				&alphaInitMat,
+				SinkhornError, eps,
+				doubleCTransform,
+				&resultAlphaMat, &resultBetaMat,
+				&resultKernelData,test);
+	}
 
 	free(muXMat.dimensions);
 	free(muYMat.dimensions);
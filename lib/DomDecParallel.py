@@ -1,18 +1,21 @@
+import os
 import numpy as np
-import scipy
-import scipy.sparse
 
-import lib.Common as Common
 import lib.DomainDecomposition as DomDec
-import lib.LogSinkhorn.LogSinkhorn as LogSinkhorn
-import lib.CPPSinkhorn.CPPSinkhorn as CPPSinkhorn
 
 import psutil
 import time
 
 
-import multiprocessing.pool as mppool
 import multiprocessing as mp
+from multiprocessing import shared_memory
+
+# Local multi-core backend for the domain decomposition algorithm.
+# Static data (muY, posY, muX and posX of the cells, partition structure) and the packed atomic Y-marginals
+# are placed in shared memory. Workers read their cells and write the new atomic marginals in place,
+# only cell numbers and dual vectors are sent between processes.
+# Mass balancing and truncation act on the packed marginals and are done on the root process, see AtomicMarginalStore.
+
 
 def getMemory(x):
     time.sleep(0.1)
@@ -20,304 +23,258 @@ def getMemory(x):
     return (os.getpid(),process.memory_info().rss)  # in bytes
 
 
-def initWorker(_muXList,_posXList,_muY,_posY,_partitionData,subSolver="LogSinkhorn"):
-    global muXList,posXList,muY,posY,partitionData
-    muXList=_muXList
-    posXList=_posXList
-    muY=_muY
-    posY=_posY
-    partitionData=_partitionData
-    
-    global SolveOnCell
-    if subSolver=="LogSinkhorn":
-    	SolveOnCell=SolveOnCell_LogSinkhorn
-    elif subSolver=="SparseSinkhorn":
-    	SolveOnCell=SolveOnCell_SparseSinkhorn
-    
-
-##############################################################################################################################
-# solve sub problems
-
-def getPi(c,alpha,beta,rhoX,rhoY,eps):
-    pi=-c+np.einsum(alpha,[0],np.ones_like(beta),[1],[0,1])+np.einsum(np.ones_like(alpha),[0],beta,[1],[0,1])
-    pi=np.exp(pi/eps)
-    pi=np.einsum(rhoX,[0],rhoY,[1],pi,[0,1],[0,1])
-    return pi
-
-def SolveOnCell_LogSinkhorn(muX,muY,posX,posY,rhoX,rhoY,alphaInit,eps,YThresh=1E-14,SinkhornError=1E-5):
-    
-    subY=muY.indices
-    # pick partial marginal vector and point positions
-    subMuY=muY.data
-    subPosY=posY[subY].copy()
-    subRhoY=rhoY[subY].copy()
-
-
-    alpha=alphaInit.copy()
-    beta=np.zeros_like(subMuY)
-    c=Common.getEuclideanCostFunction(posX,subPosY,p=2.)
-    cT=c.transpose().copy()
-    
-    msg=LogSinkhorn.iterateUntilError(alpha,beta,c,cT,muX,subMuY,rhoX,subRhoY,eps,1000,20,SinkhornError)
-    
-    if msg==1:
-        print("warning: {:d} : Sinkhorn did not converge to accuracy".format(msg))
-    elif msg!=0:
-        print("warning: {:d} : unspecified error".format(msg))
-
-    pi=getPi(c,alpha,beta,rhoX,subRhoY,eps)
-
-    return (msg,alpha,beta,pi)
-
-
-def SolveOnCell_SparseSinkhorn(muX,muY,posX,posY,rhoX,rhoY,alphaInit,eps,YThresh=1E-14,SinkhornError=1E-4,\
-        autoEpsFix=True,verbose=True):
-    """Runs the Sinkhorn algorithm on the entropic Wasserstein-2 transport problem
-    between (muX,posX) and (muY,posY) with regularization eps and initial dual variable
-    alphaInit on the X-side.
-    
-    Entries of the Y-marginal with mass less than YThresh are ignored.
-    Sinkhorn algorithm terminates when L1 error is below SinkhornError.
-
-    If autoEpsFix==True the algorithm tries to fix epsilon when something goes wrong numerically.
-    I.e. if the algorithm fails during the first run, eps is increased by a factor 2 until a result is obtained.
-    Then eps is gradually decreased again until the original value.
-    
-    If test==1 some debug tests in the c++ code are done."""
-    
-    subY=muY.indices
-    # pick partial marginal vector and point positions
-    subMuY=muY.data
-    subPosY=posY[subY].copy()
-    subRhoY=rhoY[subY].copy()
-
-    result=CPPSinkhorn.SolveSinkhorn(muX,subMuY,posX,subPosY,rhoX,subRhoY,alphaInit,\
-            SinkhornError,eps,0)
-
-    if autoEpsFix:
-        epsExponent=0
-        while result[0]!=0:
-            # in case the algorithm failed (probably since eps is too small),
-            # increase eps until it succeeds
-            
-            epsExponent+=1
-            epsEff=eps*(2**epsExponent)
-            
-            result=CPPSinkhorn.SolveSinkhorn(muX,subMuY,posX,subPosY,rhoX,subRhoY,alphaInit,\
-                    SinkhornError,epsEff,0)
-
-        if (epsExponent>0) and verbose:
-            print("autoFix:\t{:d}".format(epsExponent))
-        while epsExponent>0:
-            # now start decreasing again
-            alphaInitEff=result[1]
-            epsExponent-=1
-            epsEff=eps*(2**epsExponent)
-            result=CPPSinkhorn.SolveSinkhorn(muX,subMuY,posX,subPosY,rhoX,subRhoY,alphaInitEff,\
-                    SinkhornError,epsEff,0)
-
-            
-            if result[0]!=0:
-                raise ValueError(\
-                        "Sinkhorn error on autoEpsFix: {:d}, epsExponent {:d}".format(result[0],epsExponent))
+###############################################################################################################################
+# shared memory arrays
+
+class SharedArray:
+    """numpy array in a multiprocessing.shared_memory block.
+    The descriptor (name,shape,dtype) is small and can be sent to other processes, which attach via SharedArray.attach."""
+
+    def __init__(self,shape,dtype=np.double,name=None):
+        self.shape=tuple(int(n) for n in shape)
+        self.dtype=np.dtype(dtype)
+        nbytes=max(int(np.prod(self.shape))*self.dtype.itemsize,1)
+        if name is None:
+            self.shm=shared_memory.SharedMemory(create=True,size=nbytes)
+            self.owner=True
+        else:
+            self.shm=shared_memory.SharedMemory(name=name)
+            self.owner=False
+        self.array=np.ndarray(self.shape,dtype=self.dtype,buffer=self.shm.buf)
+
+    @classmethod
+    def fromArray(cls,a):
+        a=np.ascontiguousarray(a)
+        result=cls(a.shape,a.dtype)
+        result.array[...]=a
+        return result
+
+    @classmethod
+    def attach(cls,descriptor):
+        return cls(descriptor[1],descriptor[2],name=descriptor[0])
+
+    @property
+    def descriptor(self):
+        return (self.shm.name,self.shape,self.dtype.str)
+
+    def close(self):
+        self.array=None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def packArrayList(arrayList,dtype=np.double):
+    """Packs a list of arrays (along their first axis) into (data,indptr).
+    A PackedArrayList is used directly."""
+    if isinstance(arrayList,DomDec.PackedArrayList):
+        return (np.ascontiguousarray(arrayList.data,dtype=dtype),np.asarray(arrayList.indptr,dtype=np.int64))
+    lengths=np.array([a.shape[0] for a in arrayList],dtype=np.int64)
+    indptr=np.zeros(lengths.shape[0]+1,dtype=np.int64)
+    np.cumsum(lengths,out=indptr[1:])
+    return (np.ascontiguousarray(np.concatenate(arrayList),dtype=dtype),indptr)
+
 
+###############################################################################################################################
+# worker side
 
+def initWorker(subSolver="LogSinkhorn",SinkhornError=1E-4,SinkhornErrorRel=False):
+    global SolveOnCell,SinkhornErrorWorker,SinkhornErrorRelWorker,attachedArrays
+    if subSolver=="LogSinkhorn":
+        SolveOnCell=DomDec.SolveOnCell_LogSinkhorn
+    elif subSolver=="SparseSinkhorn":
+        SolveOnCell=DomDec.SolveOnCell_SparseSinkhorn
     else:
-        raise ValueError("Sinkhorn error: {:d}".format(result[0]))
-
-    # assemble kernel with rescaled Y indices
-    resultKernel=scipy.sparse.csr_matrix((result[3],result[4],result[5]),\
-            shape=(muX.shape[0],subMuY.shape[0]))
-    return (result[0],result[1],result[2],resultKernel)
-
-
-
-def DomDecIteration_SparseY(\
-        cellNr,cellAlpha,muYAtomicList,eps,\
-        sparseThreshold=-1.):
-    """Iterate a cell in one partition: combine corresponding atomic cells, solve subproblem and compute new atomic partial marginals."""
-        
-    # trivial return to measure time required for inter-process communication
-    #return (cellAlpha,muYAtomicList)
-        
-    # compute Y marginal of cell by summing atomic Y marginals
-    muYCell=muYAtomicList[0].copy()
-    for muYTerm in muYAtomicList[1:]:
-        muYCell+=muYTerm
-
-    # solve on cell
-    result=SolveOnCell(muXList[cellNr],muYCell,posXList[cellNr],posY,muXList[cellNr],muY,cellAlpha,eps)
-    #(msg,alpha,beta,pi)
-
-    # update partial dual variable
-    resultAlpha=result[1]
-
-    # extract new atomic muY
-    pi=result[3]
-    resultMuYAtomicList=[\
-            Common.getSparseVector(Common.GetPartialYMarginal(pi,range(*partitionData[2][j][1:3])),\
-                sparseThreshold,\
-                subIndices=muYCell.indices,subShape=muY.shape[0])
-            for j in partitionData[1][cellNr]
-            ]
-
-    return (resultAlpha,resultMuYAtomicList)
+        SolveOnCell=subSolver
+    SinkhornErrorWorker=SinkhornError
+    SinkhornErrorRelWorker=SinkhornErrorRel
+    # shared arrays the worker is attached to, by name
+    attachedArrays={}
+
+
+def getWorkerArrays(descriptors):
+    """Attaches to the shared arrays given by a dict of descriptors and returns a dict of numpy arrays.
+    Arrays that are no longer referenced by the descriptors are released."""
+    global attachedArrays
+    names=set(d[0] for d in descriptors.values())
+    for name in list(attachedArrays.keys()):
+        if name not in names:
+            attachedArrays.pop(name).close()
+    result={}
+    for key,d in descriptors.items():
+        if d[0] not in attachedArrays:
+            attachedArrays[d[0]]=SharedArray.attach(d)
+        result[key]=attachedArrays[d[0]].array
+    return result
 
-###############################################################################################################################
-# mass balancing between atomic marginals
-
-def getPairwiseDelta(d1,d2):
-    return min(max(d1,0),max(-d2,0))-min(max(-d1,0),max(d2,0))
-
-def BalanceMeasuresMulti(muYAtomicListSub,massDeltasSub,threshStep=1E-16,threshTerminate=1E-10):
-    nCells=len(muYAtomicListSub)
-    if nCells==1:
-        return (0,muYAtomicListSub,massDeltasSub)
-
-    for i in range(nCells):
-        for j in range(i+1,nCells):
-            delta=getPairwiseDelta(massDeltasSub[i],massDeltasSub[j])
-            if delta>0:
-                delta=min(delta,np.sum(muYAtomicListSub[i]))
-            else:
-                delta=max(delta,-np.sum(muYAtomicListSub[j]))
-            if np.abs(delta)>threshStep:
-                LogSinkhorn.balanceMeasures_sparse(\
-                        muYAtomicListSub[i].data,muYAtomicListSub[j].data,\
-                        muYAtomicListSub[i].indices,muYAtomicListSub[j].indices,\
-                        delta)
-                massDeltasSub[i]-=delta
-                massDeltasSub[j]+=delta
-            if np.sum(np.abs(massDeltasSub))<threshTerminate:
-                return (0,muYAtomicListSub,massDeltasSub)
-    return (1,muYAtomicListSub,massDeltasSub)
+
+def getSegment(data,indptr,i):
+    return data[indptr[i]:indptr[i+1]]
+
+
+def IterateCells(descriptors,cellNumbers,alphas,eps):
+    """Worker job: iterates the composite cells cellNumbers, reading static data and atomic marginals from shared memory
+    and writing the new atomic marginals and their common support into the shared output arrays.
+    Returns a list of tuples (cellNr,alpha,beta,nIndices)."""
+    a=getWorkerArrays(descriptors)
+    result=[]
+    for i,alphaCell in zip(cellNumbers,alphas):
+        children=getSegment(a["children"],a["childrenIndptr"],i)
+        muYAtomicListData=[getSegment(a["storeData"],a["storeIndptr"],j) for j in children]
+        muYAtomicListIndices=[getSegment(a["storeIndices"],a["storeIndptr"],j) for j in children]
+        resultAlpha,resultBeta,resultMuYAtomicDataList,muYCellIndices=DomDec.DomDecIteration_SparseY(\
+                SolveOnCell,SinkhornErrorWorker,SinkhornErrorRelWorker,a["muY"],a["posY"],eps,\
+                getSegment(a["muX"],a["muXIndptr"],i),getSegment(a["posX"],a["muXIndptr"],i),alphaCell,\
+                muYAtomicListData,muYAtomicListIndices,getSegment(a["childRanges"],a["childrenIndptr"],i))
+        nIndices=muYCellIndices.shape[0]
+        outData=a["outData"][a["outDataOffsets"][i]:a["outDataOffsets"][i]+children.shape[0]*nIndices]
+        outData.reshape((children.shape[0],nIndices))[...]=resultMuYAtomicDataList
+        a["outIndices"][a["outIndicesOffsets"][i]:a["outIndicesOffsets"][i]+nIndices]=muYCellIndices
+        result.append((i,resultAlpha,resultBeta,nIndices))
+    return result
 
 
 ###############################################################################################################################
+# root side
 
 def setSpawnMethod(mthd="spawn"):
     mp.set_start_method(mthd)
 
 class DomainDecompositionParallelIterator:
-    def __init__(self,nWorkers,muXList,posXList,muY,posY,partitionData,subSolver="LogSinkhorn"):
-        self.nWorkers=nWorkers
-        self.muXList=muXList
-        self.posXList=posXList
-        self.muY=muY
-        self.posY=posY
-        self.partitionData=partitionData
-        self.subSolver=subSolver
-        
-        self.nCells=len(self.muXList)
-
-        self.pool=mp.Pool(self.nWorkers,initWorker,(self.muXList,self.posXList,self.muY,self.posY,self.partitionData,self.subSolver))
-
-    def iterate(self,alphaList,muYAtomicList,eps):
-        argList=[(i,alphaList[i],[muYAtomicList[j] for j in self.partitionData[1][i]],eps) for i in range(self.nCells)]
-        result=self.pool.starmap(DomDecIteration_SparseY,argList)
-
-        for i,(alphaData,muYAtomicData) in enumerate(result):
-            alphaList[i]=alphaData
-            for jsub,j in enumerate(self.partitionData[1][i]):
-                muYAtomicList[j]=muYAtomicData[jsub]
-
-    def balanceMeasures(self,muYAtomicList,massDeltas,verbose=False):
-        argList=[[[muYAtomicList[j] for j in self.partitionData[1][i]],massDeltas[self.partitionData[1][i]]] for i in range(self.nCells)]
-        result=self.pool.starmap(BalanceMeasuresMulti,argList)
-        
-        for i,(msg,muYAtomicData,massDeltaData) in enumerate(result):
-            massDeltas[self.partitionData[1][i]]=massDeltaData
-            for jsub,j in enumerate(self.partitionData[1][i]):
-                muYAtomicList[j]=muYAtomicData[jsub]
-            if (msg!=0) and (verbose):
-                print("warning: failed to balance measures in cell {:d}".format(i))
-
-    def truncateMeasures(self,muYAtomicList,thresh):
-        argList=[[x,thresh] for x in muYAtomicList]
-        result=self.pool.starmap(Common.truncateSparseVector,argList)
-        for i in range(len(muYAtomicList)):
-            muYAtomicList[i]=result[i]
+    """Process pool for the half-iterations of the domain decomposition algorithm.
 
+    Usage: register the static data of each partition with setPartition, then call iterate with an AtomicMarginalStore,
+    which is updated like in DomDec.Iterate. When the layer changes, call setPartition again with the new data.
+    Call close to terminate the workers and free the shared memory."""
 
-    def getMemory(self):
-        return self.pool.map(getMemory,range(self.nWorkers))
-
-######################################################################################################################################
-
-def initWorkerRefiner(_muYAtomicListOld,_atomicCellParents,_muXL,_muYL,_muXLOld,_muYLOld,_atomicCells,_atomicCellsOld,_childrenYLOld):
-    global muYAtomicListOld,atomicCellParents,muXL,muYL,muXLOld,muYLOld,atomicCells,atomicCellsOld,childrenYLOld
-    
-    muYAtomicListOld=_muYAtomicListOld
-    atomicCellParents=_atomicCellParents
-    muXL=_muXL
-    muYL=_muYL
-    muXLOld=_muXLOld
-    muYLOld=_muYLOld
-    atomicCells=_atomicCells
-    atomicCellsOld=_atomicCellsOld
-    childrenYLOld=_childrenYLOld
-
-
-def refineMuYAtomic(i):
-    muYAtomicOld=muYAtomicListOld[atomicCellParents[i]]
-
-    yres=muYL.shape[0]
-    xMassScaleFactor=np.sum(muXL[atomicCells[i]])/np.sum(muXLOld[atomicCellsOld[atomicCellParents[i]]])
-    indicesFine=[]
-    dataFine=[]
-    yMassScaleFactors=muYAtomicOld.data/muYLOld[muYAtomicOld.indices]
-    for d,y in zip(yMassScaleFactors,muYAtomicOld.indices):
-        indicesFine+=childrenYLOld[y]
-        dataFine.append(muYL[childrenYLOld[y]]*d*xMassScaleFactor)
-    indicesFine=np.array(indicesFine,dtype=np.int32)
-    dataFine=np.hstack(dataFine)
-    indptrFine=np.array([0,indicesFine.shape[0]],dtype=np.int32)
-    result=Common.truncateSparseVector(\
-            scipy.sparse.csr_matrix((dataFine,indicesFine,indptrFine),shape=(1,yres)),
-            thresh=1E-15)
-    result.sort_indices()
-    return result
-    
-
-class MuYAtomicParallelRefiner:
-    def __init__(self,nWorkers,muXL,muYL,muXLOld,muYLOld,parentsYL,
-            atomicCells,atomicCellsOld,muYAtomicListOld,metaCellShape,thresh=1E-15):
-            
+    def __init__(self,nWorkers,muY,posY,SinkhornSubSolver="LogSinkhorn",SinkhornError=1E-4,SinkhornErrorRel=False,\
+            chunksPerWorker=4):
         self.nWorkers=nWorkers
-        self.muXL=muXL
-        self.muYL=muYL
-        self.muXLOld=muXLOld
-        self.muYLOld=muYLOld
-        self.parentsYL=parentsYL
-        self.atomicCells=atomicCells
-        self.atomicCellsOld=atomicCellsOld
-        self.muYAtomicListOld=muYAtomicListOld
-        self.metaCellShape=metaCellShape
-        self.thresh=thresh
-
-
-        yresOld=muYLOld.shape[0]
-
-        # list of children of each coarse node
-        self.childrenYLOld=[[] for i in range(yresOld)]
-        for i,parent in enumerate(parentsYL):
-            self.childrenYLOld[parent].append(i)
-
-        # old atomic cells are 2x2 clustering of new atomic cells
-        newCellChildren=DomDec.GetPartitionIndices2D(metaCellShape,2,0)
-        # for each new atomic cell compute the old parent atomic cell
-        self.atomicCellParents=np.zeros((np.prod(metaCellShape),),dtype=np.int)
-        for i,children in enumerate(newCellChildren):
-            self.atomicCellParents[children]=i
-        
-        self.pool=mp.Pool(self.nWorkers,initWorkerRefiner,\
-                (self.muYAtomicListOld,self.atomicCellParents,self.muXL,self.muYL,self.muXLOld,self.muYLOld,self.atomicCells,self.atomicCellsOld,self.childrenYLOld))
-
-    def getRefinedMuYAtomic(self):
-        return self.pool.map(refineMuYAtomic,range(len(self.atomicCells)))
-
-
-#################################################
-
+        self.chunksPerWorker=chunksPerWorker
+        self.partitions={}
+        self.buffers={}
+        self.setY(muY,posY)
+        self.pool=mp.Pool(self.nWorkers,initWorker,(SinkhornSubSolver,SinkhornError,SinkhornErrorRel))
+
+    def _setBuffer(self,key,a):
+        if key in self.buffers:
+            self.buffers.pop(key).close()
+        self.buffers[key]=SharedArray.fromArray(a)
+
+    def _getBuffer(self,key,size,dtype):
+        """Grow-only shared buffer of at least the given size."""
+        if (key not in self.buffers) or (self.buffers[key].shape[0]<size) or (self.buffers[key].dtype!=dtype):
+            if key in self.buffers:
+                self.buffers.pop(key).close()
+            self.buffers[key]=SharedArray((max(size,1),),dtype)
+        return self.buffers[key].array
+
+    def setY(self,muY,posY):
+        """Sets the Y marginal and positions, e.g. when the layer changes."""
+        self._setBuffer("muY",muY)
+        self._setBuffer("posY",posY)
+
+    def setPartition(self,key,partitionDataCompCells,partitionDataCompCellIndices,muXList,posXList):
+        """Places the static data of a partition in shared memory.
+        partitionDataCompCells can be a GridPartition, as in DomDec.Iterate."""
+        partitionDataCompCells,partitionDataCompCellIndices=DomDec.GetCompCellData(\
+                partitionDataCompCells,partitionDataCompCellIndices)
+        if key in self.partitions:
+            for name in self.partitions[key]["buffers"]:
+                self.buffers.pop(name).close()
+        children,childrenIndptr=packArrayList(partitionDataCompCells,dtype=np.int64)
+        if not isinstance(partitionDataCompCellIndices,DomDec.PackedArrayList):
+            partitionDataCompCellIndices=[np.asarray(r,dtype=np.int64).reshape((-1,2)) for r in partitionDataCompCellIndices]
+        childRanges,_=packArrayList(partitionDataCompCellIndices,dtype=np.int64)
+        muX,muXIndptr=packArrayList(muXList)
+        posX,posXIndptr=packArrayList(posXList)
+        if not np.array_equal(muXIndptr,posXIndptr):
+            raise ValueError("muXList and posXList do not match")
+        arrays={"children":children,"childrenIndptr":childrenIndptr,"childRanges":childRanges,\
+                "muX":muX,"muXIndptr":muXIndptr,"posX":posX}
+        names=[]
+        for name,a in arrays.items():
+            self._setBuffer((key,name),a)
+            names.append((key,name))
+        self.partitions[key]={"buffers":names,"children":children,"childrenIndptr":childrenIndptr,\
+                "nCells":childrenIndptr.shape[0]-1}
+
+    def getDescriptors(self,key):
+        descriptors={name:self.buffers[(key,name)].descriptor for (_,name) in self.partitions[key]["buffers"]}
+        for name in ["muY","posY","storeData","storeIndices","storeIndptr",\
+                "outData","outIndices","outDataOffsets","outIndicesOffsets"]:
+            descriptors[name]=self.buffers[name].descriptor
+        return descriptors
+
+    def iterate(self,key,eps,muYAtomicStore,alphaList,betaDataList,betaIndexList):
+        """One half-iteration on partition key, same effect as DomDec.Iterate with an AtomicMarginalStore."""
+        partition=self.partitions[key]
+        nCells=partition["nCells"]
+        children=partition["children"]
+        childrenIndptr=partition["childrenIndptr"]
+        nChildren=np.diff(childrenIndptr)
+
+        # copy the marginals into shared memory
+        nnz=muYAtomicStore.nnz
+        self._getBuffer("storeData",nnz,np.double)[:nnz]=muYAtomicStore.data
+        self._getBuffer("storeIndices",nnz,np.int32)[:nnz]=muYAtomicStore.indices
+        self._getBuffer("storeIndptr",muYAtomicStore.indptr.shape[0],np.int64)[:muYAtomicStore.indptr.shape[0]]=\
+                muYAtomicStore.indptr
+
+        # the support of a composite cell is the union of the supports of its atomic cells,
+        # reserve space for the worst case, i.e. no overlap
+        lengths=muYAtomicStore.getLengths()[children]
+        cellOfChild=np.repeat(np.arange(nCells),nChildren)
+        supportBound=np.bincount(cellOfChild,weights=lengths,minlength=nCells).astype(np.int64)
+        outIndicesOffsets=np.zeros(nCells+1,dtype=np.int64)
+        np.cumsum(supportBound,out=outIndicesOffsets[1:])
+        outDataOffsets=np.zeros(nCells+1,dtype=np.int64)
+        np.cumsum(supportBound*nChildren,out=outDataOffsets[1:])
+        self._getBuffer("outData",outDataOffsets[-1],np.double)
+        self._getBuffer("outIndices",outIndicesOffsets[-1],np.int32)
+        self._getBuffer("outDataOffsets",nCells+1,np.int64)[:nCells+1]=outDataOffsets
+        self._getBuffer("outIndicesOffsets",nCells+1,np.int64)[:nCells+1]=outIndicesOffsets
+
+        descriptors=self.getDescriptors(key)
+        chunks=np.array_split(np.arange(nCells),min(nCells,max(self.nWorkers*self.chunksPerWorker,1)))
+        jobs=[(descriptors,c,[alphaList[i] for i in c],eps) for c in chunks if c.shape[0]>0]
+
+        nIndices=np.zeros(nCells,dtype=np.int64)
+        for result in self.pool.starmap(IterateCells,jobs):
+            for i,alpha,beta,n in result:
+                alphaList[i]=alpha
+                betaDataList[i]=beta
+                nIndices[i]=n
+
+        # write results from shared memory into the store
+        outData=self.buffers["outData"].array
+        outIndices=self.buffers["outIndices"].array
+        cellList=[]
+        dataList=[]
+        indicesList=[]
+        for i in range(nCells):
+            k=nChildren[i]
+            n=nIndices[i]
+            indices=outIndices[outIndicesOffsets[i]:outIndicesOffsets[i]+n]
+            betaIndexList[i]=indices.copy()
+            cellList.append(children[childrenIndptr[i]:childrenIndptr[i+1]])
+            dataList.append(outData[outDataOffsets[i]:outDataOffsets[i]+k*n].reshape((k,n)))
+            indicesList.append(indices)
+        muYAtomicStore.replaceCells(cellList,dataList,indicesList)
+
+    def balanceMeasures(self,muYAtomicStore,atomicCellMasses,partitionDataCompCells,verbose=False):
+        DomDec.BalanceMeasuresMultiAll(muYAtomicStore,atomicCellMasses,partitionDataCompCells,verbose=verbose)
+
+    def truncateMeasures(self,muYAtomicStore,thresh):
+        muYAtomicStore.truncate(thresh)
 
+    def getMemory(self):
+        return self.pool.map(getMemory,range(self.nWorkers))
 
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for buffer in self.buffers.values():
+            buffer.close()
+        self.buffers={}
+        self.partitions={}
@@ -1,12 +1,115 @@
 import numpy as np
 import scipy
 import scipy.sparse
+from mpi4py import MPI
 
 import lib.Common as Common
 import lib.DomainDecomposition as DomDec
 import lib.MPIParallelMap as ParallelMap
 
 
+###############################################################################################################################
+# static scheduling
+
+class LocalityScheduler:
+    """Static assignment of the composite cells of one partition to the MPI workers,
+    for ParallelIterate and ParallelBalanceMeasures.
+
+    The composite cells are ordered along a Morton curve over the grid of atomic cells (by the smallest coordinates of
+    their atomic cells) and this order is cut into nWorkers contiguous ranges of roughly equal cost.
+    So each worker gets a spatially compact block of cells, and as both partitions use the same curve, a worker gets
+    roughly the same region in the A and B half-steps. The costs are uniform initially and are replaced by the times
+    measured in each ParallelIterate."""
+
+    def __init__(self,partitionDataCompCells,metaCellShape,nWorkers):
+        partitionDataCompCells,_=DomDec.GetCompCellData(partitionDataCompCells)
+        if isinstance(partitionDataCompCells,DomDec.PackedArrayList):
+            children=partitionDataCompCells.data
+            sizes=partitionDataCompCells.getLengths()
+        else:
+            children=np.concatenate([np.asarray(c,dtype=np.int64) for c in partitionDataCompCells])
+            sizes=np.array([len(c) for c in partitionDataCompCells],dtype=np.int64)
+        coords=np.stack(np.unravel_index(children,metaCellShape),axis=1)
+        cellCoords=np.minimum.reduceat(coords,np.cumsum(sizes)-sizes,axis=0)
+        self.nWorkers=nWorkers
+        self.order=np.argsort(DomDec.GetMortonCodes(cellCoords),kind="stable")
+        self.costs=np.ones(sizes.shape[0])
+        self.update()
+
+    def __len__(self):
+        return self.order.shape[0]
+
+    def update(self):
+        """Recomputes the cuts of the Morton order from self.costs. A cell goes to the first worker whose share
+        of the total cost is not yet used up at the middle of the cell."""
+        costs=self.costs[self.order]
+        cumCosts=np.cumsum(costs)
+        total=cumCosts[-1] if cumCosts.shape[0]>0 else 0.
+        targets=total*np.arange(1,self.nWorkers)/self.nWorkers
+        self.workerBounds=np.concatenate(([0],np.searchsorted(cumCosts-0.5*costs,targets),[len(self)])).astype(np.int64)
+
+    def setCosts(self,costs):
+        """Sets the cost of each composite cell and updates the assignment."""
+        self.costs=np.asarray(costs,dtype=np.double).copy()
+        self.update()
+
+    def getWorkers(self):
+        """Worker (1,...,nWorkers) of each composite cell."""
+        result=np.empty(len(self),dtype=np.int64)
+        result[self.order]=np.repeat(np.arange(1,self.nWorkers+1),np.diff(self.workerBounds))
+        return result
+
+
+###############################################################################################################################
+# iteration
+
+def GetStaticCellData(muY,posY,muXList,posXList,partitionDataCompCellIndices):
+    """Data of ParallelIterate that is constant over a layer, in the form in which it is registered on the workers.
+    The per cell lists are packed into pairs (data,indptr)."""
+    packed=[DomDec.PackedArrayList.fromList(l) for l in [muXList,posXList,partitionDataCompCellIndices]]
+    return [muY,posY]+[(p.data,p.indptr) for p in packed]
+
+
+def DomDecIteration_SparseY_Static(SolveOnCell,SinkhornError,SinkhornErrorRel,eps,staticKey,\
+        i,alphaCell,muYAtomicListData,muYAtomicListIndices):
+    """DomDec.DomDecIteration_SparseY on composite cell i, where muY, posY and the X-data of the cell are taken
+    from the static data registered on the worker under staticKey (see GetStaticCellData)."""
+    muY,posY,muXPacked,posXPacked,compCellIndicesPacked=ParallelMap.getStaticData(staticKey)
+    muXList=DomDec.PackedArrayList(*muXPacked)
+    posXList=DomDec.PackedArrayList(*posXPacked)
+    compCellIndices=DomDec.PackedArrayList(*compCellIndicesPacked)
+    return DomDec.DomDecIteration_SparseY(SolveOnCell,SinkhornError,SinkhornErrorRel,muY,posY,eps,\
+            muXList[i],posXList[i],alphaCell,muYAtomicListData,muYAtomicListIndices,compCellIndices[i])
+
+
+def DomDecHalfStep_SparseY(SolveOnCell,SinkhornError,SinkhornErrorRel,muY,posY,eps,truncationThresh,\
+        muXCell,posXCell,alphaCell,muYAtomicListData,muYAtomicListIndices,partitionDataCompCellIndices,\
+        atomicCellMassesSub):
+    """Fused job of ParallelHalfStep: DomDec.DomDecIteration_SparseY, followed by balancing the new atomic marginals
+    against atomicCellMassesSub and truncating them below truncationThresh.
+    Returns (alpha,beta,betaIndices,msg,dataList,indicesList), msg is the status of the balancing
+    and the atomic marginals dataList,indicesList no longer share their support."""
+    result=DomDec.DomDecIteration_SparseY(SolveOnCell,SinkhornError,SinkhornErrorRel,muY,posY,eps,\
+            muXCell,posXCell,alphaCell,muYAtomicListData,muYAtomicListIndices,partitionDataCompCellIndices)
+    return FinishHalfStep(result,atomicCellMassesSub,truncationThresh)
+
+
+def DomDecHalfStep_SparseY_Static(SolveOnCell,SinkhornError,SinkhornErrorRel,eps,staticKey,truncationThresh,\
+        i,alphaCell,muYAtomicListData,muYAtomicListIndices,atomicCellMassesSub):
+    """DomDecHalfStep_SparseY with the data of the cell taken from the static data of the worker,
+    as in DomDecIteration_SparseY_Static."""
+    result=DomDecIteration_SparseY_Static(SolveOnCell,SinkhornError,SinkhornErrorRel,eps,staticKey,\
+            i,alphaCell,muYAtomicListData,muYAtomicListIndices)
+    return FinishHalfStep(result,atomicCellMassesSub,truncationThresh)
+
+
+def FinishHalfStep(result,atomicCellMassesSub,truncationThresh):
+    """Balances and truncates the atomic marginals in the result of DomDecIteration_SparseY."""
+    resultAlpha,resultBeta,resultMuYAtomicDataList,muYCellIndices=result
+    msg,resultMuYAtomicDataList=DomDec.BalanceMeasuresMulti(resultMuYAtomicDataList,atomicCellMassesSub)
+    truncated=[Common.truncateSparseVector(data,muYCellIndices,truncationThresh) for data in resultMuYAtomicDataList]
+    return (resultAlpha,resultBeta,muYCellIndices,msg,[d for d,_ in truncated],[ind for _,ind in truncated])
+
 
 def ParallelIterate(comm,\
         muY,posY,eps,\
@@ -14,10 +117,62 @@ def ParallelIterate(comm,\
         muYAtomicDataList,muYAtomicIndicesList,\
         muXList,posXList,alphaList,betaDataList,betaIndexList,\
         SinkhornSubSolver="LogSinkhorn", SinkhornError=1E-4, SinkhornErrorRel=False,\
-        MPIchunksize=1, MPIprobetime=None):
-
+        MPIchunksize=1, MPIprobetime=None, MPItransport="buffer", MPIprefetch=1, MPIscheduler=None, MPIstaticKey=None):
+    """One half-iteration on the MPI workers, see DomDec.Iterate.
+    If a LocalityScheduler is given as MPIscheduler, cells are assigned statically to the workers by the scheduler,
+    and the measured times are passed back to it for balancing the next call.
+    If MPIstaticKey is given, muY, posY, muXList, posXList and partitionDataCompCellIndices are registered on the
+    workers under this key on the first call (see ParallelMap.SetStaticData) and jobs only carry the cell number,
+    alpha and the atomic marginals. Use one key per layer and partition and evict them with
+    ParallelMap.ClearStaticData when the layer changes."""
+    MapCells(comm,muY,posY,eps,\
+            partitionDataCompCells,partitionDataCompCellIndices,\
+            muYAtomicDataList,muYAtomicIndicesList,\
+            muXList,posXList,alphaList,betaDataList,betaIndexList,\
+            SinkhornSubSolver,SinkhornError,SinkhornErrorRel,\
+            MPIchunksize,MPIprobetime,MPItransport,MPIprefetch,MPIscheduler,MPIstaticKey)
+
+
+def ParallelHalfStep(comm,\
+        muY,posY,eps,\
+        partitionDataCompCells,partitionDataCompCellIndices,\
+        muYAtomicDataList,muYAtomicIndicesList,\
+        muXList,posXList,alphaList,betaDataList,betaIndexList,\
+        atomicCellMasses,truncationThresh=1E-15,\
+        SinkhornSubSolver="LogSinkhorn", SinkhornError=1E-4, SinkhornErrorRel=False, verbose=False,\
+        MPIchunksize=1, MPIprobetime=None, MPItransport="buffer", MPIprefetch=1, MPIscheduler=None, MPIstaticKey=None):
+    """ParallelIterate, ParallelBalanceMeasures and ParallelTruncateMeasures in one round of communication:
+    each worker job solves a composite cell, balances its atomic marginals against atomicCellMasses and truncates them
+    below truncationThresh, so only the final sparse marginals are sent back. Arguments as in ParallelIterate."""
+    MapCells(comm,muY,posY,eps,\
+            partitionDataCompCells,partitionDataCompCellIndices,\
+            muYAtomicDataList,muYAtomicIndicesList,\
+            muXList,posXList,alphaList,betaDataList,betaIndexList,\
+            SinkhornSubSolver,SinkhornError,SinkhornErrorRel,\
+            MPIchunksize,MPIprobetime,MPItransport,MPIprefetch,MPIscheduler,MPIstaticKey,\
+            atomicCellMasses=atomicCellMasses,truncationThresh=truncationThresh,verbose=verbose)
+
+
+def MapCells(comm,muY,posY,eps,\
+        partitionDataCompCells,partitionDataCompCellIndices,\
+        muYAtomicDataList,muYAtomicIndicesList,\
+        muXList,posXList,alphaList,betaDataList,betaIndexList,\
+        SinkhornSubSolver,SinkhornError,SinkhornErrorRel,\
+        MPIchunksize,MPIprobetime,MPItransport,MPIprefetch,MPIscheduler,MPIstaticKey,\
+        atomicCellMasses=None,truncationThresh=None,verbose=False):
+    """Common implementation of ParallelIterate and, if atomicCellMasses is given, ParallelHalfStep."""
 
+    partitionDataCompCells,partitionDataCompCellIndices=DomDec.GetCompCellData(partitionDataCompCells,partitionDataCompCellIndices)
     nCells=len(muXList)
+    halfStep=(atomicCellMasses is not None)
+    if MPIscheduler is not None:
+        cellOfJob=MPIscheduler.order
+        workerBounds=MPIscheduler.workerBounds
+        costs=np.zeros(nCells)
+    else:
+        cellOfJob=np.arange(nCells)
+        workerBounds=None
+        costs=None
 
     if SinkhornSubSolver=="LogSinkhorn":
     	SolveOnCell=DomDec.SolveOnCell_LogSinkhorn
@@ -26,29 +181,101 @@ def ParallelIterate(comm,\
     else:
         SolveOnCell=SinkhornSubSolver
 
-    argsGlobal=[SolveOnCell,SinkhornError,SinkhornErrorRel,muY,posY,eps]
-
-    def argList(i):
-        return \
-            [muXList[i],posXList[i],alphaList[i],\
-            [muYAtomicDataList[j] for j in partitionDataCompCells[i]],\
-            [muYAtomicIndicesList[j] for j in partitionDataCompCells[i]],\
-            partitionDataCompCellIndices[i]\
-            ]
-
-    def callReturn(i,dat):
-        # dat=(resultAlpha,resultMuYAtomicDataList,resultMuYAtomicIndicesList)
+    if MPIstaticKey is not None:
+        if not ParallelMap.HasStaticData(MPIstaticKey):
+            ParallelMap.SetStaticData(comm,MPIstaticKey,\
+                    GetStaticCellData(muY,posY,muXList,posXList,partitionDataCompCellIndices))
+        argsGlobal=[SolveOnCell,SinkhornError,SinkhornErrorRel,eps,MPIstaticKey]
+        func=DomDecIteration_SparseY_Static
+        if halfStep:
+            func=DomDecHalfStep_SparseY_Static
+            argsGlobal.append(truncationThresh)
+    else:
+        argsGlobal=[SolveOnCell,SinkhornError,SinkhornErrorRel,muY,posY,eps]
+        func=DomDec.DomDecIteration_SparseY
+        if halfStep:
+            func=DomDecHalfStep_SparseY
+            argsGlobal.append(truncationThresh)
+
+    if isinstance(muYAtomicDataList,DomDec.AtomicMarginalStore):
+        store=muYAtomicDataList
+        getAtomicData=store.getData
+        getAtomicIndices=store.getIndices
+        # old marginals are still needed for sending the remaining jobs, write back after the map
+        newCells=[None]*nCells
+        newData=[None]*nCells
+        newIndices=[None]*nCells
+    else:
+        store=None
+        getAtomicData=muYAtomicDataList.__getitem__
+        getAtomicIndices=muYAtomicIndicesList.__getitem__
+
+    def argList(job):
+        i=cellOfJob[job]
+        if MPIstaticKey is not None:
+            args=[int(i),alphaList[i],\
+                [getAtomicData(j) for j in partitionDataCompCells[i]],\
+                [getAtomicIndices(j) for j in partitionDataCompCells[i]]\
+                ]
+        else:
+            args=[muXList[i],posXList[i],alphaList[i],\
+                [getAtomicData(j) for j in partitionDataCompCells[i]],\
+                [getAtomicIndices(j) for j in partitionDataCompCells[i]],\
+                partitionDataCompCellIndices[i]\
+                ]
+        if halfStep:
+            args.append(atomicCellMasses[partitionDataCompCells[i]])
+        return args
+
+    def callReturn(job,dat):
+        # ParallelIterate: dat=(resultAlpha,resultBeta,resultMuYAtomicDataList,muYCellIndices)
+        # ParallelHalfStep: dat=(resultAlpha,resultBeta,muYCellIndices,msg,resultMuYAtomicDataList,resultMuYAtomicIndicesList)
+        i=cellOfJob[job]
         alphaList[i]=dat[0]
         betaDataList[i]=dat[1]
+        if halfStep:
+            betaIndexList[i]=dat[2]
+            if (dat[3]!=0) and (verbose):
+                print("warning: failed to balance measures in cell {:d}".format(i))
+            if store is not None:
+                newCells[i]=partitionDataCompCells[i]
+                newData[i]=dat[4]
+                newIndices[i]=dat[5]
+                return
+            for jsub,j in enumerate(partitionDataCompCells[i]):
+                muYAtomicDataList[j]=dat[4][jsub]
+                muYAtomicIndicesList[j]=dat[5][jsub]
+            return
+
         betaIndexList[i]=dat[3].copy()
+        if store is not None:
+            newCells[i]=partitionDataCompCells[i]
+            newData[i]=dat[2]
+            newIndices[i]=dat[3]
+            return
         for jsub,j in enumerate(partitionDataCompCells[i]):
             muYAtomicDataList[j]=dat[2][jsub]
             muYAtomicIndicesList[j]=dat[3].copy()
         
 
-    ParallelMap.ParallelMap(comm,DomDec.DomDecIteration_SparseY,argList,argsGlobal,\
+    ParallelMap.ParallelMap(comm,func,argList,argsGlobal,\
             callableArgList=True, callableArgListLen=nCells, callableReturn=callReturn,\
-            chunksize=MPIchunksize, probetime=MPIprobetime)
+            chunksize=MPIchunksize, probetime=MPIprobetime, transport=MPItransport, prefetch=MPIprefetch,\
+            workerBounds=workerBounds, costs=costs)
+
+    if (store is not None) and (nCells>0):
+        if halfStep:
+            # the truncated marginals no longer share their support
+            store.setCells(np.concatenate([np.asarray(c,dtype=np.int64) for c in newCells]),\
+                    np.array([d.shape[0] for data in newData for d in data],dtype=np.int64),\
+                    np.concatenate([d for data in newData for d in data]),\
+                    np.concatenate([ind for indices in newIndices for ind in indices]))
+        else:
+            store.replaceCells(newCells,newData,newIndices)
+    if MPIscheduler is not None:
+        costsCells=np.empty(nCells)
+        costsCells[cellOfJob]=costs
+        MPIscheduler.setCosts(costsCells)
 
 
 
@@ -60,17 +287,34 @@ def ParallelIterate(comm,\
 def ParallelBalanceMeasures(comm,\
         muYAtomicDataList,atomicCellMasses,partitionDataCompCells,\
         verbose=False,\
-        MPIchunksize=1, MPIprobetime=None):
+        MPIchunksize=1, MPIprobetime=None, MPItransport="buffer", MPIscheduler=None):
+    """Balancing of the atomic marginals within each composite cell on the MPI workers, see DomDec.BalanceMeasuresMulti.
+    With a LocalityScheduler as MPIscheduler each cell goes to the same worker as in the last ParallelIterate."""
+
+    if isinstance(muYAtomicDataList,DomDec.AtomicMarginalStore):
+        # balancing is linear in the size of the packed arrays, cheaper than any communication
+        DomDec.BalanceMeasuresMultiAll(muYAtomicDataList,atomicCellMasses,partitionDataCompCells,verbose=verbose)
+        return
+
+    partitionDataCompCells,_=DomDec.GetCompCellData(partitionDataCompCells)
+    if MPIscheduler is not None:
+        cellOfJob=MPIscheduler.order
+        workerBounds=MPIscheduler.workerBounds
+    else:
+        cellOfJob=np.arange(len(partitionDataCompCells))
+        workerBounds=None
 
-    def argList(i):
+    def argList(job):
+        i=cellOfJob[job]
         return \
             [
                     [muYAtomicDataList[j] for j in partitionDataCompCells[i]],
                     atomicCellMasses[partitionDataCompCells[i]]
             ]
 
-    def callReturn(i,dat):
+    def callReturn(job,dat):
         # dat=(msg,muYAtomicData)
+        i=cellOfJob[job]
         for jsub,j in enumerate(partitionDataCompCells[i]):
             muYAtomicDataList[j]=dat[1][jsub]
         if (dat[0]!=0) and (verbose):
@@ -78,7 +322,7 @@ def ParallelBalanceMeasures(comm,\
 
     ParallelMap.ParallelMap(comm,DomDec.BalanceMeasuresMulti,argList,\
             callableArgList=True, callableArgListLen=len(partitionDataCompCells), callableReturn=callReturn,\
-            chunksize=MPIchunksize, probetime=MPIprobetime)
+            chunksize=MPIchunksize, probetime=MPIprobetime, transport=MPItransport, workerBounds=workerBounds)
 
 
 
@@ -88,6 +332,11 @@ def ParallelBalanceMeasures(comm,\
 # measure truncation
 def ParallelTruncateMeasures(comm,muYAtomicDataList,muYAtomicIndicesList,thresh,\
         MPIchunksize=1, MPIprobetime=None):
+
+    if isinstance(muYAtomicDataList,DomDec.AtomicMarginalStore):
+        # bulk truncation of the packed arrays is cheaper than any communication
+        muYAtomicDataList.truncate(thresh)
+        return
     
     def argList(i):
         return [muYAtomicDataList[i],muYAtomicIndicesList[i],thresh]
@@ -110,44 +359,217 @@ def GetRefinedAtomicYMarginals_SparseY(comm,muYL,muYLOld,parentsYL,\
         atomicCellMasses,atomicCellMassesOld,\
         atomicCells,atomicCellsOld,\
         muYAtomicDataListOld,muYAtomicIndicesListOld,\
-        metaCellShape,thresh=1E-15,\
+        metaCellShape,\
         MPIchunksize=1, MPIprobetime=None):
 
-    yresOld=muYLOld.shape[0]
-    yres=muYL.shape[0]
-    
-    # list of children of each coarse node
-    childrenYLOld=[[] for i in range(yresOld)]
-    for i,parent in enumerate(parentsYL):
-        childrenYLOld[parent].append(i)
-
-    # old atomic cells are 2x2 clustering of new atomic cells
-    newCellChildren=DomDec.GetPartitionIndices2D(metaCellShape,2,0)
-    # for each new atomic cell compute the old parent atomic cell
-    atomicCellParents=np.zeros((np.prod(metaCellShape),),dtype=np.int32)
-    for i,children in enumerate(newCellChildren):
-        atomicCellParents[children]=i
+    # the refinement is vectorized over all atomic cells, which is cheaper than sending the cells to the workers
+    return DomDec.GetRefinedAtomicYMarginals_SparseY(muYL,muYLOld,parentsYL,\
+            atomicCellMasses,atomicCellMassesOld,\
+            atomicCells,atomicCellsOld,\
+            muYAtomicDataListOld,muYAtomicIndicesListOld,\
+            metaCellShape)
 
-        
-    def argList(i):
-        return [muYAtomicDataListOld[i],muYAtomicIndicesListOld[i]]
-
-
-    resultData=[None for i in range(len(atomicCells))]
-    resultIndices=[None for i in range(len(atomicCells))]
-
-    def callReturn(i,dat):
-        # dat=(dataFine,indicesFine)
-        for j in newCellChildren[i]:
-            resultData[j]=dat[0]*atomicCellMasses[j]/atomicCellMassesOld[i]
-            resultIndices[j]=dat[1].copy()
-
-    ParallelMap.ParallelMap(comm,DomDec.refineMuYAtomicOld,argList,\
-    		[muYL,muYLOld,childrenYLOld],\
-    		callableArgList=True, callableArgListLen=len(atomicCellsOld),callableReturn=callReturn,\
-    		chunksize=MPIchunksize, probetime=MPIprobetime)
-
-    
-    return [resultData,resultIndices]
 
 
+###############################################################################################################################
+# distributed mode
+# all ranks run the same script and each rank permanently owns a block of atomic cells. the atomic marginals, duals and
+# X-data of a composite cell only live on the rank that works on it. between half-steps only the marginals of atomic cells
+# at the block boundaries are exchanged with the neighbouring ranks, root only takes part in reductions.
+
+# tags for ExchangeAtomicMarginals
+TAG_EXCHANGE_LENGTHS=1
+TAG_EXCHANGE_DATA=2
+TAG_EXCHANGE_INDICES=3
+
+
+def GetBlockOwnership(atomicShape,nRanks):
+    """Splits the grid of atomic cells into nRanks slabs along the first axis and returns the owning rank of each atomic cell.
+    Slab boundaries are placed at even rows, so each composite cell of the A partition lies on a single rank.
+    Some ranks own no cells if there are fewer pairs of rows than ranks."""
+    nPairs=(atomicShape[0]+1)//2
+    rowOwner=((np.arange(atomicShape[0])//2)*nRanks)//nPairs
+    return np.repeat(rowOwner,int(np.prod(atomicShape[1:]))).astype(np.int64)
+
+
+def GroupByRank(cells,ranks):
+    """Splits cells into a dict rank->cells according to the partner rank of each cell. Cells keep their order."""
+    return {int(r):cells[ranks==r] for r in np.unique(ranks)}
+
+
+def ExchangeAtomicMarginals(comm,store,sendCells,recvCells):
+    """Point to point exchange of atomic marginals between ranks, in place.
+    sendCells[r] are the cells of store that are moved to rank r, recvCells[r] the cells that arrive from rank r,
+    in the same order as on the sending rank. Sent cells are emptied in store, received cells are inserted.
+    Only raw buffers are communicated: the lengths of the cells first, then their data and indices."""
+    requests=[]
+    sendBuffers=[]
+    for r,cells in sendCells.items():
+        lengths,data,indices=store.getCells(cells)
+        sendBuffers.append((lengths,data,indices))
+        requests.append(comm.Isend([lengths,MPI.INT64_T],dest=r,tag=TAG_EXCHANGE_LENGTHS))
+        requests.append(comm.Isend([data,MPI.DOUBLE],dest=r,tag=TAG_EXCHANGE_DATA))
+        requests.append(comm.Isend([indices,MPI.INT32_T],dest=r,tag=TAG_EXCHANGE_INDICES))
+
+    recvRanks=list(recvCells.keys())
+    recvLengths=[np.empty(len(recvCells[r]),dtype=np.int64) for r in recvRanks]
+    MPI.Request.Waitall([comm.Irecv([lengths,MPI.INT64_T],source=r,tag=TAG_EXCHANGE_LENGTHS)\
+            for r,lengths in zip(recvRanks,recvLengths)])
+    recvData=[np.empty(np.sum(lengths),dtype=np.double) for lengths in recvLengths]
+    recvIndices=[np.empty(np.sum(lengths),dtype=np.int32) for lengths in recvLengths]
+    for r,data,indices in zip(recvRanks,recvData,recvIndices):
+        requests.append(comm.Irecv([data,MPI.DOUBLE],source=r,tag=TAG_EXCHANGE_DATA))
+        requests.append(comm.Irecv([indices,MPI.INT32_T],source=r,tag=TAG_EXCHANGE_INDICES))
+    MPI.Request.Waitall(requests)
+
+    sent=[cells for cells in sendCells.values()]
+    received=[recvCells[r] for r in recvRanks]
+    if len(sent)+len(received)==0:
+        return
+    cells=np.concatenate(sent+received).astype(np.int64)
+    lengths=np.concatenate([np.zeros(len(c),dtype=np.int64) for c in sent]+recvLengths)
+    store.setCells(cells,lengths,\
+            np.concatenate([np.zeros(0)]+recvData),np.concatenate([np.zeros(0,dtype=np.int32)]+recvIndices))
+
+
+class DistributedDomDec:
+    """State of one rank in the distributed mode, on one layer.
+
+    The atomic cells are split into blocks by atomicOwner (by default GetBlockOwnership). For each of the two partitions
+    (k=0: A, k=1: B) a composite cell is worked on by the owner of its first atomic cell. So all A cells are local
+    and the B cells at the block boundaries import the marginals of some atomic cells from the neighbouring rank.
+    The marginals are kept in an AtomicMarginalStore over all atomic cells of the layer in which only the cells held by
+    this rank are non-empty. Per composite cell data is kept in lists over the local composite cells self.cells[k],
+    e.g. self.alphaList[k][i] is the dual of composite cell self.cells[k][i]."""
+
+    def __init__(self,comm,shapeXL,cellSize,muXL,posXL,muYL,posYL,atomicOwner=None):
+        self.comm=comm
+        self.rank=comm.Get_rank()
+        self.shapeXL=list(shapeXL)
+        self.cellSize=cellSize
+        self.muXL=muXL
+        self.muYL=muYL
+        self.posYL=posYL
+        self.partitions=[DomDec.GetGridPartition(shapeXL,cellSize,0),DomDec.GetGridPartition(shapeXL,cellSize,1)]
+        self.metaCellShape=list(self.partitions[0].atomicShape)
+        if atomicOwner is None:
+            atomicOwner=GetBlockOwnership(self.metaCellShape,comm.Get_size())
+        self.atomicOwner=atomicOwner
+        self.atomicCellMasses=self.partitions[0].getAtomicCellMasses(muXL)
+        self.ownedCells=np.nonzero(atomicOwner==self.rank)[0]
+        self.store=None
+
+        self.cells=[]
+        self.compCells=[]
+        self.compCellIndices=[]
+        self.muXList=[]
+        self.posXList=[]
+        self.alphaList=[]
+        self.betaDataList=[]
+        self.betaIndexList=[]
+        self.imports=[]
+        self.exports=[]
+        for partition in self.partitions:
+            children=partition.children
+            compCellOwner=atomicOwner[children.data[children.indptr[:-1]]]
+            cells=np.nonzero(compCellOwner==self.rank)[0]
+            self.cells.append(cells)
+            self.compCells.append([children[i] for i in cells])
+            self.compCellIndices.append([partition.childRanges[i] for i in cells])
+            self.muXList.append([muXL[partition.cells[i]] for i in cells])
+            self.posXList.append([posXL[partition.cells[i]] for i in cells])
+            self.betaDataList.append([None for i in cells])
+            self.betaIndexList.append([None for i in cells])
+            # rank that works on each atomic cell during this half-step
+            holder=compCellOwner[partition.atomicParents]
+            imported=np.nonzero((holder==self.rank)&(atomicOwner!=self.rank))[0]
+            exported=np.nonzero((atomicOwner==self.rank)&(holder!=self.rank))[0]
+            self.imports.append(GroupByRank(imported,atomicOwner[imported]))
+            self.exports.append(GroupByRank(exported,holder[exported]))
+
+    def setAlpha(self,alphaField=None):
+        """Initializes the duals on the local composite cells from a field on the whole X-grid, or with zeros."""
+        self.alphaList=[]
+        for k,partition in enumerate(self.partitions):
+            if alphaField is None:
+                self.alphaList.append([np.zeros_like(muX) for muX in self.muXList[k]])
+            else:
+                self.alphaList.append([alphaField[partition.cells[i]] for i in self.cells[k]])
+
+    def initialize(self):
+        """Product initialization of the owned atomic marginals, on the coarsest layer."""
+        self.store=DomDec.AtomicMarginalStore.fromProduct(self.muYL,self.atomicCellMasses,cells=self.ownedCells)
+        self.setAlpha()
+
+    def refine(self,previous,parentsYL,alphaField=None):
+        """Refines the atomic marginals held by the previous layer previous (a DistributedDomDec) and moves
+        them to their owners on this layer. alphaField can provide initial duals on the whole X-grid."""
+        self.store=DomDec.GetRefinedAtomicYMarginals_SparseY(self.muYL,previous.muYL,parentsYL,\
+                self.atomicCellMasses,previous.atomicCellMasses,\
+                None,None,\
+                previous.store,None,\
+                self.metaCellShape)
+        # the refined marginals are held by the owners of the parent cells
+        source=previous.atomicOwner[DomDec.GetAtomicCellParents(self.metaCellShape)]
+        sent=np.nonzero((source==self.rank)&(self.atomicOwner!=self.rank))[0]
+        received=np.nonzero((source!=self.rank)&(self.atomicOwner==self.rank))[0]
+        ExchangeAtomicMarginals(self.comm,self.store,\
+                GroupByRank(sent,self.atomicOwner[sent]),GroupByRank(received,source[received]))
+        self.setAlpha(alphaField)
+
+    def iterate(self,k,eps,SinkhornSubSolver="LogSinkhorn",SinkhornError=1E-4,SinkhornErrorRel=False,\
+            truncationThresh=1E-15,verbose=False):
+        """Half-step on partition k (0: A, 1: B): import boundary marginals, iterate, balance and truncate the local
+        composite cells, return the boundary marginals to their owners."""
+        ExchangeAtomicMarginals(self.comm,self.store,self.exports[k],self.imports[k])
+        DomDec.Iterate(self.muYL,self.posYL,eps,\
+                self.compCells[k],self.compCellIndices[k],\
+                self.store,None,\
+                self.muXList[k],self.posXList[k],self.alphaList[k],self.betaDataList[k],self.betaIndexList[k],\
+                SinkhornSubSolver=SinkhornSubSolver,SinkhornError=SinkhornError,SinkhornErrorRel=SinkhornErrorRel)
+        DomDec.BalanceMeasuresMultiAll(self.store,self.atomicCellMasses,self.compCells[k],verbose=verbose)
+        self.store.truncate(truncationThresh)
+        ExchangeAtomicMarginals(self.comm,self.store,self.imports[k],self.exports[k])
+
+    def getNnz(self,root=0):
+        """Total number of stored entries of the atomic marginals, on rank root."""
+        return self.comm.reduce(self.store.nnz,root=root)
+
+    def gatherCellLists(self,k,values,root=None):
+        """Collects per composite cell values on the local cells of partition k (e.g. self.alphaList[k]) into one list
+        over all composite cells, on rank root or on all ranks if root is None."""
+        if root is None:
+            parts=self.comm.allgather((self.cells[k],values))
+        else:
+            parts=self.comm.gather((self.cells[k],values),root=root)
+            if parts is None:
+                return None
+        result=[None for i in range(len(self.partitions[k]))]
+        for cells,vals in parts:
+            for i,v in zip(cells,vals):
+                result[i]=v
+        return result
+
+    def getAlphaFieldEven(self):
+        """Glued dual field on the whole X-grid, as DomDec.getAlphaFieldEven. Available on all ranks."""
+        alphaAList=self.gatherCellLists(0,self.alphaList[0])
+        alphaBList=self.gatherCellLists(1,self.alphaList[1])
+        return DomDec.getAlphaFieldEven(alphaAList,alphaBList,\
+                self.partitions[0].cells,self.partitions[1].cells,self.shapeXL,self.metaCellShape,self.cellSize,self.muXL)
+
+    def getPrimalInfos(self,eps,k=0,root=0):
+        """DomDec.getPrimalInfos for partition k, summed over all ranks on rank root (None on the other ranks)."""
+        infos,muYList=DomDec.getPrimalInfos(self.muYL,self.posYL,self.posXList[k],self.muXList[k],\
+                self.alphaList[k],self.betaDataList[k],self.betaIndexList[k],eps,getMuYList=True)
+        margY=np.zeros_like(self.muYL)
+        for muYCell,indices in zip(muYList,self.betaIndexList[k]):
+            margY[indices]+=muYCell
+        margYTotal=np.zeros_like(margY) if self.rank==root else None
+        self.comm.Reduce(margY,margYTotal,op=MPI.SUM,root=root)
+        keys=["scorePrimal","scorePrimalUnreg","errorMargX"]
+        values=self.comm.reduce(np.array([infos[key] for key in keys]),op=MPI.SUM,root=root)
+        if self.rank!=root:
+            return None
+        result={key:float(v) for key,v in zip(keys,values)}
+        result["errorMargY"]=np.sum(np.abs(self.muYL-margYTotal))
+        return result
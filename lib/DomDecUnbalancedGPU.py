@@ -67,7 +67,7 @@ def MiniBatchIterateUnbalanced(
     muY_basic_box, shapeY, partition, current_basic_score, 
     SinkhornError=1E-4, SinkhornErrorRel=True, SinkhornMaxIter=None,
     SinkhornInnerIter=100,
-    N_clusters="smart", safeguard_threshold = 0.005, **kwargs
+    N_clusters="smart", safeguard_threshold = 0.005, tracker = None, **kwargs
 ):
     """
     Perform a domain decomposition iteration on the composite cells given by 
@@ -80,6 +80,11 @@ def MiniBatchIterateUnbalanced(
     this parameter is smaller than `np.inf`). `N_clusters` controls the number
     of clusters; it can also be set to "smart"; which adapts it to the 
     resolution.
+
+    The global Y marginal and the scores for the safeguard are kept in a 
+    YMarginalTracker, updated only for the basic cells of each batch. To not 
+    recompute them on every call, pass the `tracker` of the previous call 
+    (returned in `info["tracker"]`); then `current_basic_score` is ignored.
     """
 
     torch_options = muY_basic_box.options
@@ -115,8 +120,17 @@ def MiniBatchIterateUnbalanced(
     time_clustering = time.perf_counter() - t0
     N_batches = len(batches)  # If some cluster was empty it was removed
 
-    # # Compute current global Y marginal
-    PYpi = get_current_Y_marginal(muY_basic_box, shapeY)
+    # Current global Y marginal and scores
+    t0 = time.perf_counter()
+    if tracker is None:
+        transport_score, margX_score, _ = current_basic_score
+        tracker = YMarginalTracker(
+            muY_basic_box, shapeY, muY, lam,
+            dict(transport=transport_score.clone(), 
+                 margX=margX_score.clone()))
+    else:
+        tracker.maybe_resync(muY_basic_box)
+    time_PYpi = time.perf_counter() - t0
 
     # Save PXpi
     PXpiJ = torch.zeros_like(alphaJ)
@@ -126,23 +140,15 @@ def MiniBatchIterateUnbalanced(
     batch_muY_basic_list = []
     info = None
     dims_batch = np.zeros((N_batches, 2), dtype=np.int64)
-    time_PYpi = 0.0
     time_check_scores = 0.0
     print("batch\ttotal\ttrans\tmargX\tmargY")
     for i,batch in enumerate(batches):
         indices = partition[batch].ravel()
-        # Count time towads 
         # Remove minus ones
-        t0 = time.perf_counter()
         indices = indices[indices >= 0]
         data_batch = muY_basic_box.data[indices]
         offsets_batch = muY_basic_box.offsets[indices]
         muY_basic_batch = BoundingBox(data_batch, offsets_batch, shapeY)
-        PYpi_batch = get_current_Y_marginal(muY_basic_batch, shapeY,
-                                                  batchshape=batches_shape)
-        
-        time_PYpi += time.perf_counter() - t0
-        # PYpi_batches.append(batch_Y_marginal)
     
         #axs[0].axis("off")
 
@@ -151,7 +157,7 @@ def MiniBatchIterateUnbalanced(
         posXJ_batch = tuple(xi[batch] for xi in posXJ)
         alpha_batch, basic_idx_batch, new_muY_basic_batch, info_batch, batch_basic_score = \
             MiniBatchDomDecIterationUnbalanced_CUDA(
-                SinkhornError, SinkhornErrorRel, muY, PYpi, posY, 
+                SinkhornError, SinkhornErrorRel, muY, tracker.PYpi, posY, 
                 dxs_dys, eps, lam, shapeY,
                 muXJ[batch], posXJ_batch, alphaJ[batch],
                 muY_basic_box, partition[batch],
@@ -175,34 +181,27 @@ def MiniBatchIterateUnbalanced(
             info["Niter"].append(info_batch["Niter"])
         ##############################################
         
-        # Update PYpi
-
+        # Change of PYpi, only at the support of the cells of the batch
         t0 = time.perf_counter()
-        new_PYpi_batch = get_current_Y_marginal(new_muY_basic_batch, shapeY,
-                                                  batchshape=batches_shape)
-        dPYpi = (new_PYpi_batch - PYpi_batch).contiguous()
+        dPYpi = tracker.get_delta(muY_basic_batch, new_muY_basic_batch)
         time_PYpi += time.perf_counter() - t0
 
         # Compare current with previous score
         t0 = time.perf_counter()
-        transport_score, margX_score, margY_score = current_basic_score
-        old_score = transport_score.sum() + margX_score.sum() + margY_score
-        new_transport_score = transport_score.clone()
-        new_margX_score = margX_score.clone()
+        old_score = sum(tracker.get_score_terms().values())
         batch_transport_score, batch_margX_score = batch_basic_score
-        # 1. Transport score
-        new_transport_score[basic_idx_batch] = batch_transport_score
-        # 2. Marginal penalty
-        new_margX_score[basic_idx_batch] = batch_margX_score
-        new_margY_score = lam*LogSinkhornGPU.KL(PYpi + dPYpi, muY)
-        new_score = new_transport_score.sum() + new_margX_score.sum() + new_margY_score
+        batch_scores = dict(transport=batch_transport_score,
+                            margX=batch_margX_score)
+        new_terms = tracker.get_score_terms(dPYpi, basic_idx_batch,
+                                            batch_scores)
+        new_score = sum(new_terms.values())
 
         # print("old, new scores", old_score.round(decimals = 1).item(), new_score.round(decimals = 1).item())
         print(i,
               new_score.round(decimals = 1).item(), 
-              new_transport_score.sum().round(decimals = 1).item(), 
-              new_margX_score.sum().round(decimals = 1).item(),
-              new_margY_score.round(decimals = 1).item(),
+              new_terms["transport"].round(decimals = 1).item(), 
+              new_terms["margX"].round(decimals = 1).item(),
+              new_terms["margY"].round(decimals = 1).item(),
               sep = "\t")
         if new_score > (1 + safeguard_threshold*max(1,lam))*old_score:
             # Need to average with previous
@@ -210,14 +209,13 @@ def MiniBatchIterateUnbalanced(
             theta = 0.25
             new_muY_basic_batch = bounding_box_interpolation(
                 muY_basic_batch, new_muY_basic_batch, theta)
-            dPYpi *= theta
             print(f"batch {i} set to safe")
+            # Update PYpi  
+            tracker.update(dPYpi, theta)
         else: 
-            current_basic_score = new_transport_score, new_margX_score, new_margY_score
+            tracker.update(dPYpi, 1.0, basic_idx_batch, batch_scores)
 
         time_check_scores += time.perf_counter() - t0
-        # Update PYpi  
-        PYpi += dPYpi
 
         # Slide marginals to corner to get the smallest bbox later
         t0 = time.perf_counter()
@@ -251,7 +249,11 @@ def MiniBatchIterateUnbalanced(
     
     # Save PXpi in info
     info["PXpiB"] = PXpiJ
+    info["tracker"] = tracker
 
+    current_basic_score = (tracker.basic_scores["transport"],
+                           tracker.basic_scores["margX"], 
+                           tracker.margY_score)
     return alphaJ, muY_basic_box, info, current_basic_score
 
 def MiniBatchDomDecIterationUnbalanced_CUDA(
@@ -407,8 +409,9 @@ def BatchSolveOnCellUnbalanced_CUDA(
 
     return alpha, beta, muY_basic, solver
 
-def compute_primal_score(solvers, muY_basic_box, muY):
+def compute_primal_score(solvers, muY_basic_box, muY, tracker=None):
     # Get primal_score and muX_error
+    # With a YMarginalTracker the marginal penalty is taken from it
     shapeY = muY_basic_box.global_shape
     lam = solvers[0].lam
     primal_score = 0.0
@@ -422,11 +425,15 @@ def compute_primal_score(solvers, muY_basic_box, muY):
         # new_alpha = solverB.get_new_alpha()
         # muX_error += torch.sum(torch.abs(solverB.mu - current_mu))
     # Add global marginal penalty
-    PYpi = get_current_Y_marginal(muY_basic_box, shapeY)
-    primal_score += lam*LogSinkhornGPU.KL(PYpi, muY)
+    if tracker is not None:
+        primal_score += tracker.margY_score
+    else:
+        PYpi = get_current_Y_marginal(muY_basic_box, shapeY)
+        primal_score += lam*LogSinkhornGPU.KL(PYpi, muY)
     return primal_score.item()
 
-def compute_primal_score_components(solvers, muY_basic_box, muY):
+def compute_primal_score_components(solvers, muY_basic_box, muY, 
+                                    tracker=None):
     # Get primal_score and muX_error
     shapeY = muY_basic_box.global_shape
     lam = solvers[0].lam
@@ -442,9 +449,11 @@ def compute_primal_score_components(solvers, muY_basic_box, muY):
         # new_alpha = solverB.get_new_alpha()
         # muX_error += torch.sum(torch.abs(solverB.mu - current_mu))
     # Add global marginal penalty
-    PYpi = get_current_Y_marginal(muY_basic_box, shapeY)
-    
-    margY_score = lam*LogSinkhornGPU.KL(PYpi, muY)
+    if tracker is not None:
+        margY_score = tracker.margY_score
+    else:
+        PYpi = get_current_Y_marginal(muY_basic_box, shapeY)
+        margY_score = lam*LogSinkhornGPU.KL(PYpi, muY)
     return transport_score.item(), margX_score.item(), margY_score.item()
 
 def bounding_box_interpolation(nu1, nu2, theta):
@@ -1,4 +1,7 @@
 from tkinter import N # TODO: what is this for?
+import concurrent.futures
+import functools
+import weakref
 import numpy as np
 import scipy
 np.set_printoptions(threshold=10000)
@@ -85,6 +88,439 @@ def GetPartitionData(atomicCells,metaCells):
         
     return (resultCells,resultChildren,resultChildrenIndices)
 
+
+def GetCompCellData(partitionDataCompCells,partitionDataCompCellIndices=None):
+    """Returns the pair (partitionDataCompCells,partitionDataCompCellIndices) expected by Iterate.
+    partitionDataCompCells can either be the list of children of each composite cell
+    (then partitionDataCompCellIndices is passed through) or a GridPartition."""
+    if isinstance(partitionDataCompCells,GridPartition):
+        return (partitionDataCompCells.children,partitionDataCompCells.childRanges)
+    return (partitionDataCompCells,partitionDataCompCellIndices)
+
+
+def GetPartitionBounds1D(N,cellSize,offset=0):
+    """Array version of GetPartitionIndices1D. Returns arrays (starts,ends) such that cell i contains the indices
+    starts[i] to ends[i]-1."""
+    nCells=max((N-offset-1)//cellSize+1,0)
+    starts=offset+np.arange(nCells,dtype=np.int64)*cellSize
+    ends=np.minimum(N,starts+cellSize)
+    if offset>0:
+        starts=np.concatenate(([0],starts))
+        ends=np.concatenate(([offset],ends))
+    return (starts,ends)
+
+
+def _getAxisView(a,axis,dim):
+    """Reshapes the 1D array a such that it broadcasts along axis of a dim-dimensional array."""
+    shape=[1]*dim
+    shape[axis]=-1
+    return a.reshape(shape)
+
+
+class PackedArrayList:
+    """List of arrays of varying length, packed into one array data and an array of offsets indptr,
+    such that the i-th entry is data[indptr[i]:indptr[i+1]].
+    Entries are returned as views. Assigning an entry of the same length writes into data,
+    so the object can stand in for the lists of cells, children and duals used by Iterate."""
+
+    def __init__(self,data,indptr):
+        self.data=data
+        self.indptr=indptr
+
+    @classmethod
+    def fromList(cls,arrays):
+        """Packs a list of arrays (with equal trailing shapes). A PackedArrayList is returned unchanged."""
+        if isinstance(arrays,PackedArrayList):
+            return arrays
+        arrays=[np.asarray(a) for a in arrays]
+        indptr=np.zeros(len(arrays)+1,dtype=np.int64)
+        np.cumsum([a.shape[0] for a in arrays],out=indptr[1:])
+        return cls(np.concatenate(arrays),indptr)
+
+    def __len__(self):
+        return self.indptr.shape[0]-1
+
+    def __getitem__(self,i):
+        return self.data[self.indptr[i]:self.indptr[i+1]]
+
+    def __setitem__(self,i,value):
+        self.data[self.indptr[i]:self.indptr[i+1]]=value
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def getLengths(self):
+        return np.diff(self.indptr)
+
+    def copy(self):
+        return PackedArrayList(self.data.copy(),self.indptr.copy())
+
+
+class GridPartition:
+    """Array-native version of GetPartitionIndices2D and GetPartitionData for a grid of shape shape
+    (any dimension). The grid is split into atomic cells of size cellSize^dim, which are joined into
+    composite cells of 2^dim atomic cells, where the composite cells are shifted by offset atomic cells.
+    Everything is computed with stride arithmetic, no per-cell python objects are created.
+
+    Attributes:
+    atomicShape: shape of the grid of atomic cells (the metaCellShape of the drivers)
+    cells: PackedArrayList with the flattened grid indices of each composite cell
+        (same ordering as GetPartitionData(...)[0])
+    children: PackedArrayList with the atomic cells of each composite cell
+        (same as GetPartitionData(...)[1], i.e. partitionDataCompCells)
+    childRanges: PackedArrayList with, for each composite cell, an int32 array of shape (nChildren,2) with the
+        start and end index of each child in the composite cell (i.e. partitionDataCompCellIndices)
+    atomicCells: PackedArrayList with the flattened grid indices of each atomic cell
+        (same as GetPartitionIndices2D(shape,cellSize,0))
+    atomicParents: composite cell of each atomic cell
+    atomicOfPoint: atomic cell of each grid point
+
+    Use GetGridPartition to obtain cached instances. The arrays are marked read-only, since they are shared."""
+
+    def __init__(self,shape,cellSize,offset=0):
+        self.shape=tuple(int(n) for n in shape)
+        self.cellSize=cellSize
+        self.offset=offset
+        dim=len(self.shape)
+
+        # atomic cells along each axis, and composite cells along each axis (in units of atomic cells)
+        atomicBounds=[GetPartitionBounds1D(n,cellSize,0) for n in self.shape]
+        self.atomicShape=tuple(b[0].shape[0] for b in atomicBounds)
+        compBounds=[GetPartitionBounds1D(n,2,offset) for n in self.atomicShape]
+        self.compShape=tuple(b[0].shape[0] for b in compBounds)
+        nAtomic=int(np.prod(self.atomicShape))
+        nComp=int(np.prod(self.compShape))
+
+        # for each atomic cell: size, composite cell, and position within the composite cell (row-major order)
+        atomicSize=np.ones((1,)*dim,dtype=np.int64)
+        atomicParents=np.zeros((1,)*dim,dtype=np.int64)
+        atomicRank=np.zeros((1,)*dim,dtype=np.int64)
+        for k,((aStarts,aEnds),(cStarts,cEnds)) in enumerate(zip(atomicBounds,compBounds)):
+            a=np.arange(self.atomicShape[k])
+            comp=np.searchsorted(cEnds,a,side="right")
+            atomicSize=atomicSize*_getAxisView(aEnds-aStarts,k,dim)
+            atomicParents=atomicParents*self.compShape[k]+_getAxisView(comp,k,dim)
+            atomicRank=atomicRank*_getAxisView((cEnds-cStarts)[comp],k,dim)+_getAxisView(a-cStarts[comp],k,dim)
+        atomicSize=np.broadcast_to(atomicSize,self.atomicShape).ravel()
+        atomicParents=np.broadcast_to(atomicParents,self.atomicShape).ravel()
+        atomicRank=np.broadcast_to(atomicRank,self.atomicShape).ravel()
+
+        # sorting atomic cells by composite cell and rank gives the children lists,
+        # and at the same time the order in which atomic cells are concatenated into the composite cells
+        children=np.argsort(atomicParents*(2**dim)+atomicRank,kind="stable")
+        childIndptr=np.zeros(nComp+1,dtype=np.int64)
+        np.cumsum(np.bincount(atomicParents,minlength=nComp),out=childIndptr[1:])
+        childSize=atomicSize[children]
+        childEnd=np.cumsum(childSize)
+        childStart=childEnd-childSize
+        cellIndptr=np.zeros(nComp+1,dtype=np.int64)
+        cellIndptr[1:]=childEnd[childIndptr[1:]-1]
+        compOfChild=atomicParents[children]
+        childRanges=np.stack((childStart,childEnd),axis=1)-cellIndptr[compOfChild].reshape((-1,1))
+
+        # start of each atomic cell in the concatenated composite cells
+        atomicStart=np.zeros(nAtomic,dtype=np.int64)
+        atomicStart[children]=childStart
+
+        # for each grid point: atomic cell and position within atomic cell (row-major)
+        atomicOfPoint=np.zeros((1,)*dim,dtype=np.int64)
+        pointRank=np.zeros((1,)*dim,dtype=np.int64)
+        for k,(aStarts,aEnds) in enumerate(atomicBounds):
+            x=np.arange(self.shape[k])
+            a=x//cellSize
+            atomicOfPoint=atomicOfPoint*self.atomicShape[k]+_getAxisView(a,k,dim)
+            pointRank=pointRank*_getAxisView((aEnds-aStarts)[a],k,dim)+_getAxisView(x-aStarts[a],k,dim)
+        atomicOfPoint=np.broadcast_to(atomicOfPoint,self.shape).ravel()
+        pointRank=np.broadcast_to(pointRank,self.shape).ravel()
+
+        nPoints=atomicOfPoint.shape[0]
+        cellIndices=np.empty(nPoints,dtype=np.int64)
+        cellIndices[atomicStart[atomicOfPoint]+pointRank]=np.arange(nPoints)
+        atomicIndptr=np.zeros(nAtomic+1,dtype=np.int64)
+        np.cumsum(atomicSize,out=atomicIndptr[1:])
+        atomicCellIndices=np.empty(nPoints,dtype=np.int64)
+        atomicCellIndices[atomicIndptr[atomicOfPoint]+pointRank]=np.arange(nPoints)
+
+        self.cells=PackedArrayList(cellIndices,cellIndptr)
+        self.children=PackedArrayList(children,childIndptr)
+        self.childRanges=PackedArrayList(childRanges.astype(np.int32),childIndptr)
+        self.atomicCells=PackedArrayList(atomicCellIndices,atomicIndptr)
+        self.atomicParents=atomicParents
+        self.atomicOfPoint=atomicOfPoint
+
+        for a in [cellIndices,cellIndptr,children,childIndptr,self.childRanges.data,\
+                atomicCellIndices,atomicIndptr,atomicParents,atomicOfPoint]:
+            a.flags.writeable=False
+
+    def __len__(self):
+        return len(self.children)
+
+    def getChildrenIndices(self):
+        """Array of shape (nAtomic,3) with rows [p,a,b]: parent composite cell and range of the atomic cell in it,
+        as GetPartitionData(...)[2]."""
+        result=np.empty((self.atomicParents.shape[0],3),dtype=np.int64)
+        result[:,0]=self.atomicParents
+        result[self.children.data,1:]=self.childRanges.data
+        return result
+
+    def getAtomicCellMasses(self,muX):
+        """Mass of muX (flattened over the grid) in each atomic cell."""
+        return np.bincount(self.atomicOfPoint,weights=muX,minlength=len(self.atomicCells))
+
+    def gatherCells(self,values):
+        """Restricts values (flattened over the grid, possibly with further trailing axes) to each composite cell.
+        Returns a PackedArrayList, so e.g. gatherCells(muXL) replaces [muXL[cell].copy() for cell in cells]."""
+        return PackedArrayList(values[self.cells.data],self.cells.indptr)
+
+    def toLists(self):
+        """Returns (cells,children,childrenIndices) in the list format of GetPartitionData."""
+        return ([c.tolist() for c in self.cells],[c.tolist() for c in self.children],self.getChildrenIndices().tolist())
+
+
+@functools.lru_cache(maxsize=32)
+def _getGridPartitionCached(shape,cellSize,offset):
+    return GridPartition(shape,cellSize,offset)
+
+def GetGridPartition(shape,cellSize,offset=0):
+    """Cached GridPartition for given shape, cellSize and offset. Partitions are reused across layers and runs,
+    so they must not be modified."""
+    return _getGridPartitionCached(tuple(int(n) for n in shape),int(cellSize),int(offset))
+
+
+def GetMortonCodes(coords):
+    """Morton (Z-order) codes of non-negative integer grid coordinates coords of shape (n,dim), obtained by interleaving
+    the bits of the coordinates. Sorting by the codes orders the points along a space-filling curve,
+    so contiguous ranges of the order are spatially compact."""
+    coords=np.asarray(coords,dtype=np.int64)
+    n,dim=coords.shape
+    nBits=int(np.max(coords,initial=0)).bit_length()
+    if nBits*dim>63:
+        raise ValueError("coordinates too large for 64 bit Morton codes")
+    codes=np.zeros(n,dtype=np.int64)
+    for b in range(nBits):
+        for k in range(dim):
+            codes|=((coords[:,k]>>b)&1)<<(b*dim+(dim-1-k))
+    return codes
+
+##############################################################################################################################
+##############################################################################################################################
+##############################################################################################################################
+##############################################################################################################################
+# packed storage of the atomic Y-marginals
+
+def getSegmentPositions(starts,lengths):
+    """For segments [starts[i],starts[i]+lengths[i]) returns the concatenation of all positions in these segments,
+    i.e. the vectorized version of np.hstack([np.arange(s,s+l) for s,l in zip(starts,lengths)])."""
+    lengths=np.asarray(lengths,dtype=np.int64)
+    total=np.sum(lengths)
+    offsets=np.cumsum(lengths)-lengths
+    return np.repeat(np.asarray(starts,dtype=np.int64)-offsets,lengths)+np.arange(total,dtype=np.int64)
+
+
+class AtomicMarginalStore:
+    """Sparse Y-marginals of all atomic cells, packed into a single data/indices/indptr triple.
+
+    The marginal of atomic cell i has the values data[indptr[i]:indptr[i+1]] at the Y-indices
+    indices[indptr[i]:indptr[i+1]], i.e. the store is a CSR matrix of shape (nCells,yres).
+    getData(i) and getIndices(i) return views into the packed arrays, so they can be modified in place.
+    Cells with a new support are written in bulk via replaceCells, which repacks the arrays in one go.
+    Truncation, rescaling and balancing act on all cells at once.
+
+    The store can be passed instead of the pair muYAtomicDataList,muYAtomicIndicesList to Iterate,
+    BalanceMeasuresMultiAll, GetActualYMarginal and GetRefinedAtomicYMarginals_SparseY."""
+
+    def __init__(self,data,indices,indptr):
+        self.data=np.ascontiguousarray(data,dtype=np.double)
+        self.indices=np.ascontiguousarray(indices,dtype=np.int32)
+        self.indptr=np.ascontiguousarray(indptr,dtype=np.int64)
+        if self.indptr[-1]!=self.data.shape[0] or self.data.shape[0]!=self.indices.shape[0]:
+            raise ValueError("inconsistent sizes of data, indices and indptr")
+
+    @classmethod
+    def fromLists(cls,muYAtomicDataList,muYAtomicIndicesList):
+        """Packs the list representation muYAtomicDataList,muYAtomicIndicesList into a store."""
+        lengths=np.array([d.shape[0] for d in muYAtomicDataList],dtype=np.int64)
+        indptr=np.zeros(lengths.shape[0]+1,dtype=np.int64)
+        np.cumsum(lengths,out=indptr[1:])
+        if indptr[-1]==0:
+            return cls(np.zeros(0),np.zeros(0,dtype=np.int32),indptr)
+        return cls(np.concatenate(muYAtomicDataList),np.concatenate(muYAtomicIndicesList),indptr)
+
+    @classmethod
+    def fromProduct(cls,muY,atomicCellMasses,cells=None):
+        """Store of the product plan: atomic cell i carries muY*atomicCellMasses[i] on the full Y support.
+        If cells is given, only these cells are filled, all others are left empty."""
+        nCells=atomicCellMasses.shape[0]
+        yres=muY.shape[0]
+        if cells is None:
+            cells=np.arange(nCells,dtype=np.int64)
+        lengths=np.zeros(nCells,dtype=np.int64)
+        lengths[cells]=yres
+        indptr=np.zeros(nCells+1,dtype=np.int64)
+        np.cumsum(lengths,out=indptr[1:])
+        data=np.outer(atomicCellMasses[np.sort(cells)],muY).ravel()
+        indices=np.tile(np.arange(yres,dtype=np.int32),len(cells))
+        return cls(data,indices,indptr)
+
+    def toLists(self,copy=True):
+        """Returns the list representation (muYAtomicDataList,muYAtomicIndicesList).
+        With copy=False the list entries are views into the store."""
+        dataList=np.split(self.data,self.indptr[1:-1])
+        indicesList=np.split(self.indices,self.indptr[1:-1])
+        if copy:
+            dataList=[d.copy() for d in dataList]
+            indicesList=[i.copy() for i in indicesList]
+        return (dataList,indicesList)
+
+    def copy(self):
+        return AtomicMarginalStore(self.data.copy(),self.indices.copy(),self.indptr.copy())
+
+    def __len__(self):
+        return self.indptr.shape[0]-1
+
+    @property
+    def nCells(self):
+        return self.indptr.shape[0]-1
+
+    @property
+    def nnz(self):
+        return int(self.indptr[-1])
+
+    def getData(self,i):
+        return self.data[self.indptr[i]:self.indptr[i+1]]
+
+    def getIndices(self,i):
+        return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+    def getCell(self,i):
+        return (self.getData(i),self.getIndices(i))
+
+    def getLengths(self):
+        return np.diff(self.indptr)
+
+    def getCellOfEntry(self):
+        """For each stored entry, the number of the atomic cell it belongs to."""
+        return np.repeat(np.arange(self.nCells,dtype=np.int64),self.getLengths())
+
+    def getMasses(self):
+        """Total mass of each atomic marginal."""
+        return np.bincount(self.getCellOfEntry(),weights=self.data,minlength=self.nCells)
+
+    def getYMarginal(self,yres):
+        """Sum of all atomic marginals as dense array of size yres."""
+        return np.bincount(self.indices,weights=self.data,minlength=yres)
+
+    def _setEntries(self,keep):
+        """Keep only the entries where the boolean mask keep is True."""
+        lengths=np.bincount(self.getCellOfEntry()[keep],minlength=self.nCells)
+        self.data=self.data[keep]
+        self.indices=self.indices[keep]
+        self.indptr=np.zeros_like(self.indptr)
+        np.cumsum(lengths,out=self.indptr[1:])
+
+    def truncate(self,thresh):
+        """Removes all entries below thresh in all cells at once.
+        Same as applying Common.truncateSparseVector to each cell."""
+        self._setEntries(self.data>=thresh)
+        return self
+
+    def rescale(self,factors):
+        """Multiplies the marginal of atomic cell i by factors[i], in place."""
+        self.data*=np.repeat(np.asarray(factors,dtype=np.double),self.getLengths())
+        return self
+
+    def compact(self):
+        """Removes explicitly stored zeros and makes the arrays own their (tightly sized) memory."""
+        self._setEntries(self.data!=0.)
+        return self
+
+    def balance(self,atomicCellMasses,compCells,threshStep=1E-16):
+        """Vectorized version of BalanceMeasuresMulti, applied to all composite cells at once, in place.
+        compCells[g] holds the atomic cells of composite cell g (a list of arrays or a PackedArrayList such as
+        GridPartition.children). The marginals of the atomic cells of one composite cell must share their support,
+        as they do after Iterate.
+        Returns the remaining absolute mass imbalance of each composite cell."""
+        if len(compCells)==0:
+            return np.zeros(0)
+        if isinstance(compCells,PackedArrayList):
+            cells=np.asarray(compCells.data,dtype=np.int64)
+            sizes=compCells.getLengths()
+        else:
+            cells=np.concatenate([np.asarray(c,dtype=np.int64) for c in compCells])
+            sizes=np.array([len(c) for c in compCells],dtype=np.int64)
+        nGroups=sizes.shape[0]
+        groups=np.repeat(np.arange(nGroups,dtype=np.int64),sizes)
+        lengths=self.getLengths()[cells]
+
+        # compare the support of each atomic cell with that of the first atomic cell in its composite cell
+        firstCells=cells[(np.cumsum(sizes)-sizes)[groups]]
+        if np.any(lengths!=self.getLengths()[firstCells]):
+            raise ValueError("atomic marginals of a composite cell must share their support")
+        if np.any(self.indices[getSegmentPositions(self.indptr[cells],lengths)]\
+                !=self.indices[getSegmentPositions(self.indptr[firstCells],lengths)]):
+            raise ValueError("atomic marginals of a composite cell must share their support")
+
+        return BalanceSharedSupport(self.data,self.indptr[cells],lengths,groups,nGroups,\
+                self.getMasses()[cells],np.asarray(atomicCellMasses,dtype=np.double)[cells],threshStep=threshStep)
+
+    def replaceCells(self,cellList,dataList,indicesList):
+        """Replaces the marginals of several groups of cells in one repacking step.
+        cellList[g] is an array of k_g atomic cells, which all obtain the common support indicesList[g]
+        of size m_g. dataList[g] is an array of shape (k_g,m_g) holding their new values.
+        Cells that do not appear in cellList are left unchanged."""
+        if len(cellList)==0:
+            return self
+        cells=np.concatenate([np.asarray(c,dtype=np.int64) for c in cellList])
+        groupSizes=np.array([len(c) for c in cellList],dtype=np.int64)
+        groupLengths=np.array([i.shape[0] for i in indicesList],dtype=np.int64)
+        cellLengths=np.repeat(groupLengths,groupSizes)
+        # all cells of one group share their indices
+        indicesFlat=np.concatenate(indicesList)
+        groupStarts=np.cumsum(groupLengths)-groupLengths
+        return self.setCells(cells,cellLengths,\
+                np.concatenate([np.asarray(d,dtype=np.double).ravel() for d in dataList]),\
+                indicesFlat[getSegmentPositions(np.repeat(groupStarts,groupSizes),cellLengths)])
+
+    def getCells(self,cells):
+        """Packed marginals of the given cells, returns (lengths,data,indices) in the format expected by setCells."""
+        cells=np.asarray(cells,dtype=np.int64)
+        lengths=self.getLengths()[cells]
+        entries=getSegmentPositions(self.indptr[cells],lengths)
+        return (lengths,self.data[entries],self.indices[entries])
+
+    def setCells(self,cells,cellLengths,cellData,cellIndices):
+        """Replaces the marginals of the given cells in one repacking step. Cell cells[i] obtains the next cellLengths[i]
+        entries of cellData and cellIndices. Cells that do not appear in cells are left unchanged."""
+        cells=np.asarray(cells,dtype=np.int64)
+        cellLengths=np.asarray(cellLengths,dtype=np.int64)
+        oldLengths=self.getLengths()
+        lengths=oldLengths.copy()
+        lengths[cells]=cellLengths
+        indptr=np.zeros_like(self.indptr)
+        np.cumsum(lengths,out=indptr[1:])
+        data=np.empty(indptr[-1],dtype=np.double)
+        indices=np.empty(indptr[-1],dtype=np.int32)
+
+        # copy unchanged cells
+        keepCells=np.ones(self.nCells,dtype=bool)
+        keepCells[cells]=False
+        keepCells=np.nonzero(keepCells)[0]
+        src=getSegmentPositions(self.indptr[keepCells],oldLengths[keepCells])
+        dst=getSegmentPositions(indptr[keepCells],oldLengths[keepCells])
+        data[dst]=self.data[src]
+        indices[dst]=self.indices[src]
+
+        # write new cells, stored in the order of cells
+        dst=getSegmentPositions(indptr[cells],cellLengths)
+        data[dst]=cellData
+        indices[dst]=cellIndices
+
+        self.data=data
+        self.indices=indices
+        self.indptr=indptr
+        return self
+
 ##############################################################################################################################
 ##############################################################################################################################
 ##############################################################################################################################
@@ -187,9 +623,20 @@ def Iterate(\
         muXList,posXList,alphaList,betaDataList,betaIndexList,\
         SinkhornSubSolver="LogSinkhorn", SinkhornError=1E-4,\
         SinkhornErrorRel=False, SinkhornMaxIter = None,\
-        SinkhornInnerIter = 100): # Introducing bounding box as an additional argument
+        SinkhornInnerIter = None, nThreads = None): # Introducing bounding box as an additional argument
         #introducing the option to remove epsilon scaling, leave const_iterations at 0 to keep the scalling
 
+    """One half-iteration of the domain decomposition algorithm on the composite cells partitionDataCompCells.
+    The atomic Y-marginals can either be given as two lists muYAtomicDataList,muYAtomicIndicesList,
+    or as an AtomicMarginalStore in muYAtomicDataList (then muYAtomicIndicesList is ignored and may be None).
+    Both are updated in place, as are alphaList, betaDataList and betaIndexList.
+    partitionDataCompCells can also be a GridPartition, then partitionDataCompCellIndices is ignored.
+    SinkhornMaxIter and SinkhornInnerIter are only used by the batched solver, by default it uses 10000 and 20
+    like SolveOnCell_LogSinkhorn.
+    With nThreads>1 the cell problems are solved by a thread pool. The C++ sub-solvers release the GIL,
+    results are written back in the calling thread."""
+
+    partitionDataCompCells,partitionDataCompCellIndices=GetCompCellData(partitionDataCompCells,partitionDataCompCellIndices)
     nCells=len(muXList)
     keops = 0
 
@@ -197,24 +644,410 @@ def Iterate(\
         SolveOnCell=SolveOnCell_LogSinkhorn
     elif SinkhornSubSolver=="SparseSinkhorn":
         SolveOnCell=SolveOnCell_SparseSinkhorn
+    elif SinkhornSubSolver=="BatchedLogSinkhorn":
+        IterateBatched(muY,posY,eps,\
+                partitionDataCompCells,partitionDataCompCellIndices,\
+                muYAtomicDataList,muYAtomicIndicesList,\
+                muXList,posXList,alphaList,betaDataList,betaIndexList,\
+                SinkhornError=SinkhornError,SinkhornErrorRel=SinkhornErrorRel,\
+                SinkhornMaxIter=SinkhornMaxIter,SinkhornInnerIter=SinkhornInnerIter)
+        return
     else:
         SolveOnCell=SinkhornSubSolver    
+
+    if isinstance(muYAtomicDataList,AtomicMarginalStore):
+        store=muYAtomicDataList
+        getAtomicData=store.getData
+        getAtomicIndices=store.getIndices
+        # new marginals are collected per composite cell and written back in one go at the end,
+        # since composite cells are disjoint the old values stay valid until then
+        newCells=[]
+        newData=[]
+        newIndices=[]
+    else:
+        store=None
+        getAtomicData=muYAtomicDataList.__getitem__
+        getAtomicIndices=muYAtomicIndicesList.__getitem__
         
-    for i in range(nCells):
-        resultAlpha,resultBeta,resultMuYAtomicDataList,muYCellIndices=DomDecIteration_SparseY(SolveOnCell,SinkhornError,SinkhornErrorRel,muY,posY,eps,\
+    def solveCell(i):
+        return DomDecIteration_SparseY(SolveOnCell,SinkhornError,SinkhornErrorRel,muY,posY,eps,\
                 muXList[i],posXList[i],alphaList[i],\
-                [muYAtomicDataList[j] for j in partitionDataCompCells[i]],\
-                [muYAtomicIndicesList[j] for j in partitionDataCompCells[i]],\
+                [getAtomicData(j) for j in partitionDataCompCells[i]],\
+                [getAtomicIndices(j) for j in partitionDataCompCells[i]],\
                 partitionDataCompCellIndices[i]\
                 )
-        alphaList[i]=resultAlpha
-        betaDataList[i]=resultBeta
-        betaIndexList[i]=muYCellIndices.copy()
-        for jsub,j in enumerate(partitionDataCompCells[i]):
-            muYAtomicDataList[j]=resultMuYAtomicDataList[jsub]
-            muYAtomicIndicesList[j]=muYCellIndices.copy()
+
+    def writeResults(results):
+        for i,(resultAlpha,resultBeta,resultMuYAtomicDataList,muYCellIndices) in enumerate(results):
+            alphaList[i]=resultAlpha
+            betaDataList[i]=resultBeta
+            betaIndexList[i]=muYCellIndices.copy()
+            if store is not None:
+                newCells.append(partitionDataCompCells[i])
+                newData.append(resultMuYAtomicDataList)
+                newIndices.append(muYCellIndices)
+            else:
+                for jsub,j in enumerate(partitionDataCompCells[i]):
+                    muYAtomicDataList[j]=resultMuYAtomicDataList[jsub]
+                    muYAtomicIndicesList[j]=muYCellIndices.copy()
+
+    if (nThreads is not None) and (nThreads>1):
+        # composite cells are disjoint and results are only written below, so threads only read shared data.
+        # if a cell raises, the pending cells are cancelled by executor.map and the pool is shut down on exit
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nThreads) as executor:
+            writeResults(executor.map(solveCell,range(nCells)))
+    else:
+        writeResults(map(solveCell,range(nCells)))
+
+    if store is not None:
+        store.replaceCells(newCells,newData,newIndices)
+
+
+def IterateBatched(\
+        muY,posY,eps,\
+        partitionDataCompCells,partitionDataCompCellIndices,\
+        muYAtomicDataList,muYAtomicIndicesList,\
+        muXList,posXList,alphaList,betaDataList,betaIndexList,\
+        SinkhornError=1E-4,SinkhornErrorRel=False,SinkhornMaxIter=None,SinkhornInnerIter=None,\
+        batchMaxEntries=2**22):
+    """Same as Iterate, but the cell problems are solved by the batched NumPy solver BatchSolveOnCells_LogSinkhorn
+    (selected in Iterate via SinkhornSubSolver="BatchedLogSinkhorn").
+    Composite cells with the same X size and the same layout of atomic cells (i.e. all interior cells on a grid)
+    are stacked, their Y supports are padded to a common size. Cells are sorted by support size before being split
+    into batches, so padding is small. batchMaxEntries bounds the size (batch x X size x Y size)
+    of the dense cost array of each batch."""
+
+    partitionDataCompCells,partitionDataCompCellIndices=GetCompCellData(partitionDataCompCells,partitionDataCompCellIndices)
+    nCells=len(muXList)
+    # same defaults as LogSinkhorn.iterateUntilError in SolveOnCell_LogSinkhorn
+    if SinkhornMaxIter is None:
+        SinkhornMaxIter=10000
+    if SinkhornInnerIter is None:
+        SinkhornInnerIter=20
+
+    if isinstance(muYAtomicDataList,AtomicMarginalStore):
+        store=muYAtomicDataList
+        getAtomicData=store.getData
+        getAtomicIndices=store.getIndices
+    else:
+        store=None
+        getAtomicData=muYAtomicDataList.__getitem__
+        getAtomicIndices=muYAtomicIndicesList.__getitem__
+
+    # Y marginals of the composite cells, and grouping of cells by their structure
+    cellData=[None]*nCells
+    cellIndices=[None]*nCells
+    groups={}
+    for i in range(nCells):
+        cellData[i],cellIndices[i]=GetCellYMarginal(\
+                [getAtomicData(j) for j in partitionDataCompCells[i]],\
+                [getAtomicIndices(j) for j in partitionDataCompCells[i]])
+        key=(muXList[i].shape[0],)+tuple(np.asarray(partitionDataCompCellIndices[i])[:,0].tolist())
+        groups.setdefault(key,[]).append(i)
+
+    newCells=[None]*nCells
+    newData=[None]*nCells
+    nFailed=0
+    for key,cells in groups.items():
+        xres=key[0]
+        childStarts=np.array(key[1:],dtype=np.int64)
+        cells=np.array(cells)
+        yresList=np.array([cellIndices[i].shape[0] for i in cells])
+        order=np.argsort(yresList,kind="stable")
+        cells=cells[order]
+        yresList=yresList[order]
+
+        batchStart=0
+        while batchStart<cells.shape[0]:
+            # grow batch while the padded cost array stays within budget
+            batchEnd=batchStart+1
+            while (batchEnd<cells.shape[0]) and ((batchEnd+1-batchStart)*xres*yresList[batchEnd]<=batchMaxEntries):
+                batchEnd+=1
+            batch=cells[batchStart:batchEnd]
+            B=batch.shape[0]
+            yresMax=yresList[batchEnd-1]
+
+            # stack, padded Y entries have zero mass
+            muXBatch=np.stack([muXList[i] for i in batch])
+            posXBatch=np.stack([posXList[i] for i in batch])
+            alphaBatch=np.stack([alphaList[i] for i in batch])
+            subMuYBatch=np.zeros((B,yresMax))
+            subRhoYBatch=np.zeros((B,yresMax))
+            subPosYBatch=np.zeros((B,yresMax,posY.shape[1]))
+            for b,i in enumerate(batch):
+                m=cellIndices[i].shape[0]
+                subMuYBatch[b,:m]=cellData[i]
+                subRhoYBatch[b,:m]=muY[cellIndices[i]]
+                subPosYBatch[b,:m]=posY[cellIndices[i]]
+
+            msg,alpha,beta,pi=BatchSolveOnCells_LogSinkhorn(muXBatch,subMuYBatch,posXBatch,subPosYBatch,\
+                    muXBatch,subRhoYBatch,alphaBatch,eps,\
+                    SinkhornError=SinkhornError,SinkhornErrorRel=SinkhornErrorRel,\
+                    SinkhornMaxIter=SinkhornMaxIter,SinkhornInnerIter=SinkhornInnerIter)
+            nFailed+=np.count_nonzero(msg)
+
+            # new atomic marginals: sum pi over the X ranges of the atomic cells
+            atomicBatch=np.add.reduceat(pi,childStarts,axis=1)
+            for b,i in enumerate(batch):
+                m=cellIndices[i].shape[0]
+                alphaList[i]=alpha[b]
+                betaDataList[i]=beta[b,:m].copy()
+                betaIndexList[i]=cellIndices[i].copy()
+                newCells[i]=partitionDataCompCells[i]
+                newData[i]=atomicBatch[b,:,:m]
+            batchStart=batchEnd
+
+    if nFailed>0:
+        print("warning: Sinkhorn did not converge to accuracy on {:d} cells".format(nFailed))
+
+    if store is not None:
+        store.replaceCells(newCells,newData,cellIndices)
+    else:
+        for i in range(nCells):
+            for jsub,j in enumerate(newCells[i]):
+                muYAtomicDataList[j]=newData[i][jsub].copy()
+                muYAtomicIndicesList[j]=cellIndices[i].copy()
     
 
+##############################################################################################################################
+##############################################################################################################################
+##############################################################################################################################
+##############################################################################################################################
+# separable kernels on grids
+# on regular grids the squared Euclidean cost is a sum of costs along each axis, so logsumexp reductions
+# over the kernel can be done one axis at a time, without ever building the cost matrix
+
+def GetGridStructure(pos,tol=1E-8):
+    """Checks whether the points pos (shape (n,dim)) lie on a regular grid (not necessarily filling it).
+    If so, returns (axes,boxShape,boxIndices) where axes is a list of 1D coordinate arrays of the bounding box
+    of the points along each axis, boxShape the shape of the bounding box and boxIndices the flattened index
+    of each point within the box. Otherwise returns None."""
+    axes=[]
+    boxCoords=[]
+    for k in range(pos.shape[1]):
+        u=np.unique(pos[:,k])
+        if u.shape[0]==1:
+            spacing=1.
+        else:
+            spacing=np.min(np.diff(u))
+        steps=(pos[:,k]-u[0])/spacing
+        stepsInt=np.rint(steps)
+        if np.max(np.abs(steps-stepsInt),initial=0.)>tol:
+            return None
+        stepsInt=stepsInt.astype(np.int64)
+        axes.append(u[0]+spacing*np.arange(stepsInt.max()+1))
+        boxCoords.append(stepsInt)
+    boxShape=tuple(a.shape[0] for a in axes)
+    return (axes,boxShape,np.ravel_multi_index(boxCoords,boxShape))
+
+
+class GridLattice:
+    """Integer coordinates of the points pos (shape (n,dim)) on the grid found by GetGridStructure.
+    The grid structure of any subset of the points then follows without np.unique, see getStructure."""
+
+    def __init__(self,pos,tol=1E-8):
+        grid=GetGridStructure(pos,tol)
+        if grid is None:
+            self.axes=None
+            self.coords=None
+        else:
+            self.axes=grid[0]
+            self.coords=np.stack(np.unravel_index(grid[2],grid[1]),axis=1)
+
+    def isGrid(self):
+        return self.coords is not None
+
+    def getStructure(self,rows=slice(None)):
+        """Grid structure (axes,boxShape,boxIndices) of pos[rows] as returned by GetGridStructure,
+        but with the grid spacing of all points. None if pos does not lie on a grid."""
+        if self.coords is None:
+            return None
+        coords=self.coords[rows]
+        lower=np.min(coords,axis=0)
+        upper=np.max(coords,axis=0)
+        boxShape=tuple(int(n) for n in upper-lower+1)
+        axes=[a[l:u+1] for a,l,u in zip(self.axes,lower,upper)]
+        return (axes,boxShape,np.ravel_multi_index(tuple((coords-lower).transpose()),boxShape))
+
+
+_gridLatticeCache={}
+
+def _getRowOwner(pos):
+    """Array owning the rows of pos, and the index of the first row of pos in it.
+    E.g. a cell posXList[i] of a PackedArrayList is a range of rows of posXList.data."""
+    base=pos.base
+    if isinstance(base,np.ndarray) and (base.ndim==2) and (base.shape[1]==pos.shape[1]) and (base.strides==pos.strides):
+        offset=pos.__array_interface__["data"][0]-base.__array_interface__["data"][0]
+        start=offset//base.strides[0]
+        if (offset%base.strides[0]==0) and (0<=start) and (start+pos.shape[0]<=base.shape[0]):
+            return base,start
+    return pos,0
+
+def GetGridLattice(pos):
+    """Returns (lattice,rows), where lattice is the cached GridLattice of the array owning the rows of pos
+    (see _getRowOwner) and pos=owner[rows]. Positions are layer-constant, so the grid of posY and of the packed
+    posXList is detected once per layer instead of once per cell problem.
+    Entries are dropped when the owner is garbage collected, the owner must not be modified in place."""
+    owner,start=_getRowOwner(pos)
+    key=id(owner)
+    entry=_gridLatticeCache.get(key)
+    if (entry is None) or (entry[0]() is not owner):
+        def drop(ref,key=key):
+            if _gridLatticeCache.get(key,(None,))[0] is ref:
+                del _gridLatticeCache[key]
+        entry=(weakref.ref(owner,drop),GridLattice(owner))
+        _gridLatticeCache[key]=entry
+    return entry[1],slice(start,start+pos.shape[0])
+
+def getLogKernelsSqEuclidean(axesOut,axesIn,eps):
+    """Per-axis log-kernels -(x-y)^2/eps of shape (len(axesOut[k]),len(axesIn[k]))."""
+    return [-(xk.reshape((-1,1))-yk.reshape((1,-1)))**2/eps for xk,yk in zip(axesOut,axesIn)]
+
+def logSumExpSeparable(h,logKernels):
+    """For h of shape (...,m_1,...,m_d) and per-axis log-kernels logKernels[k] of shape (n_k,m_k)
+    returns r of shape (...,n_1,...,n_d) with
+    r[x]=log(sum_y exp(h[y]+sum_k logKernels[k][x_k,y_k])),
+    computed one axis at a time. The kernels may carry the same leading batch axes as h."""
+    dim=len(logKernels)
+    nBatchAxes=h.ndim-dim
+    for k,logK in enumerate(logKernels):
+        axis=nBatchAxes+k
+        hk=np.moveaxis(h,axis,-1)
+        if logK.ndim>2:
+            # batched kernel, insert axes for the remaining grid axes of h
+            logK=logK.reshape(logK.shape[:-2]+(1,)*(hk.ndim-1-nBatchAxes)+logK.shape[-2:])
+        h=np.moveaxis(logSumExp(hk[...,np.newaxis,:]+logK,axis=-1),-1,axis)
+    return h
+
+
+class SeparablePlan:
+    """Entropic transport plan pi[x,y]=rhoX[x]*rhoY[y]*exp((alpha[x]+beta[y]-|x-y|^2)/eps) between two point sets on regular grids,
+    kept in factorized form. It supports what DomDecIteration_SparseY and getPrimalInfos need from a dense plan:
+    row selection pi[rows], marginals pi.sum(axis=...), and the transport cost, all via logSumExpSeparable."""
+
+    def __init__(self,alpha,beta,rhoX,rhoY,gridX,gridY,eps,rows=None):
+        self.alpha=alpha
+        self.beta=beta
+        self.rhoX=rhoX
+        self.rhoY=rhoY
+        self.gridX=gridX
+        self.gridY=gridY
+        self.eps=eps
+        self.rows=rows
+        self.shape=(alpha.shape[0],beta.shape[0])
+
+    def __getitem__(self,rows):
+        if isinstance(rows,range):
+            rows=slice(rows.start,rows.stop,rows.step)
+        mask=np.zeros(self.shape[0],dtype=bool)
+        mask[rows]=True
+        if self.rows is not None:
+            mask&=self.rows
+        return SeparablePlan(self.alpha,self.beta,self.rhoX,self.rhoY,self.gridX,self.gridY,self.eps,rows=mask)
+
+    def _getLogDensityBox(self,side):
+        """log of rhoX*exp(alpha/eps) (side 0) or rhoY*exp(beta/eps) (side 1), written into the bounding box of the grid."""
+        if side==0:
+            grid,dual,rho=self.gridX,self.alpha,self.rhoX
+        else:
+            grid,dual,rho=self.gridY,self.beta,self.rhoY
+        with np.errstate(divide="ignore"):
+            values=dual/self.eps+np.log(rho)
+        if (side==0) and (self.rows is not None):
+            values=np.where(self.rows,values,-np.inf)
+        result=np.full(grid[1],-np.inf)
+        result.ravel()[grid[2]]=values
+        return result
+
+    def _getLogMarginal(self,side,logKernels=None):
+        """log of the marginal on side 0 (X) or 1 (Y), in the order of the points."""
+        if side==0:
+            gridOut,gridIn=self.gridX,self.gridY
+        else:
+            gridOut,gridIn=self.gridY,self.gridX
+        if logKernels is None:
+            logKernels=getLogKernelsSqEuclidean(gridOut[0],gridIn[0],self.eps)
+        conv=logSumExpSeparable(self._getLogDensityBox(1-side),logKernels).ravel()[gridOut[2]]
+        return conv+self._getLogDensityBox(side).ravel()[gridOut[2]]
+
+    def sum(self,axis=None):
+        if axis is None:
+            return np.sum(self.sum(axis=1))
+        # summing over axis 0 gives the Y marginal
+        return np.exp(self._getLogMarginal(1-axis))
+
+    def getTransportCost(self):
+        """sum_{x,y} pi[x,y]*|x-y|^2, obtained from one separable reduction per axis, where on axis k the kernel
+        is multiplied by the cost along that axis."""
+        logKernels=getLogKernelsSqEuclidean(self.gridX[0],self.gridY[0],self.eps)
+        result=0.
+        for k in range(len(logKernels)):
+            logKernelsK=logKernels.copy()
+            with np.errstate(divide="ignore"):
+                logKernelsK[k]=logKernels[k]+np.log(-self.eps*logKernels[k])
+            result+=np.sum(np.exp(self._getLogMarginal(0,logKernelsK)))
+        return result
+
+    def toarray(self):
+        posX=np.stack(np.meshgrid(*self.gridX[0],indexing="ij"),axis=-1).reshape((-1,len(self.gridX[0])))[self.gridX[2]]
+        posY=np.stack(np.meshgrid(*self.gridY[0],indexing="ij"),axis=-1).reshape((-1,len(self.gridY[0])))[self.gridY[2]]
+        c=np.sum((posX[:,np.newaxis,:]-posY[np.newaxis,:,:])**2,axis=2)
+        pi=getPi(c,self.alpha,self.beta,self.rhoX,self.rhoY,self.eps)
+        if self.rows is not None:
+            pi[~self.rows]=0.
+        return pi
+
+
+def UseSeparableKernel(posX,posY,subY=None,separable="auto"):
+    """Decides whether the cell problem between posX and posY[subY] should be handled with separable kernels.
+    Returns (gridX,gridY) (see GridLattice.getStructure) if so, and None otherwise.
+    With separable="auto" the separable reduction is used whenever posX and posY lie on grids. With separable=True
+    a ValueError is raised if they do not. The grids are detected once per layer, see GetGridLattice."""
+    if separable is False:
+        return None
+    latticeX,rowsX=GetGridLattice(posX)
+    latticeY,rowsY=GetGridLattice(posY)
+    if not (latticeX.isGrid() and latticeY.isGrid()):
+        if separable is True:
+            raise ValueError("separable kernels need X and Y on regular grids")
+        return None
+    if subY is not None:
+        rowsY=np.asarray(subY)+rowsY.start
+    return (latticeX.getStructure(rowsX),latticeY.getStructure(rowsY))
+
+
+def iterateUntilErrorSeparable(alpha,beta,gridX,gridY,muX,muY,rhoX,rhoY,eps,nIterationsMax,nIterationsInner,maxError):
+    """Separable version of LogSinkhorn.iterateUntilError, for X and Y on grids given by GetGridStructure.
+    Performs the same updates and stopping criterion. alpha and beta are updated in place. Returns 0 on success, 1 otherwise."""
+    logKernelsXY=getLogKernelsSqEuclidean(gridX[0],gridY[0],eps)
+    logKernelsYX=[k.transpose() for k in logKernelsXY]
+    hX=np.full(gridX[1],-np.inf)
+    hY=np.full(gridY[1],-np.inf)
+    with np.errstate(divide="ignore"):
+        logRhoX=np.log(rhoX)
+        logRhoY=np.log(rhoY)
+    logMuXRel=np.log(muX/rhoX)
+    logMuYRel=np.log(muY/rhoY)
+    a=alpha/eps
+    b=beta/eps
+    n=0
+    error=maxError+1.
+    while (n<nIterationsMax) and (error>=maxError):
+        for i in range(nIterationsInner):
+            hY.ravel()[gridY[2]]=b+logRhoY
+            a=logMuXRel-logSumExpSeparable(hY,logKernelsXY).ravel()[gridX[2]]
+            hX.ravel()[gridX[2]]=a+logRhoX
+            b=logMuYRel-logSumExpSeparable(hX,logKernelsYX).ravel()[gridY[2]]
+        n+=nIterationsInner
+        hY.ravel()[gridY[2]]=b+logRhoY
+        conv=logSumExpSeparable(hY,logKernelsXY).ravel()[gridX[2]]
+        error=np.sum(np.abs(muX-rhoX*np.exp(a+conv)))
+    alpha[...]=a*eps
+    beta[...]=b*eps
+    if error<maxError:
+        return 0
+    return 1
+
 ##############################################################################################################################
 ##############################################################################################################################
 ##############################################################################################################################
@@ -230,7 +1063,11 @@ def getPi(c,alpha,beta,rhoX,rhoY,eps):
 
 #-----------------------------------------------------------------------------------------------------------------------------------------
 
-def SolveOnCell_LogSinkhorn(muX,subMuY,subY,posX,posY,rhoX,rhoY,alphaInit,eps,SinkhornError=1E-4,SinkhornErrorRel=False,YThresh=1E-14):
+def SolveOnCell_LogSinkhorn(muX,subMuY,subY,posX,posY,rhoX,rhoY,alphaInit,eps,SinkhornError=1E-4,SinkhornErrorRel=False,YThresh=1E-14,\
+        separable="auto"):
+    """Solves the cell problem with the log-domain Sinkhorn algorithm.
+    If X and Y lie on regular grids (and separable is not False), reductions are done with separable per-axis kernels,
+    see UseSeparableKernel. pi is then returned as SeparablePlan instead of a dense array."""
     
     subPosY=posY[subY].copy()
     subRhoY=rhoY[subY].copy()
@@ -238,6 +1075,19 @@ def SolveOnCell_LogSinkhorn(muX,subMuY,subY,posX,posY,rhoX,rhoY,alphaInit,eps,Si
 
     alpha=alphaInit.copy()
     beta=np.zeros_like(subMuY)
+
+    if SinkhornErrorRel:
+        effectiveError=SinkhornError*np.sum(muX)
+    else:
+        effectiveError=SinkhornError
+
+    grids=UseSeparableKernel(posX,posY,subY,separable)
+    if grids is not None:
+        msg=iterateUntilErrorSeparable(alpha,beta,grids[0],grids[1],muX,subMuY,rhoX,subRhoY,eps,10000,20,effectiveError)
+        if msg==1:
+            print("warning: {:d} : Sinkhorn did not converge to accuracy".format(msg))
+        return (msg,alpha,beta,SeparablePlan(alpha,beta,rhoX,subRhoY,grids[0],grids[1],eps))
+
     #c=Common.getEuclideanCostFunction(posX,subPosY,p=2.)
     #cT=c.transpose().copy()
     xres=posX.shape[0]
@@ -246,11 +1096,6 @@ def SolveOnCell_LogSinkhorn(muX,subMuY,subY,posX,posY,rhoX,rhoY,alphaInit,eps,Si
     c=c.reshape((xres,yres))
     cT=cT.reshape((yres,xres))
     
-    if SinkhornErrorRel:
-        effectiveError=SinkhornError*np.sum(muX)
-    else:
-        effectiveError=SinkhornError
-    
     # dummy return for time measurements
     #return None
     
@@ -329,6 +1174,82 @@ def SolveOnCell_SparseSinkhorn(muX,subMuY,subY,posX,posY,rhoX,rhoY,alphaInit,eps
             shape=(muX.shape[0],subMuY.shape[0]))
     return (result[0],result[1],result[2],resultKernel)
 
+def logSumExp(a,axis):
+    """log(sum(exp(a))) along axis, stable for large values and for -inf entries."""
+    aMax=np.max(a,axis=axis,keepdims=True)
+    aMax[~np.isfinite(aMax)]=0.
+    with np.errstate(divide="ignore"):
+        result=np.log(np.sum(np.exp(a-aMax),axis=axis))
+    result+=np.squeeze(aMax,axis=axis)
+    return result
+
+def BatchSolveOnCells_LogSinkhorn(muX,subMuY,posX,subPosY,rhoX,subRhoY,alphaInit,eps,\
+        SinkhornError=1E-4,SinkhornErrorRel=False,SinkhornMaxIter=10000,SinkhornInnerIter=20):
+    """Batched NumPy version of SolveOnCell_LogSinkhorn, performing the same iterations as LogSinkhorn.iterateUntilError.
+    All arguments carry a leading batch axis: muX,rhoX,alphaInit have shape (B,xres), subMuY,subRhoY (B,yres),
+    posX (B,xres,dim), subPosY (B,yres,dim). Padding entries on the Y side must have subMuY=subRhoY=0.
+    Each cell stops being updated as soon as its error falls below the tolerance.
+    Returns (msg,alpha,beta,pi) with msg an array of length B (0: converged, 1: not converged) and pi of shape (B,xres,yres)."""
+
+    B,xres=muX.shape
+    c=np.sum(posX**2,axis=2)[:,:,np.newaxis]+np.sum(subPosY**2,axis=2)[:,np.newaxis,:]\
+            -2*np.einsum(posX,[0,1,3],subPosY,[0,2,3],[0,1,2])
+    c/=eps
+    cT=np.ascontiguousarray(c.transpose((0,2,1)))
+    validY=subRhoY>0.
+    with np.errstate(divide="ignore",invalid="ignore"):
+        logRhoX=np.log(rhoX)
+        logRhoY=np.log(subRhoY)
+        logMuXRel=np.log(muX/rhoX)
+        logMuYRel=np.where(validY,np.log(subMuY/subRhoY),0.)
+
+    if SinkhornErrorRel:
+        effectiveError=SinkhornError*np.sum(muX,axis=1)
+    else:
+        effectiveError=np.full(B,SinkhornError)
+
+    # work with alpha/eps, beta/eps
+    alpha=alphaInit/eps
+    beta=np.zeros_like(subMuY)
+    msg=np.ones(B,dtype=np.int32)
+    active=np.arange(B)
+    nIter=0
+    while (active.shape[0]>0) and (nIter<SinkhornMaxIter):
+        # restrict to cells that have not converged yet
+        a=alpha[active]
+        b=beta[active]
+        cA=c[active]
+        cTA=cT[active]
+        logRhoXA=logRhoX[active]
+        logRhoYA=logRhoY[active]
+        logMuXRelA=logMuXRel[active]
+        logMuYRelA=logMuYRel[active]
+        for n in range(SinkhornInnerIter):
+            a=logMuXRelA-logSumExp((b+logRhoYA)[:,np.newaxis,:]-cA,axis=2)
+            b=logMuYRelA-logSumExp((a+logRhoXA)[:,np.newaxis,:]-cTA,axis=2)
+        nIter+=SinkhornInnerIter
+        alpha[active]=a
+        beta[active]=b
+        # L1 error of X marginal, as in LogSinkhorn.getL1Error
+        conv=logSumExp((b+logRhoYA)[:,np.newaxis,:]-cA,axis=2)
+        error=np.sum(np.abs(muX[active]-rhoX[active]*np.exp(a+conv)),axis=1)
+        converged=error<effectiveError[active]
+        msg[active[converged]]=0
+        active=active[~converged]
+
+    pi=np.exp(alpha[:,:,np.newaxis]+beta[:,np.newaxis,:]-c)
+    pi*=rhoX[:,:,np.newaxis]
+    pi*=subRhoY[:,np.newaxis,:]
+    beta[~validY]=0.
+    return (msg,alpha*eps,beta*eps,pi)
+
+def GetCellYMarginal(muYAtomicListData,muYAtomicListIndices):
+    """Y marginal of a composite cell as sparse vector (data,indices), given by the sum of its atomic Y marginals."""
+    arrayAdder=LogSinkhorn.TSparseArrayAdder()
+    for x,y in zip(muYAtomicListData,muYAtomicListIndices):
+        arrayAdder.add(x,y)
+    return arrayAdder.getDataTuple()
+
 def DomDecIteration_SparseY(\
         SolveOnCell,SinkhornError,SinkhornErrorRel,muY,posY,eps,\
         muXCell,posXCell,alphaCell,muYAtomicListData,muYAtomicListIndices,partitionDataCompCellIndices\
@@ -346,10 +1267,7 @@ def DomDecIteration_SparseY(\
     #    muYCell+=muYTerm
     
     # new code where sparse vectors are represented index and value list of non-zero entries, with custom c++ code for adding
-    arrayAdder=LogSinkhorn.TSparseArrayAdder()
-    for x,y in zip(muYAtomicListData,muYAtomicListIndices):
-        arrayAdder.add(x,y)
-    muYCellData,muYCellIndices=arrayAdder.getDataTuple()
+    muYCellData,muYCellIndices=GetCellYMarginal(muYAtomicListData,muYAtomicListIndices)
 
     # another dummy return and dummy function call
     #SolveOnCell(muXCell,muYCellData,muYCellIndices,posXCell,posY,muXCell,muY,alphaCell,eps)
@@ -495,64 +1413,68 @@ def DomDecIteration_SparseY(\
 #    return [refineMuYAtomic(i,preMuYAtomicList[atomicCellParents[i]]) for i in range(len(atomicCells))]
 
 
-def GetRefinedAtomicYMarginals_SparseY(muYL,muYLOld,parentsYL,\
-        atomicCellMasses,atomicCellMassesOld,\
-        atomicCells,atomicCellsOld,\
-        muYAtomicDataListOld,muYAtomicIndicesListOld,\
-        metaCellShape,thresh=1E-15):
-
-    yresOld=muYLOld.shape[0]
-    yres=muYL.shape[0]
-    
-    # list of children of each coarse node
-    childrenYLOld=[[] for i in range(yresOld)]
-    for i,parent in enumerate(parentsYL):
-        childrenYLOld[parent].append(i)
-
-    # old atomic cells are 2x2 clustering of new atomic cells
-    newCellChildren=GetPartitionIndices2D(metaCellShape,2,0)
-    # for each new atomic cell compute the old parent atomic cell
-    atomicCellParents=np.zeros((np.prod(metaCellShape),),dtype=np.int)
-    for i,children in enumerate(newCellChildren):
-        atomicCellParents[children]=i
-        
-        
-    preMuYAtomicList=[refineMuYAtomicOld(muYL,muYLOld,childrenYLOld,\
-            muYAtomicDataListOld[i],muYAtomicIndicesListOld[i]) for i in range(len(atomicCellsOld))]
+def GetChildrenTable(parentsYL,yresOld):
+    """CSR table of the children of each coarse Y-point: the children of point y are children[indptr[y]:indptr[y+1]],
+    in increasing order."""
+    children=np.argsort(parentsYL,kind="stable").astype(np.int32)
+    indptr=np.zeros(yresOld+1,dtype=np.int64)
+    np.cumsum(np.bincount(parentsYL,minlength=yresOld),out=indptr[1:])
+    return (children,indptr)
 
-    resultData=[None for i in range(len(atomicCells))]
-    resultIndices=[None for i in range(len(atomicCells))]
 
-    for i,dat in enumerate(preMuYAtomicList):
-        # dat=(dataFine,indicesFine)
-        for j in newCellChildren[i]:
-            resultData[j]=dat[0]*atomicCellMasses[j]/atomicCellMassesOld[i]
-            resultIndices[j]=dat[1].copy()
+def GetAtomicCellParents(metaCellShape):
+    """For each atomic cell on a grid of atomic cells of shape metaCellShape, the index of the atomic cell on the previous
+    layer that contains it. Old atomic cells are 2^dim clusterings of new ones, as in GetPartitionIndices2D(metaCellShape,2,0)."""
+    coords=np.unravel_index(np.arange(np.prod(metaCellShape)),metaCellShape)
+    metaCellShapeOld=tuple((n+1)//2 for n in metaCellShape)
+    return np.ravel_multi_index(tuple(c//2 for c in coords),metaCellShapeOld)
 
-    
-    return [resultData,resultIndices]
 
-# compute refined muYAtomicOld/muYLOld densities for each old atomic cell
-# then on each child cell can simply rescale this one by x cell weights, but all tricky sparsity and refinement operations are only done once
-def refineMuYAtomicOld(muYL,muYLOld,childrenYLOld,\
-        muYAtomicDataOld,muYAtomicIndicesOld):
+def GetRefinedAtomicYMarginals_SparseY(muYL,muYLOld,parentsYL,\
+        atomicCellMasses,atomicCellMassesOld,\
+        atomicCells,atomicCellsOld,\
+        muYAtomicDataListOld,muYAtomicIndicesListOld,\
+        metaCellShape):
+    """Refines the atomic Y-marginals from the previous layer to the current one.
+    If muYAtomicDataListOld is an AtomicMarginalStore (muYAtomicIndicesListOld is then ignored),
+    the result is returned as AtomicMarginalStore, otherwise as [resultData,resultIndices].
 
+    All old atomic marginals are refined at once: each coarse Y-point is replaced by its children (CSR table from parentsYL),
+    with mass distributed according to muYL. Each new atomic cell then receives the refined
+    marginal of its parent cell, rescaled by the ratio of X-masses."""
 
-    indicesFine=[]
-    dataFine=[]
-    yMassScaleFactors=muYAtomicDataOld/muYLOld[muYAtomicIndicesOld]
-    for d,y in zip(yMassScaleFactors,muYAtomicIndicesOld):
-        indicesFine+=childrenYLOld[y]
-        dataFine.append(np.full((len(childrenYLOld[y]),),d,dtype=np.double))
-    indicesFine=np.array(indicesFine,dtype=np.int32)
-    dataFine=np.hstack(dataFine)
-    dataFine*=muYL[indicesFine]
-    
-    ordering=np.argsort(indicesFine)
+    if isinstance(muYAtomicDataListOld,AtomicMarginalStore):
+        storeOld=muYAtomicDataListOld
+    else:
+        storeOld=AtomicMarginalStore.fromLists(muYAtomicDataListOld,muYAtomicIndicesListOld)
+
+    # refine Y-points of all old atomic marginals
+    childrenYLOld,childrenYLOldIndptr=GetChildrenTable(parentsYL,muYLOld.shape[0])
+    nChildren=np.diff(childrenYLOldIndptr)[storeOld.indices]
+    indicesFine=childrenYLOld[getSegmentPositions(childrenYLOldIndptr[storeOld.indices],nChildren)]
+    dataFine=np.repeat(storeOld.data/muYLOld[storeOld.indices],nChildren)*muYL[indicesFine]
+    cellOfEntry=np.repeat(storeOld.getCellOfEntry(),nChildren)
+    # sort Y-indices within each cell
+    ordering=np.argsort(cellOfEntry*muYL.shape[0]+indicesFine,kind="stable")
+    lengthsFine=np.bincount(storeOld.getCellOfEntry(),weights=nChildren,minlength=storeOld.nCells).astype(np.int64)
+    indptrFine=np.zeros(storeOld.nCells+1,dtype=np.int64)
+    np.cumsum(lengthsFine,out=indptrFine[1:])
     indicesFine=indicesFine[ordering]
     dataFine=dataFine[ordering]
-    
-    return (dataFine,indicesFine)
+
+    # copy to new atomic cells and rescale with X-masses
+    atomicCellParents=GetAtomicCellParents(metaCellShape)
+    lengths=lengthsFine[atomicCellParents]
+    entries=getSegmentPositions(indptrFine[atomicCellParents],lengths)
+    indptr=np.zeros(atomicCellParents.shape[0]+1,dtype=np.int64)
+    np.cumsum(lengths,out=indptr[1:])
+    result=AtomicMarginalStore(\
+            dataFine[entries]*np.repeat(atomicCellMasses/atomicCellMassesOld[atomicCellParents],lengths),\
+            indicesFine[entries],indptr)
+
+    if isinstance(muYAtomicDataListOld,AtomicMarginalStore):
+        return result
+    return list(result.toLists(copy=False))
 
 
 ##############################################################################################################################
@@ -608,44 +1530,160 @@ def getPairwiseDelta(d1,d2):
 #            print("warning: failed to balance measures in cell {:d}".format(i))
 
 
+def getTransferPairs(surplus,deficit,groups,nGroups,threshStep=1E-16):
+    """Computes the mass transfers for balancing atomic cells within groups (composite cells) in one sweep.
+    Within each group, the surplus and deficit cells are matched with the north-west corner rule,
+    which yields at most k-1 transfers for a group of k atomic cells. Cells of one group must be contiguous.
+    Returns arrays (src,dst,amount,rank) with one entry per transfer: amount of mass to move from cell src to cell dst,
+    and the position rank of the transfer within its group."""
+    nCells=groups.shape[0]
+    if nCells==0:
+        empty=np.zeros(0,dtype=np.int64)
+        return (empty,empty,np.zeros(0),empty)
+
+    # segments of contiguous cells of one group, and position of each cell within its segment
+    newSegment=np.ones(nCells,dtype=bool)
+    newSegment[1:]=(groups[1:]!=groups[:-1])
+    segments=np.cumsum(newSegment)-1
+    segmentStarts=np.flatnonzero(newSegment)
+    segmentLengths=np.diff(np.append(segmentStarts,nCells))
+    positions=np.arange(nCells)-segmentStarts[segments]
+    nSegments=segmentStarts.shape[0]
+
+    # cumulative surplus and deficit within each segment, accumulated on a (nSegments,maxLength) array
+    # so that the matching of one segment is not affected by rounding errors from other segments
+    def getSegmentCumsum(values):
+        result=np.zeros((nSegments,np.max(segmentLengths)))
+        result[segments,positions]=values
+        return np.cumsum(result,axis=1)
+    cumSurplus=getSegmentCumsum(surplus)
+    cumDeficit=getSegmentCumsum(deficit)
+    transfer=np.minimum(cumSurplus[:,-1],cumDeficit[:,-1])
+
+    # breakpoints of the matching within each segment
+    points=np.concatenate((
+            np.minimum(cumSurplus[segments,positions],transfer[segments])[surplus>0.],
+            np.minimum(cumDeficit[segments,positions],transfer[segments])[deficit>0.]))
+    pointSegments=np.concatenate((segments[surplus>0.],segments[deficit>0.]))
+    order=np.lexsort((points,pointSegments))
+    points=points[order]
+    pointSegments=pointSegments[order]
+    newGroup=np.ones(points.shape[0],dtype=bool)
+    newGroup[1:]=(pointSegments[1:]!=pointSegments[:-1])
+    previous=np.zeros_like(points)
+    previous[1:]=points[:-1]
+    previous[newGroup]=0.
+    amount=points-previous
+    keep=(amount>threshStep)
+    amount=amount[keep]
+    pointSegments=pointSegments[keep]
+    middle=0.5*(points+previous)[keep]
+
+    # cells of the same segment whose surplus and deficit ranges contain the interval
+    lastPositions=segmentLengths[pointSegments]-1
+    src=segmentStarts[pointSegments]+np.minimum(
+            np.sum(cumSurplus[pointSegments]<middle[:,np.newaxis],axis=1),lastPositions)
+    dst=segmentStarts[pointSegments]+np.minimum(
+            np.sum(cumDeficit[pointSegments]<middle[:,np.newaxis],axis=1),lastPositions)
+    pointStarts=np.searchsorted(pointSegments,np.arange(nSegments))
+    rank=np.arange(pointSegments.shape[0])-pointStarts[pointSegments]
+    return (src,dst,amount,rank)
+
+
+def transferMass(data,srcStarts,dstStarts,lengths,amount,thresh=1E-10):
+    """Vectorized version of LogSinkhorn.balanceMeasures for several disjoint pairs of segments of data, in place.
+    For each pair the mass amount is moved from data[srcStarts[i]:srcStarts[i]+lengths[i]] to the segment starting at
+    dstStarts[i], first only on entries where the destination is at least thresh (to not create new support),
+    then on all entries. Returns the amount of mass that could not be moved for each pair."""
+    srcEntries=getSegmentPositions(srcStarts,lengths)
+    dstEntries=getSegmentPositions(dstStarts,lengths)
+    pairs=np.repeat(np.arange(lengths.shape[0]),lengths)
+    segmentStarts=np.cumsum(lengths)-lengths
+    remaining=np.array(amount,dtype=np.double)
+    for t in [thresh,0.]:
+        mu1=data[srcEntries]
+        available=np.where(data[dstEntries]>=t,mu1,0.)
+        # mass available before each entry within its segment
+        cumAvailable=np.cumsum(available)-available
+        if cumAvailable.shape[0]>0:
+            cumAvailable-=np.repeat(cumAvailable[np.minimum(segmentStarts,cumAvailable.shape[0]-1)],lengths)
+        take=np.clip(remaining[pairs]-cumAvailable,0.,available)
+        data[srcEntries]=mu1-take
+        data[dstEntries]+=take
+        remaining-=np.bincount(pairs,weights=take,minlength=lengths.shape[0])
+    return np.maximum(remaining,0.)
+
+
+def BalanceSharedSupport(data,cellStarts,cellLengths,groups,nGroups,masses,targetMasses,threshStep=1E-16):
+    """Balances the masses of atomic marginals within groups (composite cells), in place.
+    The marginal of cell i is data[cellStarts[i]:cellStarts[i]+cellLengths[i]], all cells of one group must share their
+    support. Cells of one group are contiguous, groups[i] is the group of cell i, masses and targetMasses the current and
+    desired mass of each cell. Surplus and deficit are computed once and mass is moved in one sweep,
+    taking linear time in the total size of the marginals.
+    Returns the remaining absolute imbalance of each group."""
+    surplus=np.maximum(masses-targetMasses,0.)
+    deficit=np.maximum(targetMasses-masses,0.)
+    src,dst,amount,rank=getTransferPairs(surplus,deficit,groups,nGroups,threshStep=threshStep)
+    newMasses=masses.copy()
+    # each group has at most one transfer per round, so transfers within a round touch distinct cells
+    for r in range(np.max(rank,initial=-1)+1):
+        active=(rank==r)
+        srcR=src[active]
+        dstR=dst[active]
+        moved=amount[active]-transferMass(data,cellStarts[srcR],cellStarts[dstR],cellLengths[srcR],amount[active])
+        newMasses[srcR]-=moved
+        newMasses[dstR]+=moved
+    return np.bincount(groups,weights=np.abs(newMasses-targetMasses),minlength=nGroups)
+
+
 # simplified version where muYAtomicListSub are only the data fields of the csr matrices and it is assumed that their indices are the same
 def BalanceMeasuresMulti(muYAtomicListSub,atomicCellMassesSub,threshStep=1E-16,threshTerminate=1E-10):
-    # dummy return to test pure communication time
-    #return (0,muYAtomicListSub)
+    """Transfers mass between the atomic Y-marginals of one composite cell such that atomic cell i has mass
+    atomicCellMassesSub[i], while the sum of the marginals remains unchanged. The marginals are modified in place.
+    Surplus and deficit are computed once, cells are then matched in a single sweep with at most k-1 transfers
+    (see BalanceSharedSupport), instead of balancing all pairs of cells.
+    Returns (msg,muYAtomicListSub) with msg=0 if the remaining imbalance is below threshTerminate and 1 otherwise."""
     nCells=len(muYAtomicListSub)
-    
-    massDeltasSub=np.array([np.sum(a)-b for a,b in zip(muYAtomicListSub,atomicCellMassesSub)])
-    # print(massDeltasSub)
     if nCells==1:
         return (0,muYAtomicListSub)
-
-    for i in range(nCells):
-        for j in range(i+1,nCells):
-            delta=getPairwiseDelta(massDeltasSub[i],massDeltasSub[j])
-            if delta>0:
-                delta=min(delta,np.sum(muYAtomicListSub[i]))
-            else:
-                delta=max(delta,-np.sum(muYAtomicListSub[j]))
-            if np.abs(delta)>threshStep:
-                LogSinkhorn.balanceMeasures(\
-                        muYAtomicListSub[i],muYAtomicListSub[j],\
-                        delta)
-                massDeltasSub[i]-=delta
-                massDeltasSub[j]+=delta
-            if np.sum(np.abs(massDeltasSub))<threshTerminate:
-                return (0,muYAtomicListSub)
+    if any(a.shape!=muYAtomicListSub[0].shape for a in muYAtomicListSub):
+        raise ValueError("atomic marginals of a composite cell must share their support")
+
+    data=np.concatenate(muYAtomicListSub)
+    res=muYAtomicListSub[0].shape[0]
+    cellStarts=np.arange(nCells,dtype=np.int64)*res
+    cellLengths=np.full(nCells,res,dtype=np.int64)
+    masses=np.array([np.sum(a) for a in muYAtomicListSub])
+    residual=BalanceSharedSupport(data,cellStarts,cellLengths,np.zeros(nCells,dtype=np.int64),1,\
+            masses,np.asarray(atomicCellMassesSub,dtype=np.double),threshStep=threshStep)
+    for i,a in enumerate(muYAtomicListSub):
+        a[...]=data[cellStarts[i]:cellStarts[i]+res]
+    if residual[0]<threshTerminate:
+        return (0,muYAtomicListSub)
     return (1,muYAtomicListSub)
 
 def GetActualYMarginal(muYAtomicIndicesList, muYAtomicDataList, N):
     """
     Compute current Y marginal based on basic cell marginals.
+    Instead of the two lists, an AtomicMarginalStore can be passed as muYAtomicIndicesList
+    (muYAtomicDataList is then ignored).
     """
+    if isinstance(muYAtomicIndicesList, AtomicMarginalStore):
+        return muYAtomicIndicesList.getYMarginal(N)
     piY = np.zeros(N)
     for (indices, data) in zip(muYAtomicIndicesList, muYAtomicDataList):
         piY[indices] += data
     return piY
 
 def BalanceMeasuresMultiAll(muYAtomicDataList,atomicCellMasses,partitionDataCompCells,verbose=False,threshTerminate=1e-6):
+    partitionDataCompCells,_=GetCompCellData(partitionDataCompCells)
+    if isinstance(muYAtomicDataList,AtomicMarginalStore):
+        # all composite cells at once on the packed arrays
+        residual=muYAtomicDataList.balance(atomicCellMasses,partitionDataCompCells)
+        if verbose:
+            for i in np.nonzero(residual>=threshTerminate)[0]:
+                print("warning: failed to balance measures in cell {:d}".format(i))
+        return
     for i in range(len(partitionDataCompCells)):
         muYAtomicListSub=[muYAtomicDataList[j] for j in partitionDataCompCells[i]]
         atomicCellMassesSub=atomicCellMasses[partitionDataCompCells[i]]
@@ -657,6 +1695,17 @@ def BalanceMeasuresMultiAll(muYAtomicDataList,atomicCellMasses,partitionDataComp
             print("warning: failed to balance measures in cell {:d}".format(i))
 
 
+def TruncateMeasures(muYAtomicDataList,muYAtomicIndicesList,thresh):
+    """Removes all entries below thresh from the atomic Y-marginals, in place.
+    muYAtomicDataList can also be an AtomicMarginalStore, then muYAtomicIndicesList is ignored."""
+    if isinstance(muYAtomicDataList,AtomicMarginalStore):
+        muYAtomicDataList.truncate(thresh)
+        return
+    for i in range(len(muYAtomicDataList)):
+        muYAtomicDataList[i],muYAtomicIndicesList[i]=Common.truncateSparseVector(\
+                muYAtomicDataList[i],muYAtomicIndicesList[i],thresh)
+
+
 ##############################################################################################################################
 ##############################################################################################################################
 ##############################################################################################################################
@@ -834,45 +1883,129 @@ def glueBetaList(betaDataList,betaIndexList,res,offsets=None,muYList=None,muY=No
         result=result/muY
     return result
 
-def getPrimalInfos(muY,posY,posXList,muXList,alphaList,betaDataList,betaIndexList,eps,getMuYList=False):
+def getCellBatches(cells,sizes,batchEntries):
+    """Splits the list cells into batches of cells of similar size, such that the number of cells in a batch
+    times the largest size within it does not exceed batchEntries (unless a single cell is larger)."""
+    cells=np.asarray(cells,dtype=np.int64)
+    order=np.argsort(sizes,kind="stable")
+    result=[]
+    start=0
+    for pos in range(1,len(order)+1):
+        if (pos==len(order)) or ((pos+1-start)*sizes[order[pos]]>batchEntries):
+            result.append(cells[order[start:pos]])
+            start=pos
+    return result
+
+
+def getPlanBatchInfos(muY,posY,posXList,muXList,alphaList,betaDataList,betaIndexList,eps,cells):
+    """Evaluates the dense cell plans of the cells in the list cells together, padded to a common size.
+    Returns the X marginals and Y marginals of each cell (padded, as arrays of shape (len(cells),maxSize)),
+    the masks of the valid entries and the transport cost of each cell. Only the plans of the batch are held in memory."""
+    nX=np.array([posXList[i].shape[0] for i in cells])
+    nY=np.array([betaIndexList[i].shape[0] for i in cells])
+    b=len(cells)
+    dim=posY.shape[1]
+    maskX=np.arange(np.max(nX)).reshape((1,-1))<nX.reshape((-1,1))
+    maskY=np.arange(np.max(nY)).reshape((1,-1))<nY.reshape((-1,1))
+    posXBatch=np.zeros(maskX.shape+(dim,))
+    posYBatch=np.zeros(maskY.shape+(dim,))
+    alphaBatch=np.zeros(maskX.shape)
+    betaBatch=np.zeros(maskY.shape)
+    muXBatch=np.zeros(maskX.shape)
+    muYBatch=np.zeros(maskY.shape)
+    posXBatch[maskX]=np.concatenate([posXList[i] for i in cells])
+    alphaBatch[maskX]=np.concatenate([alphaList[i] for i in cells])
+    muXBatch[maskX]=np.concatenate([muXList[i] for i in cells])
+    indexY=np.concatenate([betaIndexList[i] for i in cells])
+    posYBatch[maskY]=posY[indexY]
+    betaBatch[maskY]=np.concatenate([betaDataList[i] for i in cells])
+    muYBatch[maskY]=muY[indexY]
+
+    # squared distances, one axis at a time
+    c=np.zeros((b,)+maskX.shape[1:]+maskY.shape[1:])
+    for k in range(dim):
+        c+=(posXBatch[:,:,np.newaxis,k]-posYBatch[:,np.newaxis,:,k])**2
+    # log-density of the plans, built in place
+    pi=c*(-1./eps)
+    with np.errstate(divide="ignore"):
+        pi+=(alphaBatch/eps+np.log(muXBatch))[:,:,np.newaxis]
+        pi+=(betaBatch/eps+np.log(muYBatch))[:,np.newaxis,:]
+    np.exp(pi,out=pi)
+    margX=np.sum(pi,axis=2)
+    margY=np.sum(pi,axis=1)
+    cost=np.einsum(pi,[0,1,2],c,[0,1,2],[0])
+    return margX,margY,maskX,maskY,cost
+
+
+def getPrimalInfos(muY,posY,posXList,muXList,alphaList,betaDataList,betaIndexList,eps,getMuYList=False,separable="auto",\
+        batchEntries=2**16,sampleFraction=None,seed=None):
+    """Primal score, unregularized transport cost and X/Y marginal errors of the cell plans given by the duals.
+    Cells on grids may be evaluated on the factorized plan (see UseSeparableKernel), the others are evaluated in batches of
+    similar size with at most batchEntries plan entries in memory at a time (see getPlanBatchInfos). No plans are stored.
+    For monitoring, with sampleFraction only a random fraction of the cells is evaluated (drawn with seed) and the
+    scores and errorMargX are extrapolated to all cells. errorMargY is then nan and getMuYList is not supported."""
     scorePrimalUnreg=0.
     scorePrimal=0.
     errorMargX=0.
     errorMargY=0.
-    
-    if getMuYList:
-        muYList=[]
 
-    margY=np.zeros_like(muY)
-
-    for i in range(len(muXList)):
-        posYcell=posY[betaIndexList[i]].copy()
-        xresCell=posXList[i].shape[0]
-        yresCell=posYcell.shape[0]
-        c,cT=LogSinkhorn.getEuclideanCost(posXList[i],posYcell)
-        #cEff=c.reshape((xresCell,yresCell))\
-        #        -np.einsum(alphaList[i],[0],np.ones((yresCell,),dtype=np.double),[1],[0,1])\
-        #        -np.einsum(np.ones((xresCell,),dtype=np.double),[0],betaDataList[i],[1],[0,1])
-
-        cEff=c.reshape((xresCell,yresCell))-alphaList[i].reshape((-1,1))-betaDataList[i].reshape((1,-1))
+    nCells=len(muXList)
+    cells=np.arange(nCells)
+    if sampleFraction is not None:
+        if getMuYList:
+            raise ValueError("getMuYList is not supported with sampleFraction")
+        rng=np.random.default_rng(seed)
+        nSample=max(1,min(nCells,int(np.ceil(sampleFraction*nCells))))
+        cells=np.sort(rng.choice(nCells,nSample,replace=False))
 
+    if getMuYList:
+        muYList=[None for i in range(nCells)]
 
-        piCell=np.einsum(np.exp(-cEff/eps),[0,1],muXList[i],[0],muY[betaIndexList[i]],[1],[0,1])
+    margY=np.zeros_like(muY)
 
-        scorePrimalUnreg+=np.sum(piCell.ravel()*c)
-        scorePrimal+=np.einsum(piCell,[0,1],alphaList[i],[0],[])\
-                +np.einsum(piCell,[0,1],betaDataList[i],[1],[])\
-                -eps*np.sum(piCell)
-                
-        
-        errorMargX+=np.sum(np.abs(np.sum(piCell,axis=1)-muXList[i]))
-        margY[betaIndexList[i]]+=np.sum(piCell,axis=0)
-        
+    denseCells=[]
+    for i in cells:
+        grids=UseSeparableKernel(posXList[i],posY,betaIndexList[i],separable)
+        if grids is None:
+            denseCells.append(i)
+            continue
+        # evaluate marginals and cost on the factorized plan
+        plan=SeparablePlan(alphaList[i],betaDataList[i],muXList[i],muY[betaIndexList[i]],grids[0],grids[1],eps)
+        margXCell=plan.sum(axis=1)
+        margYCell=plan.sum(axis=0)
+        scorePrimalUnreg+=plan.getTransportCost()
+        scorePrimal+=np.sum(margXCell*alphaList[i])+np.sum(margYCell*betaDataList[i])-eps*np.sum(margXCell)
+        errorMargX+=np.sum(np.abs(margXCell-muXList[i]))
+        margY[betaIndexList[i]]+=margYCell
         if getMuYList:
-            muYList.append(np.sum(piCell,axis=0))
-
-
-    errorMargY=np.sum(np.abs(muY-margY))
+            muYList[i]=margYCell
+
+    sizes=np.array([posXList[i].shape[0]*betaIndexList[i].shape[0] for i in denseCells],dtype=np.int64)
+    for batch in getCellBatches(denseCells,sizes,batchEntries):
+        margXBatch,margYBatch,maskX,maskY,cost=getPlanBatchInfos(muY,posY,posXList,muXList,alphaList,\
+                betaDataList,betaIndexList,eps,batch)
+        margXCells=margXBatch[maskX]
+        margYCells=margYBatch[maskY]
+        alpha=np.concatenate([alphaList[i] for i in batch])
+        beta=np.concatenate([betaDataList[i] for i in batch])
+        muX=np.concatenate([muXList[i] for i in batch])
+        indexY=np.concatenate([betaIndexList[i] for i in batch])
+        scorePrimalUnreg+=np.sum(cost)
+        scorePrimal+=np.sum(margXCells*alpha)+np.sum(margYCells*beta)-eps*np.sum(margXCells)
+        errorMargX+=np.sum(np.abs(margXCells-muX))
+        margY+=np.bincount(indexY,weights=margYCells,minlength=margY.shape[0])
+        if getMuYList:
+            for j,i in enumerate(batch):
+                muYList[i]=margYBatch[j,maskY[j]]
+
+    if sampleFraction is not None:
+        scale=nCells/len(cells)
+        scorePrimal*=scale
+        scorePrimalUnreg*=scale
+        errorMargX*=scale
+        errorMargY=np.nan
+    else:
+        errorMargY=np.sum(np.abs(muY-margY))
     
     result={"scorePrimal":scorePrimal, "scorePrimalUnreg":scorePrimalUnreg,"errorMargX":errorMargX,"errorMargY":errorMargY}
     
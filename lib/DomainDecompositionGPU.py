@@ -2,11 +2,30 @@ import numpy as np
 import torch
 # from . import MultiScaleOT
 from .LogSinkhorn import LogSinkhorn as LogSinkhorn
-import LogSinkhornGPU
+try:
+    import LogSinkhornGPU
+except ImportError:
+    # Without the CUDA kernels all tensors are handled by LogSinkhornTorch
+    LogSinkhornGPU = None
+from . import LogSinkhornTorch
 
 from . import DomainDecomposition as DomDec
 import time
 
+def get_backend(x, dim=2):
+    """
+    Get the module implementing Sinkhorn solvers and bounding box kernels for 
+    tensor (or device) `x`: LogSinkhornGPU for CUDA tensors if it is 
+    installed, the pure PyTorch implementation LogSinkhornTorch otherwise. 
+    Both share the same function names and signatures. The kernels of 
+    LogSinkhornGPU are two-dimensional, for grids of dimension `dim` != 2 
+    LogSinkhornTorch is used on all devices.
+    """
+    device = x.device if torch.is_tensor(x) else torch.device(x)
+    if LogSinkhornGPU is not None and device.type == "cuda" and dim == 2:
+        return LogSinkhornGPU
+    return LogSinkhornTorch
+
 #########################################################
 # Bounding box utils
 # Cast all cell problems to a common size and coordinates
@@ -54,6 +73,340 @@ class BoundingBox:
             assert torch.all(self.offsets[:,i] < self.global_shape[i]), \
                 "Offset must be smaller than global shape"
             
+class RaggedBoundingBox:
+    """
+    Holds sparse vectors in ragged bounding box representation: every 
+    structure is trimmed to its own box, and the boxes are stored one after 
+    another in a flat tensor. Unlike BoundingBox, no memory is spent on padding
+    all structures to the largest box.
+
+    Attributes
+    ----------
+
+    dim, B, global_shape, offsets :
+        As in BoundingBox.
+    data : torch.Tensor
+        Flat tensor with the entries of all boxes, of length `size`. It is a 
+        view into the first entries of `storage`, which is grown on demand.
+    starts : torch.Tensor(int64) of size (B,)
+        Position of each structure in `data`.
+    shapes : torch.Tensor(int64) of size (B, dim)
+        Box shape of each structure.
+    strides : torch.Tensor(int64) of size (B, dim)
+        Strides of each structure in `data`, so that entry `x` of structure 
+        `i` is `data[starts[i] + (x * strides[i]).sum()]`. Boxes are stored in
+        row-major order.
+    """
+
+    def __init__(self, data, starts, shapes, strides, offsets, global_shape,
+                 size=None, workspace=None, name="ragged"):
+        self.storage = data
+        self.size = data.numel() if size is None else size
+        self.data = data[:self.size]
+        self.starts = starts
+        self.shapes = shapes
+        self.strides = strides
+        self.offsets = offsets
+        self.B = offsets.shape[0]
+        self.dim = offsets.shape[1]
+        self.global_shape = global_shape
+        self.options = dict(device = data.device, dtype = data.dtype)
+        self.options_int = dict(device = offsets.device, dtype = offsets.dtype)
+        # Where to take storage from when `data` needs to grow
+        self.workspace = workspace
+        self.name = name
+
+    @classmethod
+    def empty(cls, B, dim, global_shape, options, options_int, capacity=0,
+              workspace=None, name="ragged"):
+        """
+        Ragged bounding box with room for `capacity` entries, to be filled with
+        `append`. Buffers are taken from `workspace` if given.
+        """
+        device = options_int["device"]
+        data = get_buffer(workspace, f"{name}_data", (capacity,), **options)
+        starts = get_buffer(workspace, f"{name}_starts", (B,),
+                            torch.int64, device).zero_()
+        shapes = get_buffer(workspace, f"{name}_shapes", (B, dim),
+                            torch.int64, device).zero_()
+        strides = get_buffer(workspace, f"{name}_strides", (B, dim),
+                             torch.int64, device).zero_()
+        offsets = get_buffer(workspace, f"{name}_offsets", (B, dim),
+                             **options_int).zero_()
+        return cls(data, starts, shapes, strides, offsets, global_shape, 0,
+                   workspace, name)
+
+    @classmethod
+    def from_bounding_box(cls, box, workspace=None, name="ragged"):
+        """
+        Ragged version of BoundingBox `box`.
+        """
+        result = cls.empty(box.B, box.dim, box.global_shape, box.options,
+                           box.options_int, 0, workspace, name)
+        indices = torch.arange(box.B, device=box.offsets.device)
+        result.append(indices, slide_marginals_to_corner(box, workspace))
+        return result
+
+    def reserve(self, capacity):
+        """
+        Make sure that `storage` can hold `capacity` entries.
+        """
+        if self.storage.numel() >= capacity:
+            return
+        # Grow geometrically to not reallocate on every append
+        capacity = max(capacity, 2*self.storage.numel())
+        storage = get_buffer(self.workspace, f"{self.name}_data", (capacity,),
+                             **self.options)
+        if storage.data_ptr() != self.storage.data_ptr():
+            storage[:self.size] = self.data
+        self.storage = storage
+
+    def append(self, indices, box):
+        """
+        Store structures `indices` from BoundingBox `box`. Each structure is 
+        trimmed to the part of its box up to its last non-zero entry along 
+        every axis, so `box` should have been passed through 
+        `slide_marginals_to_corner` first.
+        """
+        data = box.data
+        dim = box.dim
+        options_int = dict(device=data.device, dtype=torch.int64)
+        # Extent of every structure along each axis
+        shapes = torch.empty((data.shape[0], dim), **options_int)
+        mask = torch.ones((1,)*(dim+1), dtype=torch.bool, device=data.device)
+        for axis in range(dim):
+            index = torch.arange(data.shape[axis+1], **options_int)
+            axis_sum = tuple(k+1 for k in range(dim) if k != axis)
+            shapes[:, axis] = ((data.sum(axis_sum) > 0) * (index + 1)) \
+                .amax(-1)
+            view = [-1] + [1]*dim
+            view[axis+1] = data.shape[axis+1]
+            mask = mask & (index.view(view) 
+                           < shapes[:, axis].view(-1, *([1]*dim)))
+        values = data[mask]
+        total = values.numel()
+        self.reserve(self.size + total)
+        self.storage[self.size:self.size + total] = values
+        sizes = shapes.prod(-1)
+        self.starts[indices] = self.size + torch.cumsum(sizes, 0) - sizes
+        self.shapes[indices] = shapes
+        self.strides[indices] = get_row_major_strides(shapes)
+        self.offsets[indices] = box.offsets
+        self.size += total
+        self.data = self.storage[:self.size]
+
+    def get_box(self, indices=None, workspace=None, name="cells_box"):
+        """
+        Get structures `indices` (all by default) as BoundingBox, padded to the
+        largest of their boxes.
+        """
+        if indices is None:
+            indices = torch.arange(self.B, device=self.offsets.device)
+        dim = self.dim
+        starts = self.starts[indices]
+        shapes = self.shapes[indices]
+        strides = self.strides[indices]
+        n = starts.shape[0]
+        box_shape = tuple(max(int(s), 1) for s in shapes.amax(0).tolist()) \
+            if n > 0 else (1,)*dim
+        options_int = dict(device=starts.device, dtype=torch.int64)
+        single = [-1] + [1]*dim
+        mask = torch.ones((1,)*(dim+1), dtype=torch.bool, device=starts.device)
+        index = starts.view(single)
+        for axis in range(dim):
+            view = [1]*(dim+1)
+            view[axis+1] = box_shape[axis]
+            ik = torch.arange(box_shape[axis], **options_int).view(view)
+            mask = mask & (ik < shapes[:, axis].view(single))
+            index = index + ik*strides[:, axis].view(single)
+        mask = mask.expand(n, *box_shape)
+        index = index.expand(n, *box_shape)
+        data = get_buffer(workspace, name, (n, *box_shape), 
+                          **self.options).zero_()
+        data[mask] = self.data[index[mask]]
+        return BoundingBox(data, self.offsets[indices], self.global_shape)
+
+def get_row_major_strides(shapes):
+    """
+    Strides of boxes with shapes `shapes` (of size (B, dim)), stored in 
+    row-major order.
+    """
+    strides = torch.ones_like(shapes)
+    for i in range(shapes.shape[1] - 1, 0, -1):
+        strides[:, i-1] = strides[:, i] * shapes[:, i]
+    return strides
+
+def as_bounding_box(box):
+    """
+    Turn RaggedBoundingBox into BoundingBox, leave BoundingBox as it is.
+    """
+    if isinstance(box, RaggedBoundingBox):
+        return box.get_box()
+    return box
+
+def get_ragged_entries(ragged_box, indices=None):
+    """
+    Locate the entries of the structures `indices` (all by default) of 
+    RaggedBoundingBox `ragged_box`.
+
+    Returns
+    -------
+    entry_index : torch.Tensor(int64)
+        For each entry, the position of its structure in `indices`.
+    flat_index : torch.Tensor(int64)
+        For each entry, its position in `ragged_box.data`.
+    coords : torch.Tensor(int64) of size (n, dim)
+        For each entry, its coordinates relative to the offset of its box.
+    """
+    device = ragged_box.offsets.device
+    if indices is None:
+        indices = torch.arange(ragged_box.B, device=device)
+    indices = indices.long()
+    shapes = ragged_box.shapes[indices]
+    sizes = shapes.prod(-1)
+    entry_index = torch.repeat_interleave(
+        torch.arange(indices.shape[0], device=device), sizes)
+    first = torch.cumsum(sizes, 0) - sizes
+    local = torch.arange(entry_index.shape[0], device=device) \
+        - first[entry_index]
+    flat_index = ragged_box.starts[indices][entry_index] + local
+    coords = (local.view(-1, 1) // ragged_box.strides[indices][entry_index]) \
+        % shapes[entry_index]
+    return entry_index, flat_index, coords
+
+def get_ragged_bounds(ragged_box, indices=None):
+    """
+    Bounds of the positive entries of the structures `indices` (all by 
+    default) in `ragged_box`, relative to their offsets, as tensors `minus` 
+    and `plus` of size (len(indices), dim). Structures without mass get the 
+    bounds of their first entry.
+    """
+    entry_index, flat_index, coords = get_ragged_entries(ragged_box, indices)
+    mask = ragged_box.data[flat_index] > 0
+    B = ragged_box.B if indices is None else indices.shape[0]
+    dim = ragged_box.dim
+    index = entry_index[mask].view(-1, 1).expand(-1, dim)
+    options_int = dict(device=coords.device, dtype=torch.int64)
+    minus = torch.zeros((B, dim), **options_int).scatter_reduce(
+        0, index, coords[mask], "amin", include_self=False)
+    plus = torch.zeros((B, dim), **options_int).scatter_reduce(
+        0, index, coords[mask], "amax", include_self=False)
+    return minus, plus
+
+class Workspace:
+    """
+    Buffers for the bounding box pipeline that are reused over 
+    half-iterations instead of allocating new tensors on every call. 
+
+    Buffers are identified by a name and only grow: a request for a larger 
+    size reallocates the buffer, smaller requests return a view into the 
+    existing memory. Bounding box shapes typically shrink over the iterations 
+    on a layer, so after the first iterations no new memory is allocated. 
+    Since the contents of a buffer are overwritten by the next request with 
+    the same name, one workspace should be used per layer.
+    """
+
+    def __init__(self):
+        self.buffers = dict()
+        self.slots = dict()
+
+    def get(self, name, shape, dtype, device):
+        """
+        Get uninitialized tensor of `shape` backed by buffer `name`.
+        """
+        numel = int(np.prod(shape))
+        key = (name, dtype, torch.device(device))
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.numel() < numel:
+            buffer = torch.empty(numel, dtype=dtype, device=device)
+            self.buffers[key] = buffer
+        return buffer[:numel].view(shape)
+
+    def next_slot(self, name):
+        """
+        Alternate between two buffers with base name `name` (ping-pong), for 
+        outputs that are the input of the next call, such as the basic cell 
+        marginals returned by MiniBatchIterate.
+        """
+        slot = 1 - self.slots.get(name, 1)
+        self.slots[name] = slot
+        return f"{name}_{slot}"
+
+def get_buffer(workspace, name, shape, dtype, device):
+    """
+    Uninitialized tensor from `workspace`, or newly allocated if `workspace` 
+    is None.
+    """
+    if workspace is None:
+        return torch.empty(shape, dtype=dtype, device=device)
+    return workspace.get(name, shape, dtype, device)
+
+class PrecisionPolicy:
+    """
+    Floating point types of the bounding box pipeline. Marginals and duals 
+    that are kept between iterations (basic cell marginals, alpha, beta_hat 
+    and refined marginals) are stored in `storage_dtype`, while the Sinkhorn
+    solves, logsumexp reductions and mass sums are done in `compute_dtype`.
+
+    Use `PrecisionPolicy.from_name` for the standard policies "double", 
+    "mixed" (float32 storage, float64 computation) and "single".
+    """
+
+    names = {
+        "double": (torch.float64, torch.float64),
+        "mixed": (torch.float32, torch.float64),
+        "single": (torch.float32, torch.float32),
+    }
+
+    def __init__(self, storage_dtype=torch.float64, 
+                 compute_dtype=torch.float64):
+        self.storage_dtype = storage_dtype
+        self.compute_dtype = compute_dtype
+
+    @classmethod
+    def from_name(cls, name):
+        if name not in cls.names:
+            raise ValueError(f"unknown precision {name}")
+        return cls(*cls.names[name])
+
+    def store(self, x):
+        """
+        `x` in storage type (not a copy if it already is).
+        """
+        return x.to(self.storage_dtype)
+
+    def compute(self, x):
+        """
+        `x` in compute type (not a copy if it already is).
+        """
+        return x.to(self.compute_dtype)
+
+    def store_box(self, box):
+        """
+        BoundingBox or RaggedBoundingBox `box` with data in storage type.
+        """
+        if box.data.dtype == self.storage_dtype:
+            return box
+        if isinstance(box, RaggedBoundingBox):
+            return RaggedBoundingBox(self.store(box.data), box.starts, 
+                                     box.shapes, box.strides, box.offsets,
+                                     box.global_shape)
+        return BoundingBox(self.store(box.data), box.offsets, box.global_shape)
+
+    def __repr__(self):
+        return f"PrecisionPolicy({self.storage_dtype}, {self.compute_dtype})"
+
+def get_precision_policy(precision, x):
+    """
+    Policy `precision`, which may be given by name. If it is None, everything 
+    stays in the type of tensor `x`.
+    """
+    if precision is None:
+        return PrecisionPolicy(x.dtype, x.dtype)
+    if isinstance(precision, str):
+        return PrecisionPolicy.from_name(precision)
+    return precision
+
 def combine_offsets(*offsets):
     """
     Concatenates inputs into columns.
@@ -84,6 +437,26 @@ def pad_tensor(a, padding, pad_value=0):
     return b
 
 
+def get_padded_shape(shape, multiple):
+    """
+    Round every entry of `shape` up to the next multiple of `multiple`.
+    """
+    return tuple(-(-n // multiple) * multiple for n in shape)
+
+
+def pad_to_shape(a, shape, pad_value=0):
+    """
+    Pad tensor `a` at the end of every axis up to `shape`, filled with 
+    `pad_value`. Returns `a` itself if it already has that shape.
+    """
+    shape = tuple(int(n) for n in shape)
+    if tuple(a.shape) == shape:
+        return a
+    b = torch.full(shape, pad_value, dtype=a.dtype, device=a.device)
+    b[tuple(slice(0, s) for s in a.shape)] = a
+    return b
+
+
 def pad_replicate(a, padding):
     """
     Pad tensor `a` replicating values at boundary `paddding` times.
@@ -224,21 +597,12 @@ def get_grid_cartesian_coordinates(muYCell, dys):
     Generate the cartesian coordinates of the boxes within a bounding box 
     and spacing dys.
     """
-    # TODO: generalize to 3D
     # TODO: use just muYCell.points for this
-    if muYCell.dim != 2:
-        raise NotImplementedError("Only implemented for dim = 2")
-    B = muYCell.B
-    left, bottom = muYCell.offsets[:,0], muYCell.offsets[:,1]
-    w, h = muYCell.box_shape
     torch_options = (muYCell.options)
-
-    dy1, dy2 = dys
-    y1_template = torch.arange(w, **torch_options) * dy1
-    y2_template = torch.arange(h, **torch_options) * dy2
-    y1 = left.view(-1, 1)*dy1 + y1_template.view(1, -1)
-    y2 = bottom.view(-1, 1)*dy2 + y2_template.view(1, -1)
-    return y1, y2
+    return tuple(
+        muYCell.offsets[:,k].view(-1, 1)*dy 
+        + (torch.arange(n, **torch_options) * dy).view(1, -1)
+        for (k, (n, dy)) in enumerate(zip(muYCell.box_shape, dys)))
 
 def get_dx(x, B):
     """
@@ -258,55 +622,79 @@ def get_dx(x, B):
             "grid points must be equispaced"
         return dx.item()
 
-def get_cell_marginals(muref, nuref, alpha, beta, xs, ys, eps, s = None):
+def get_cell_marginals(muref, nuref, alpha, beta, xs, ys, eps, s = None,
+                       precision = None):
     """
     Get cell marginals directly using duals and logsumexp reductions, 
     without building the transport plans. 
     The mathematical formulation is covered in [TODO: ref]
     Returns tensor of size (B, n_basic, Ns), where B is the batch dimension and 
-    n_basic the number of basic cells per composite cell.
+    n_basic the number of basic cells per composite cell. The reductions are 
+    done in the compute type of PrecisionPolicy `precision`, the result is in
+    its storage type.
     """
-    Ms = LogSinkhornGPU.geom_dims(muref)
-    Ns = LogSinkhornGPU.geom_dims(nuref)
-    B = LogSinkhornGPU.batch_dim(muref)
+    precision = get_precision_policy(precision, muref)
+    muref = precision.compute(muref)
+    alpha = precision.compute(alpha)
+    xs = tuple(precision.compute(xi) for xi in xs)
+    ys = tuple(precision.compute(yj) for yj in ys)
+    beta = precision.store(beta)
+    nuref = precision.store(nuref)
+    dim = len(xs)
+    backend = get_backend(muref, dim)
+    Ms = backend.geom_dims(muref)
+    Ns = backend.geom_dims(nuref)
+    B = backend.batch_dim(muref)
 
     if s is None:
         # Deduce cellsize
         s = Ms[0]//2
     # Get number of basic cells
-    b1, b2 = Ms[0]//s, Ms[1]//s
-    dim = len(xs)
-    assert dim == 2, "Not implemented for dimension rather than 2"
-    n_basic = b1*b2  # number of basic cells
+    basic_shape = tuple(M//s for M in Ms)
+    n_basic = int(np.prod(basic_shape))  # number of basic cells
 
     # Perform permutations and reshapes in X data to turn them
-    # into B*n_cells problems of size (s,s)
-    alpha_b = alpha.view(-1, b1, s, b2, s) \
-        .permute((0, 1, 3, 2, 4)).reshape(-1, s, s)
-    mu_b = muref.view(-1, b1, s, b2, s) \
-        .permute((0, 1, 3, 2, 4)).reshape(-1, s, s)
-    new_Ms = (s, s)
-    logmu_b = LogSinkhornGPU.log_dens(mu_b)
-
-    x1, x2 = xs
-    x1_b = torch.repeat_interleave(x1.view(-1, b1, s, 1), b2, dim=3)
-    x1_b = x1_b.permute((0, 1, 3, 2)).reshape(-1, s)
-    x2_b = torch.repeat_interleave(x2.view(-1, 1, b2, s), b1, dim=1)
-    x2_b = x2_b.reshape(-1, s)
-    xs_b = (x1_b, x2_b)
+    # into B*n_cells problems of size (s, ..., s)
+    permutation = (0, *range(1, 2*dim, 2), *range(2, 2*dim+1, 2))
+    alpha_b = alpha.view(-1, *get_children_shape(basic_shape, s)) \
+        .permute(permutation).reshape(-1, *[s]*dim)
+    mu_b = muref.view(-1, *get_children_shape(basic_shape, s)) \
+        .permute(permutation).reshape(-1, *[s]*dim)
+    new_Ms = (s,)*dim
+    logmu_b = backend.log_dens(mu_b)
+
+    # Coordinates along axis k only depend on the k-th index of the basic cell
+    xs_b = []
+    for (k, xk) in enumerate(xs):
+        view = [-1] + [1]*dim + [s]
+        view[k+1] = basic_shape[k]
+        xs_b.append(xk.view(view).expand(-1, *basic_shape, s).reshape(-1, s))
+    xs_b = tuple(xs_b)
 
     # Duplicate Y data to match X data
-    y1, y2 = ys
-    y1_b = torch.repeat_interleave(y1, n_basic, dim=0)
-    y2_b = torch.repeat_interleave(y2, n_basic, dim=0)
-    xs_b = (x1_b, x2_b)
-    ys_b = (y1_b, y2_b)
+    ys_b = tuple(torch.repeat_interleave(yk, n_basic, dim=0) for yk in ys)
+
+    if not muref.is_cuda:
+        # On CPU, perform the reduction with separable per-axis kernels
+        # in absolute coordinates, see DomDec.logSumExpSeparable
+        h = (alpha_b / eps + logmu_b).numpy()
+        log_kernels = [
+            -(yj[:, :, None] - xi[:, None, :]).numpy()**2 / eps
+            for (xi, yj) in zip(xs_b, ys_b)
+        ]
+        beta_hat = torch.from_numpy(DomDec.logSumExpSeparable(h, log_kernels))
+        beta_hat = precision.store(beta_hat).view(-1, n_basic, *Ns)
+        beta_hat += beta[:, None]/eps
+        muY_basic = beta_hat
+        torch.exp(beta_hat, out=muY_basic)
+        muY_basic *= nuref[:, None]
+        return muY_basic
 
     # Perform a reduction to get a second dual for each basic cell
     dxs = torch.tensor(np.array([get_dx(xi, xi.shape[0]) for xi in xs_b]))
     dys = torch.tensor(np.array([get_dx(yj, yj.shape[0]) for yj in ys_b]))
 
-    offsetX, offsetY, offset_const = LogSinkhornGPU.compute_offsets_sinkhorn_grid(
+    offsetX, offsetY, offset_const = backend.compute_offsets_sinkhorn_grid(
         xs_b, ys_b, eps)
     h = alpha_b / eps + logmu_b + offsetX
 
@@ -321,9 +709,11 @@ def get_cell_marginals(muref, nuref, alpha, beta, xs, ys, eps, s = None):
     # )
     # Memory friendly implementation
 
-    beta_hat = LogSinkhornGPU.softmin_cuda_image(h, Ns, new_Ms, eps, dys, dxs)
-    beta_hat += (offsetY + offset_const)
-    beta_hat = beta_hat.view(-1, n_basic, *Ns)
+    beta_hat = backend.softmin_cuda_image(h, Ns, new_Ms, eps, dys, dxs)
+    # Add offsets one after another to not allocate their sum
+    beta_hat += offsetY
+    beta_hat += offset_const
+    beta_hat = precision.store(beta_hat).view(-1, n_basic, *Ns)
     beta_hat += beta[:,None]/eps 
     muY_basic = beta_hat
     torch.exp(beta_hat, out = muY_basic)
@@ -334,18 +724,23 @@ def get_cell_marginals(muref, nuref, alpha, beta, xs, ys, eps, s = None):
 def BatchSolveOnCell_CUDA(
     muXCell, muYCell, posX, posY, eps, alphaInit, muYref,
     SinkhornError=1E-4, SinkhornErrorRel=False, YThresh=1E-14, verbose=True,
-    SinkhornMaxIter=10000, SinkhornInnerIter=10
+    SinkhornMaxIter=10000, SinkhornInnerIter=10, precision=None
 ):
     """
     Solve cell problems. Return optimal potentials and new basic cell 
-    marginals.
+    marginals. The solver runs in the compute type of `precision`, the 
+    potentials and marginals are returned in its storage type.
     """
+    precision = get_precision_policy(precision, muXCell)
+    muXCell, muYCell, alphaInit, muYref = (
+        precision.compute(x) for x in (muXCell, muYCell, alphaInit, muYref))
+    posX = tuple(precision.compute(xi) for xi in posX)
+    posY = tuple(precision.compute(yj) for yj in posY)
 
     # Retrieve BatchSize
     # TODO: clean up
     B = muXCell.shape[0]
     dim = len(posX)
-    assert dim == 2, "Not implemented for dimension != 2"
 
     # Retrieve cellsize
     s = muXCell.shape[-1] // 2
@@ -353,7 +748,7 @@ def BatchSolveOnCell_CUDA(
     # Define cost for solver
     C = (posX, posY)
     # Solve problem
-    solver = LogSinkhornGPU.LogSinkhornCudaImageOffset(
+    solver = get_backend(muXCell, dim).LogSinkhornCudaImageOffset(
         muXCell, muYCell, C, eps, alpha_init=alphaInit, nuref=muYref,
         max_error=SinkhornError, max_error_rel=SinkhornErrorRel,
         max_iter=SinkhornMaxIter, inner_iter=SinkhornInnerIter
@@ -365,16 +760,18 @@ def BatchSolveOnCell_CUDA(
     beta = solver.beta
     # Compute cell marginals directly
     muY_basic = get_cell_marginals(
-        muXCell, muYref, alpha, beta, posX, posY, eps
+        muXCell, muYref, alpha, beta, posX, posY, eps, precision=precision
     )
 
     # Wrap solver and possibly runtime info into info dictionary
     info = {
         "solver": solver,
-        "msg": msg
+        "msg": msg,
+        # Coordinates and Y reference measure, e.g. for get_primal_infos
+        "problem": (posX, posY, muYref)
     }
 
-    return alpha, beta, muY_basic, info
+    return precision.store(alpha), precision.store(beta), muY_basic, info
 
 def get_alpha_field_gpu(alpha, shape, cellsize):
     """
@@ -383,22 +780,28 @@ def get_alpha_field_gpu(alpha, shape, cellsize):
     This new potential may feature big jumps between composite cells; these 
     will be smoothed out by `get_alpha_field_even_gpu`.
     """
-    # TODO: generalize to 3D
-    assert len(shape) == 2, "Not implemented for dimension rather than 2"
+    dim = len(shape)
     comp_shape = tuple(s // (2*cellsize) for s in shape)
-    alpha_field = alpha.view(*comp_shape, 2*cellsize, 2*cellsize) \
-                       .permute(0, 2, 1, 3).contiguous().view(shape)
+    # Interleave composite cell and position within composite cell axes
+    permutation = tuple(k for axis in range(dim) for k in (axis, dim+axis))
+    alpha_field = alpha.view(*comp_shape, *[2*cellsize]*dim) \
+                       .permute(permutation).contiguous().view(shape)
     return alpha_field
 
 
 def get_alpha_field_even_gpu(alphaA, alphaB, shapeXL, shapeXL_pad,
-                             cellsize, basic_shape, muX=None):
+                             cellsize, basic_shape, muX=None, shapeX=None):
     """
     Uses alphaA, alphaB and getAlphaGraph to compute a global dual potential.
+    If the layer was padded to whole composite cells, `shapeX` is its shape 
+    before padding. Only implemented in 2D, like `DomDec.getAlphaGraph`.
     """
-    # TODO: generalize to 3D
     dim = len(alphaA.shape)-1
-    assert dim == 2, "Not implemented for dimension rather than 2"
+    if dim != 2:
+        raise NotImplementedError(
+            f"alpha stitching is only implemented in 2D, got dimension {dim}; "
+            "start each layer from zero potentials instead, as in "
+            "examples/example-domdec-gpu-3d.py")
     # Glue alpha batched cell potentials to form two global potentials.
     alphaA_field = get_alpha_field_gpu(alphaA, shapeXL, cellsize)
     alphaB_field = get_alpha_field_gpu(alphaB, shapeXL_pad, cellsize)
@@ -406,7 +809,27 @@ def get_alpha_field_even_gpu(alphaA, alphaB, shapeXL, shapeXL_pad,
     # Remove padding
     alphaB_field = alphaB_field[cellsize:-cellsize, cellsize:-cellsize]
     # Compute vertical differences
-    alphaDiff = (alphaA_field-alphaB_field).cpu().numpy().ravel()
+    alphaDiff = (alphaA_field-alphaB_field).cpu().numpy()
+    if shapeX is not None:
+        # Basic cells entirely in the padding carry no mass, so alphaA and 
+        # alphaB need not differ by a constant there. They can only be the
+        # last row or column of basic cells; copy the neighbouring basic cell
+        # of the same composite cell instead.
+        if muX is not None:
+            muX = muX.reshape(shapeXL).copy()
+        for (axis, n) in enumerate(shapeX):
+            b = -(-n // cellsize)
+            if b < basic_shape[axis]:
+                src = [slice(None)]*dim
+                dst = [slice(None)]*dim
+                src[axis] = slice((b-1)*cellsize, b*cellsize)
+                dst[axis] = slice(b*cellsize, (b+1)*cellsize)
+                alphaDiff[tuple(dst)] = alphaDiff[tuple(src)]
+                if muX is not None:
+                    muX[tuple(dst)] = muX[tuple(src)]
+        if muX is not None:
+            muX = muX.ravel()
+    alphaDiff = alphaDiff.ravel()
     # Solve helmholtz problem
     alphaGraph = DomDec.getAlphaGraph(
         alphaDiff, basic_shape, cellsize, muX
@@ -424,30 +847,66 @@ def get_alpha_field_even_gpu(alphaA, alphaB, shapeXL, shapeXL_pad,
 
     return alphaFieldEven
 
-def CUDA_balance(muXCell, muY_basic):
+def CUDA_balance(muXCell, muY_basic, precision=None):
     """
     Transfer mass between basic cells inside a composite cell until basic 
-    masses are correct. CUDA implementation.
+    masses are correct. CUDA implementation. Masses are summed in the compute
+    type of `precision`.
     """
-    B, M, _ = muXCell.shape
-    s = M//2
-    atomic_mass = muXCell.view(B, 2, s, 2, s).sum(dim=(2, 4))
+    precision = get_precision_policy(precision, muY_basic)
+    B = muXCell.shape[0]
+    dim = muXCell.dim() - 1
+    s = muXCell.shape[-1]//2
+    atomic_mass = muXCell.view(B, *get_children_shape([2]*dim, s)) \
+        .sum(dim=tuple(range(2, 2*dim+1, 2)), dtype=precision.compute_dtype)
     atomic_mass = atomic_mass.view(B, -1)
     muY_basic_shape = muY_basic.shape
-    muY_basic = muY_basic.view(B, 4, -1)
-    atomic_mass_nu = muY_basic.sum(-1)
-    mass_delta = atomic_mass_nu - atomic_mass
+    muY_basic = muY_basic.view(B, 2**dim, -1)
+    atomic_mass_nu = muY_basic.sum(-1, dtype=precision.compute_dtype)
+    mass_delta = (atomic_mass_nu - atomic_mass).to(muY_basic.dtype)
     # print(f"balancing with {muY_basic.dtype}")
     threshold = torch.tensor(1e-12)
-    # Call LogSinkhornGPU backend function 
-    LogSinkhornGPU.backend.BalanceCUDA(muY_basic, mass_delta, threshold)
+    # Call backend function 
+    get_backend(muY_basic, dim).backend.BalanceCUDA(muY_basic, mass_delta, 
+                                                    threshold)
     return muY_basic.view(*muY_basic_shape)
 
 ###############################################
 # transform basic cell utilities
 ###############################################
 
-def get_axis_bounds(muY_basic, global_minus, axis, sum_indices):
+def add_with_offsets(nu_basic, shape, weights, sum_indices,
+                     relative_basic_minus, basic_minus, basic_extent):
+    """
+    AddWithOffsetsCUDA_2D of the backend for any dimension: boxes of the basic
+    cells are added to C = sum_indices.shape[0] composite cells of shape 
+    `shape`. `relative_basic_minus`, `basic_minus` and `basic_extent` hold 
+    one tensor of the shape of `sum_indices` for each axis.
+    """
+    dim = len(shape)
+    if dim == 2:
+        return get_backend(nu_basic).backend.AddWithOffsetsCUDA_2D(
+            nu_basic, *shape, weights, sum_indices,
+            relative_basic_minus[0], basic_minus[0], basic_extent[0],
+            relative_basic_minus[1], basic_minus[1], basic_extent[1])
+    return get_backend(nu_basic, dim).backend.AddWithOffsetsCUDA_ND(
+        nu_basic, shape, weights, sum_indices,
+        relative_basic_minus, basic_minus, basic_extent)
+
+def add_with_offsets_output_side(nu_basic, shape, weights, sum_indices,
+                                 offsets_comp, offsets_basic):
+    """
+    AddWithOffsetsCUDA_2D_OutputSide of the backend for any dimension.
+    """
+    dim = len(shape)
+    if dim == 2:
+        return get_backend(nu_basic).backend.AddWithOffsetsCUDA_2D_OutputSide(
+            nu_basic, *shape, weights, sum_indices, offsets_comp, 
+            offsets_basic)
+    return get_backend(nu_basic, dim).backend.AddWithOffsetsCUDA_ND_OutputSide(
+        nu_basic, shape, weights, sum_indices, offsets_comp, offsets_basic)
+
+def get_axis_bounds(muY_basic, global_minus, axis, sum_indices, workspace=None):
     """
     Get relative extents of the bounding box that would result from combining
     the basic cells in muY_basic according to sum_indices.
@@ -462,20 +921,25 @@ def get_axis_bounds(muY_basic, global_minus, axis, sum_indices):
         axis along which the extents are to be computed
     sum_indices : torch.Tensor
         Each row contains the indices of muY_basic that are to be aggregated.
+    workspace : Workspace, optional
+        Buffers to reuse.
     """
     B = muY_basic.shape[0]
     geom_shape = muY_basic.shape[1:]
     n = geom_shape[axis]
     # Put in the position of every point with mass its index along axis
     index_axis = torch.arange(n, device=muY_basic.device, dtype=torch.int32)
-    axis_sum = 2 if axis == 0 else 1 # TODO: generalize for higher dim
+    # Sum over all other geometric axes
+    axis_sum = tuple(k+1 for k in range(len(geom_shape)) if k != axis)
     mask = muY_basic.sum(axis_sum) > 0
     mask_index = mask * index_axis.view(1, -1) # mask_index has shape (B, -1)
     # Get positive extreme
     basic_plus = mask_index.amax(-1)
     # Turn zeros to upper bound so that we can get the minimum
     mask_index[~mask] = n
-    basic_minus = mask_index.amin(-1)
+    # Cells without mass (e.g. basic cells in the padding of a layer) get the
+    # bounds of their first entry
+    basic_minus = torch.minimum(mask_index.amin(-1), basic_plus)
     basic_extent = basic_plus - basic_minus + 1
     # Add global offsets
     global_basic_minus = global_minus + basic_minus
@@ -486,7 +950,10 @@ def get_axis_bounds(muY_basic, global_minus, axis, sum_indices):
     # obtain the same (i.e., an array `sum_indices` without -1's), we are not 
     # able to remove the overhead. 
     # Remove -1's in sum_indices
-    sum_indices_clean = sum_indices.clone().long()
+    sum_indices_clean = get_buffer(workspace, "sum_indices_clean",
+                                   sum_indices.shape, torch.int64,
+                                   sum_indices.device)
+    sum_indices_clean.copy_(sum_indices)
     idx, idy = torch.where(sum_indices_clean < 0)
     # Each composite cell comes at least from one basic
     sum_indices_clean[idx, idy] = sum_indices_clean[idx, 0]
@@ -508,30 +975,33 @@ def get_axis_bounds(muY_basic, global_minus, axis, sum_indices):
             global_composite_minus, max_composite_extent)
 
 
-def combine_cells(muY_basic_box, sum_indices, weights=1):
+def combine_cells(muY_basic_box, sum_indices, weights=1, workspace=None):
     """
     Combine basic cells in muY_basic, taking into account their global boundaries 
     to yield Nu_comp. Nu_comp[j] is the result of combining all the cells with 
     indices in sum_indices[j], each multiplied by its corresponding weight in
-    weights[j].
+    weights[j]. Temporary tensors are taken from `workspace` if given.
+    `muY_basic_box` can also be a RaggedBoundingBox, see combine_ragged_cells.
     """
+    if isinstance(muY_basic_box, RaggedBoundingBox):
+        return combine_ragged_cells(muY_basic_box, sum_indices, weights,
+                                    workspace)
     muY_basic = muY_basic_box.data
     shapeY = muY_basic_box.global_shape
-    global_left = muY_basic_box.offsets[:,0]
-    global_bottom = muY_basic_box.offsets[:,1]
 
     if type(weights) in [int, float]:
-        torch_options = muY_basic_box.options
-        weights = torch.full(sum_indices.shape, weights, **torch_options)
-
-    # Get bounding box parameters
-    relative_basic_left, basic_left, basic_width, \
-        global_composite_left, composite_width = \
-        get_axis_bounds(muY_basic, global_left, 0, sum_indices)
-
-    relative_basic_bottom, basic_bottom, basic_height, \
-        global_composite_bottom, composite_height = \
-        get_axis_bounds(muY_basic, global_bottom, 1, sum_indices)
+        weights = get_buffer(workspace, "combine_weights", sum_indices.shape,
+                             **muY_basic_box.options).fill_(weights)
+
+    # Get bounding box parameters, one axis at a time
+    global_composite_minus = []
+    composite_shape = []
+    for axis in range(muY_basic_box.dim):
+        _, _, _, global_composite_minus_axis, composite_extent = \
+            get_axis_bounds(muY_basic, muY_basic_box.offsets[:,axis], axis,
+                            sum_indices, workspace)
+        global_composite_minus.append(global_composite_minus_axis)
+        composite_shape.append(composite_extent)
 
     # Previous version
     # Nu_comp = LogSinkhornGPU.backend.AddWithOffsetsCUDA_2D(
@@ -547,11 +1017,10 @@ def combine_cells(muY_basic_box, sum_indices, weights=1):
 
     # New version, output side
 
-    offsets_comp = combine_offsets(
-        global_composite_left, global_composite_bottom)
+    offsets_comp = combine_offsets(*global_composite_minus)
     
-    Nu_comp = LogSinkhornGPU.backend.AddWithOffsetsCUDA_2D_OutputSide(
-        muY_basic, composite_width, composite_height,
+    Nu_comp = add_with_offsets_output_side(
+        muY_basic, composite_shape,
         weights, sum_indices,
         offsets_comp, muY_basic_box.offsets
     )
@@ -568,80 +1037,192 @@ def combine_cells(muY_basic_box, sum_indices, weights=1):
 
     return muYCell_box
 
-def slide_marginals_to_corner(muY_basic_box):
+def combine_ragged_cells(muY_basic_box, sum_indices, weights=1,
+                         workspace=None):
+    """
+    Version of combine_cells for a RaggedBoundingBox `muY_basic_box`. Only 
+    the positive entries of the basic cells are scattered into the composite
+    cells, which are returned as BoundingBox.
+    """
+    Bc, C = sum_indices.shape
+    options_int = dict(device=sum_indices.device, dtype=torch.int64)
+    # Remove -1's, giving them zero weight
+    sum_indices_clean = sum_indices.long()
+    mask_ind = sum_indices_clean < 0
+    sum_indices_clean = torch.where(mask_ind, sum_indices_clean[:, :1],
+                                    sum_indices_clean)
+    if type(weights) in [int, float]:
+        weights = torch.full((Bc, C), weights, **muY_basic_box.options)
+    weights = weights.masked_fill(mask_ind, 0)
+
+    # Bounding box of each composite cell, only from the basic cells in 
+    # `sum_indices` so that the cost does not grow with the whole store
+    basic_cells, inverse = torch.unique(sum_indices_clean, return_inverse=True)
+    minus, plus = get_ragged_bounds(muY_basic_box, basic_cells)
+    offsets = muY_basic_box.offsets.long()
+    global_composite_minus = (offsets[basic_cells] + minus)[inverse].amin(1)
+    global_composite_plus = (offsets[basic_cells] + plus)[inverse].amax(1)
+    box_shape = (global_composite_plus - global_composite_minus + 1) \
+        .amax(0).tolist()
+
+    # Scatter entries into their composite cell
+    cells = sum_indices_clean.view(-1)
+    entry_index, flat_index, coords = \
+        get_ragged_entries(muY_basic_box, cells)
+    values = muY_basic_box.data[flat_index] * weights.view(-1)[entry_index]
+    mask = muY_basic_box.data[flat_index] > 0
+    composite = entry_index[mask] // C
+    coords = offsets[cells[entry_index[mask]]] + coords[mask] \
+        - global_composite_minus[composite]
+    index = composite
+    for (n, coord) in zip(box_shape, coords.unbind(-1)):
+        index = index * n + coord
+    Nu_comp = get_buffer(workspace, "combine_ragged", (Bc, *box_shape),
+                         **muY_basic_box.options).zero_()
+    Nu_comp.view(-1).index_add_(0, index, values[mask])
+    offsets_comp = global_composite_minus.to(muY_basic_box.offsets.dtype)
+    return BoundingBox(Nu_comp, offsets_comp, muY_basic_box.global_shape)
+
+def slide_ragged_to_corner(muY_basic_box, workspace=None):
+    """
+    Version of slide_marginals_to_corner for a RaggedBoundingBox: trim every
+    box to the bounds of its positive entries.
+    """
+    minus, plus = get_ragged_bounds(muY_basic_box)
+    shapes = plus - minus + 1
+    entry_index, flat_index, coords = get_ragged_entries(muY_basic_box)
+    values = muY_basic_box.data[flat_index]
+    mask = values > 0
+    entry_index = entry_index[mask]
+    # Row-major strides and starts of the trimmed boxes
+    strides = get_row_major_strides(shapes)
+    sizes = shapes.prod(-1)
+    starts = torch.cumsum(sizes, 0) - sizes
+    size = int(sizes.sum().item())
+    data = get_buffer(workspace, "slide_ragged", (size,),
+                      **muY_basic_box.options).zero_()
+    coords = coords[mask] - minus[entry_index]
+    index = starts[entry_index] + (coords * strides[entry_index]).sum(-1)
+    data[index] = values[mask]
+    offsets = muY_basic_box.offsets + minus.to(muY_basic_box.offsets.dtype)
+    return RaggedBoundingBox(data, starts, shapes, strides, offsets,
+                             muY_basic_box.global_shape)
+
+def slide_marginals_to_corner(muY_basic_box, workspace=None):
     """
     Get smallest possible bounding box by sliding cell marginals to the 
     bottom-left corner and trimming excess space.
     """
+    if isinstance(muY_basic_box, RaggedBoundingBox):
+        return slide_ragged_to_corner(muY_basic_box, workspace)
     
     B = muY_basic_box.B
-    torch_options_int = muY_basic_box.options_int
-    sum_indices = torch.arange(B, **torch_options_int).view(-1, 1)
-    return combine_cells(muY_basic_box, sum_indices)
+    sum_indices = get_buffer(workspace, "slide_sum_indices", (B,),
+                             **muY_basic_box.options_int)
+    torch.arange(B, out=sum_indices)
+    return combine_cells(muY_basic_box, sum_indices.view(-1, 1),
+                         workspace=workspace)
 
 
-def crop_measure_to_box(rho_composite_box, rho):
+def crop_measure_to_box(rho_composite_box, rho, workspace=None):
     """
     Get the reference measure rho in the same support as rho_composite
     """
-    # TODO: implement for 3D
-    assert rho_composite_box.dim == 2, "only implemented for 2D"
-
     torch_options = rho_composite_box.options
     torch_options_int = rho_composite_box.options_int
     rho_composite = rho_composite_box.data
-    global_left = rho_composite_box.offsets[:,0].clone()
-    global_bottom = rho_composite_box.offsets[:,1].clone()
 
     torch_options = dict(device=rho_composite.device,
                          dtype=rho_composite.dtype)
     torch_options_int = dict(device=rho_composite.device, dtype=torch.int32)
 
-    B, w, h = rho_composite.shape
+    B = rho_composite.shape[0]
+    box_shape = rho_composite.shape[1:]
     # mask = rho_composite > 0
     sum_indices_comp = torch.arange(B, **torch_options_int).view(-1, 1)
 
-    _, relative_left, comp_width, _, _ = \
-        get_axis_bounds(rho_composite, global_left, 0, sum_indices_comp)
-
-    _, relative_bottom, comp_height, _, _ = \
-        get_axis_bounds(rho_composite,
-                        global_bottom, 1, sum_indices_comp)
-
-    # Reshape indices for AddWithOffsets
-    global_left = global_left.view(-1, 1) + relative_left
-    global_bottom = global_bottom.view(-1, 1) + relative_bottom
-    comp_width = comp_width.view(-1, 1)
-    comp_height = comp_height.view(-1, 1)
+    # Bounds along each axis, reshaped for AddWithOffsets
+    relative_minus = []
+    global_minus = []
+    comp_extent = []
+    for axis in range(rho_composite_box.dim):
+        global_minus_axis = rho_composite_box.offsets[:,axis].clone()
+        _, relative_minus_axis, comp_extent_axis, _, _ = \
+            get_axis_bounds(rho_composite, global_minus_axis, axis,
+                            sum_indices_comp)
+        relative_minus.append(relative_minus_axis)
+        global_minus.append(global_minus_axis.view(-1, 1) 
+                            + relative_minus_axis)
+        comp_extent.append(comp_extent_axis.view(-1, 1))
 
     # relative_left = relative_bottom = torch.zeros((B, 1), **torch_options_int)
-    sum_indices_rho = torch.zeros((B, 1), **torch_options_int)
-    weights = torch.ones((B, 1), **torch_options)
+    sum_indices_rho = get_buffer(workspace, "crop_sum_indices", (B, 1),
+                                 **torch_options_int).fill_(0)
+    weights = get_buffer(workspace, "crop_weights", (B, 1),
+                         **torch_options).fill_(1)
 
-    reference_rho = LogSinkhornGPU.backend.AddWithOffsetsCUDA_2D(
-        rho.view(1, *rho.shape), w, h,
+    reference_rho = add_with_offsets(
+        rho.view(1, *rho.shape), box_shape,
         weights, sum_indices_rho,
-        relative_left, global_left, comp_width,
-        relative_bottom, global_bottom, comp_height
+        relative_minus, global_minus, comp_extent
     )
 
     return reference_rho
 
+def get_children_shape(shape, n_children=2):
+    """
+    Shape (n_1, 2, n_2, 2, ...) that splits the axes of a grid of shape 
+    (2*n_1, 2*n_2, ...) into coarse points and their children. With 
+    `n_children` = 1 it gives the shape of the coarse grid that broadcasts
+    against it.
+    """
+    return tuple(k for n in shape for k in (n, n_children))
+
 def refine_marginals_CUDA(muY_basic_box, basic_mass_coarse, basic_mass_fine, 
-                          nu_coarse, nu_fine):
+                          nu_coarse, nu_fine, precision=None):
     """
     Refine the cell Y-marginals given in the bounding box structure 
-    `muY_basic_box` to match the new, fine X and Y marginals.
+    `muY_basic_box` to match the new, fine X and Y marginals. A 
+    RaggedBoundingBox is refined into a RaggedBoundingBox. The refinement 
+    weights are applied in the compute type of PrecisionPolicy `precision`, 
+    the refined marginals are returned in its storage type.
+
+    The fine layers may be smaller than twice the coarse ones, as produced by 
+    get_multiscale_layers for non-dyadic shapes and by padding every layer 
+    to whole composite cells. Then the marginals are refined to twice the 
+    coarse shapes and the basic cells outside `basic_mass_fine` are dropped.
     """
+    precision = get_precision_policy(precision, muY_basic_box.data)
+    basic_mass_coarse, basic_mass_fine, nu_coarse, nu_fine = (
+        precision.compute(x) 
+        for x in (basic_mass_coarse, basic_mass_fine, nu_coarse, nu_fine))
+    shapeY = tuple(nu_fine.shape)
+    basic_shape_fine = tuple(basic_mass_fine.shape)
+    nu_fine = pad_to_shape(nu_fine, [2*n for n in nu_coarse.shape])
+    basic_mass_fine = pad_to_shape(
+        basic_mass_fine, [2*n for n in basic_mass_coarse.shape])
+    if isinstance(muY_basic_box, RaggedBoundingBox):
+        muY_basic_refine_box = refine_ragged_marginals(
+            muY_basic_box, basic_mass_coarse, basic_mass_fine, nu_coarse, 
+            nu_fine, precision)
+        return crop_refined_marginals(muY_basic_refine_box, 
+                                      basic_mass_fine.shape, 
+                                      basic_shape_fine, shapeY)
 
     # Slide marginals to the corner
     muY_basic_box = slide_marginals_to_corner(muY_basic_box)
+    muY_basic_box = BoundingBox(precision.compute(muY_basic_box.data),
+                                muY_basic_box.offsets, 
+                                muY_basic_box.global_shape)
 
     # Y marginals
-    # Get refinement weights for each Y point
-    s1, s2 = nu_coarse.shape
-    refinement_weights_Y = nu_fine.view(s1, 2, s2, 2).permute(1, 3, 0, 2) \
-        .reshape(-1, s1, s2) / nu_coarse[None, :, :]
+    # Get refinement weights for each Y point, of shape (2**dim, *shape)
+    # where the first axis enumerates the children of each coarse point
+    dim = muY_basic_box.dim
+    shape_coarse = nu_coarse.shape
+    refinement_weights_Y = nu_fine.view(get_children_shape(shape_coarse)) \
+        .permute(*range(1, 2*dim, 2), *range(0, 2*dim, 2)) \
+        .reshape(-1, *shape_coarse) / nu_coarse[None]
 
     B = muY_basic_box.B
     C = refinement_weights_Y.shape[0]
@@ -651,75 +1232,188 @@ def refine_marginals_CUDA(muY_basic_box, basic_mass_coarse, basic_mass_fine,
     # Get axes bounds
     muY_basic = muY_basic_box.data
     # mask = muY_basic > 0
-    global_left = muY_basic_box.offsets[:,0]
-    global_bottom = muY_basic_box.offsets[:,1]
     sum_indices_basic = torch.arange(B, **torch_options_int).view(-1, 1)
-
-    relative_basic_left, basic_left, basic_width, \
-        global_composite_left, w = \
-        get_axis_bounds(muY_basic, global_left, 0, sum_indices_basic)
-
-    relative_basic_bottom, basic_bottom, basic_height, \
-        global_composite_bottom, h = \
-        get_axis_bounds(muY_basic, global_bottom, 1, sum_indices_basic)
-
-    # Indices for refinement mask
+    basic_minus_refine = []
+    basic_extent_refine = []
+    box_shape = []
+    for axis in range(dim):
+        global_minus = muY_basic_box.offsets[:,axis]
+        _, _, basic_extent, _, n = \
+            get_axis_bounds(muY_basic, global_minus, axis, sum_indices_basic)
+        box_shape.append(n)
+        # Indices for refinement mask
+        basic_minus_refine.append(
+            torch.repeat_interleave(global_minus, C).view(-1, 1))
+        basic_extent_refine.append(
+            torch.repeat_interleave(basic_extent.ravel(), C).view(-1, 1))
 
     template_indices = torch.arange(C, **torch_options_int)
     sum_indices_refine = torch.tile(template_indices, (B,)).view(-1, 1)
-    basic_left_refine = torch.repeat_interleave(global_left, C).view(-1, 1)
-    basic_bottom_refine = torch.repeat_interleave(global_bottom, C).view(-1, 1)
-    basic_width_refine = torch.repeat_interleave(
-        basic_width.ravel(), C).view(-1, 1)
-    basic_height_refine = torch.repeat_interleave(
-        basic_height.ravel(), C).view(-1, 1)
-    relative_basic_left_refine = relative_basic_bottom_refine = torch.zeros(
-        (B*C, 1), **torch_options_int)
+    relative_basic_minus_refine = [torch.zeros(
+        (B*C, 1), **torch_options_int)] * dim
 
     weights = torch.ones((B*C, 1), **torch_options)
 
-    refinement_weights_Y_box = LogSinkhornGPU.backend.AddWithOffsetsCUDA_2D(
-        refinement_weights_Y, w, h,
+    refinement_weights_Y_box = add_with_offsets(
+        refinement_weights_Y, box_shape,
         weights, sum_indices_refine,
-        relative_basic_left_refine, basic_left_refine, basic_width_refine,
-        relative_basic_bottom_refine, basic_bottom_refine, basic_height_refine
+        relative_basic_minus_refine, basic_minus_refine, basic_extent_refine
     )
 
     # Refine nu basic by multiplying it with the refinement weights
-    muY_basic_refine_Y = refinement_weights_Y_box.view(B, C, w, h) 
-    muY_basic_refine_Y *= muY_basic.view(B, 1, w, h)
-    muY_basic_refine_Y = muY_basic_refine_Y.view(
-        B, 2, 2, w, h).permute(0, 3, 1, 4, 2).reshape(B, 2*w, 2*h)
+    muY_basic_refine_Y = refinement_weights_Y_box.view(B, C, *box_shape) 
+    muY_basic_refine_Y *= muY_basic.view(B, 1, *box_shape)
+    # Interleave every axis with the axis of its children
+    shape_refine = tuple(2*n for n in box_shape)
+    muY_basic_refine_Y = muY_basic_refine_Y.view(B, *[2]*dim, *box_shape) \
+        .permute(0, *(k for axis in range(1, dim+1) 
+                      for k in (dim+axis, axis))) \
+        .reshape(B, *shape_refine)
     
     # Refine muX
-    b1, b2 = basic_mass_coarse.shape
-    refinement_weights_X = basic_mass_fine.view(b1, 2, b2, 2) \
-        / basic_mass_coarse.view(b1, 1, b2, 1)
+    basic_shape = basic_mass_coarse.shape
+    refinement_weights_X = \
+        basic_mass_fine.view(get_children_shape(basic_shape)) \
+        / basic_mass_coarse.view(get_children_shape(basic_shape, 1))
     print(muY_basic_refine_Y.shape, refinement_weights_X.shape)
-    muY_basic_refine = muY_basic_refine_Y.view(b1, 1, b2, 1, 2*w, 2*h) \
-        * refinement_weights_X.view(b1, 2, b2, 2, 1, 1)
-    muY_basic_refine = muY_basic_refine.view(4*B, 2*w, 2*h)
-
-    # Refine left and bottom
-    expand = torch.ones((1, 2, 1, 2), **torch_options_int)
-    global_left_refine = 2*global_left.view(b1, 1, b2, 1) * expand
-    global_left_refine = global_left_refine.view(-1)
-    global_bottom_refine = 2*global_bottom.view(b1, 1, b2, 1) * expand
-    global_bottom_refine = global_bottom_refine.view(-1)
-
-    # Compose new bounding box
-    offsets = combine_offsets(global_left_refine, global_bottom_refine)
-    shapeY = nu_fine.shape
+    muY_basic_refine = \
+        muY_basic_refine_Y.view(*get_children_shape(basic_shape, 1), 
+                                *shape_refine) \
+        * refinement_weights_X.view(*refinement_weights_X.shape, 
+                                    *[1]*dim)
+    muY_basic_refine = muY_basic_refine.view(2**dim*B, *shape_refine)
+
+    # Refine offsets: children inherit twice the offset of their parent
+    expand = torch.ones(get_children_shape([1]*dim) + (1,), 
+                        **torch_options_int)
+    offsets = 2*muY_basic_box.offsets.view(
+        *get_children_shape(basic_shape, 1), dim) * expand
+    offsets = offsets.view(-1, dim)
 
     # print("shapeY", shapeY, "new offsets", offsets)
-    muY_basic_refine_box = BoundingBox(muY_basic_refine, offsets, shapeY)
+    muY_basic_refine_box = BoundingBox(precision.store(muY_basic_refine), 
+                                       offsets, nu_fine.shape)
 
-    return muY_basic_refine_box
+    return crop_refined_marginals(muY_basic_refine_box, basic_mass_fine.shape,
+                                  basic_shape_fine, shapeY)
+
+def crop_refined_marginals(muY_basic_box, refined_shape, basic_shape, shapeY):
+    """
+    Keep the cell marginals of the basic cells in the leading `basic_shape` 
+    block of the (row-major) basic grid of shape `refined_shape`, and set the
+    global shape to `shapeY`. Entries beyond shapeY must be zero.
+    """
+    refined_shape = tuple(refined_shape)
+    basic_shape = tuple(basic_shape)
+    shapeY = tuple(shapeY)
+    if refined_shape == basic_shape \
+            and tuple(muY_basic_box.global_shape) == shapeY:
+        return muY_basic_box
+    keep = torch.arange(int(np.prod(refined_shape)), 
+                        device=muY_basic_box.offsets.device) \
+        .view(refined_shape)[tuple(slice(0, b) for b in basic_shape)] \
+        .reshape(-1)
+    if isinstance(muY_basic_box, RaggedBoundingBox):
+        # Trimming drops the entries beyond shapeY, which carry no mass
+        return slide_ragged_to_corner(RaggedBoundingBox(
+            muY_basic_box.data, muY_basic_box.starts[keep], 
+            muY_basic_box.shapes[keep], muY_basic_box.strides[keep], 
+            muY_basic_box.offsets[keep], shapeY))
+    return BoundingBox(muY_basic_box.data[keep], muY_basic_box.offsets[keep],
+                       shapeY)
+
+def refine_ragged_marginals(muY_basic_box, basic_mass_coarse,
+                            basic_mass_fine, nu_coarse, nu_fine,
+                            precision=None):
+    """
+    Version of refine_marginals_CUDA for a RaggedBoundingBox, where every 
+    basic cell keeps its own box (of twice the size) after refinement.
+    """
+    precision = get_precision_policy(precision, muY_basic_box.data)
+    muY_basic_box = slide_ragged_to_corner(muY_basic_box)
+    dim = muY_basic_box.dim
+    shape_coarse = nu_coarse.shape
+    basic_shape = basic_mass_coarse.shape
+    B = muY_basic_box.B
+    device = muY_basic_box.offsets.device
+    offsets = muY_basic_box.offsets.long()
+    shapes = muY_basic_box.shapes
+    entry_index, flat_index, coords = get_ragged_entries(muY_basic_box)
+    values = precision.compute(muY_basic_box.data[flat_index])
+
+    # Refinement weights for each entry, of shape (n, 2, ..., 2)
+    y = tuple((offsets[entry_index] + coords).unbind(-1))
+    children = tuple(k for yk in y for k in (yk, slice(None)))
+    refinement_weights_Y = nu_fine.view(get_children_shape(shape_coarse)) \
+        [children] / nu_coarse[y].view(-1, *[1]*dim)
+    refinement_weights_X = \
+        basic_mass_fine.view(get_children_shape(basic_shape)) \
+        / basic_mass_coarse.view(get_children_shape(basic_shape, 1))
+    # Position of every basic cell on the basic grid
+    i = []
+    rest = entry_index
+    for b in reversed(basic_shape):
+        i.insert(0, rest % b)
+        rest = rest // b
+    refinement_weights_X = refinement_weights_X[
+        tuple(k for ik in i for k in (ik, slice(None)))]
+    # Refined values, indexed by (entry, x children, y children)
+    values_refine = values.view(-1, *[1]*(2*dim)) \
+        * refinement_weights_X.view(-1, *[2]*dim, *[1]*dim) \
+        * refinement_weights_Y.view(-1, *[1]*dim, *[2]*dim)
+
+    # Refined cells: child k of cell i is 2*i + k on the fine grid
+    k = torch.arange(2, device=device)
+    refine_index = torch.zeros((1,)*(2*dim), device=device, 
+                               dtype=torch.int64)
+    for (axis, b) in enumerate(basic_shape):
+        view = [1]*(2*dim)
+        view[axis] = b
+        view_k = [1]*(2*dim)
+        view_k[dim+axis] = 2
+        refine_index = refine_index*(2*b) \
+            + 2*torch.arange(b, device=device).view(view) + k.view(view_k)
+    refine_index = refine_index.reshape(B, *[2]*dim)
+    shapes_refine = torch.empty((2**dim*B, dim), device=device,
+                                dtype=torch.int64)
+    shapes_refine[refine_index.view(-1)] = \
+        (2*shapes).repeat_interleave(2**dim, dim=0)
+    strides_refine = get_row_major_strides(shapes_refine)
+    sizes = shapes_refine.prod(-1)
+    starts_refine = torch.cumsum(sizes, 0) - sizes
+    offsets_refine = torch.empty((2**dim*B, dim), **muY_basic_box.options_int)
+    offsets_refine[refine_index.view(-1)] = \
+        (2*muY_basic_box.offsets).repeat_interleave(2**dim, dim=0)
+
+    # Position of every refined value
+    cells = refine_index[entry_index].view(-1, *[2]*dim, *[1]*dim)
+    index = starts_refine[cells]
+    for axis in range(dim):
+        view_k = [1]*(2*dim+1)
+        view_k[dim+axis+1] = 2
+        x = (2*coords[:, axis]).view(-1, *[1]*(2*dim)) + k.view(view_k)
+        index = index + x*strides_refine[cells, axis]
+    data = torch.zeros(int(sizes.sum().item()), device=device,
+                       dtype=precision.storage_dtype)
+    data[index.view(-1)] = precision.store(values_refine).view(-1)
+    return RaggedBoundingBox(data, starts_refine, shapes_refine,
+                             strides_refine, offsets_refine, nu_fine.shape)
 
 def get_current_Y_marginal(muY_basic_box, shapeY, batchshape = None):
     """
     Aggregate cell Y marginals to obtain actual global Y marginal.
     """
+    if isinstance(muY_basic_box, RaggedBoundingBox):
+        # Scatter the entries directly into the global marginal
+        entry_index, flat_index, coords = get_ragged_entries(muY_basic_box)
+        coords = muY_basic_box.offsets.long()[entry_index] + coords
+        index = torch.zeros_like(entry_index)
+        for (n, coord) in zip(shapeY, coords.unbind(-1)):
+            index = index * n + coord
+        muY_sum = torch.zeros(tuple(shapeY), **muY_basic_box.options)
+        muY_sum.view(-1).index_add_(0, index,
+                                     muY_basic_box.data[flat_index])
+        return muY_sum
     B = muY_basic_box.B
     muY_basic = muY_basic_box.data
     torch_options_int = muY_basic_box.options_int
@@ -758,14 +1452,17 @@ def get_current_Y_marginal(muY_basic_box, shapeY, batchshape = None):
 
     # Try multiscale approach
     s = 8
-    if batchshape is None: 
-        b1 = b2 = int(np.sqrt(B)) // s
-    else: 
-        b1, b2 = batchshape[0]//s, batchshape[1]//s
-    if b1 == 0 or b2 == 0: # skip coarse step
+    if muY_basic_box.dim != 2:
+        batchshape = None
+    elif batchshape is None and int(np.sqrt(B))**2 == B: 
+        # Assume a square grid of basic cells
+        batchshape = (int(np.sqrt(B)),)*2
+    if batchshape is None or any(b == 0 or b % s != 0 for b in batchshape):
+        # skip coarse step
         s = 1
         muY_box_coarse = muY_basic_box
     else:
+        b1, b2 = batchshape[0]//s, batchshape[1]//s
         # Combine fine to coarse 8x8 clusters
         sum_indices_coarse = torch.arange(B, **torch_options_int).reshape(b1, s, b2, s) \
                     .permute(0, 2, 1, 3).reshape(-1, s*s)
@@ -773,28 +1470,183 @@ def get_current_Y_marginal(muY_basic_box, shapeY, batchshape = None):
     # Combine coarse to global
     sum_indices_global = torch.arange(B//(s*s), **torch_options_int).view(1, -1)
     weights = torch.ones((1, B//(s*s)), **torch_options)
-    offsets_comp = torch.zeros((1, 2), **torch_options_int)
-    muY_sum = LogSinkhornGPU.backend.AddWithOffsetsCUDA_2D_OutputSide(
-        muY_box_coarse.data, *shapeY, weights, sum_indices_global, 
+    offsets_comp = torch.zeros((1, muY_basic_box.dim), **torch_options_int)
+    muY_sum = add_with_offsets_output_side(
+        muY_box_coarse.data, tuple(shapeY), weights, sum_indices_global, 
         offsets_comp, muY_box_coarse.offsets
     )
 
     return muY_sum.squeeze()
 
-def get_multiscale_layers(muX, shapeX):
+def get_box_entries(box, indices=None):
+    """
+    Non-zero entries of the structures `indices` (all by default) of 
+    BoundingBox or RaggedBoundingBox `box`, as flat indices into the global 
+    shape and values. Entries outside the global shape are dropped.
     """
-    Get multiscale layers of tensor muX. Currently only works if shape is 
-    power of 2.
+    if isinstance(box, RaggedBoundingBox):
+        entry_index, flat_index, coords = get_ragged_entries(box, indices)
+        cells = entry_index if indices is None \
+            else indices.long()[entry_index]
+        values = box.data[flat_index]
+        coords = box.offsets.long()[cells] + coords
+        mask = values != 0
+        values, coords = values[mask], coords[mask]
+    else:
+        data, offsets = box.data, box.offsets
+        if indices is not None:
+            data, offsets = data[indices.long()], offsets[indices.long()]
+        mask = data != 0
+        values = data[mask]
+        position = mask.nonzero()
+        coords = offsets.long()[position[:, 0]] + position[:, 1:]
+    index = torch.zeros_like(values, dtype=torch.int64)
+    inside = torch.ones_like(values, dtype=torch.bool)
+    for (n, coord) in zip(box.global_shape, coords.unbind(-1)):
+        index = index * n + coord
+        inside &= (coord >= 0) & (coord < n)
+    return index[inside], values[inside]
+
+class YMarginalTracker:
+    """
+    Keeps the global Y marginal `PYpi` of the basic cell marginals across 
+    half-iterations, updating it by the change of the basic cells touched by
+    each batch, so that monitoring costs O(touched cells) instead of O(all
+    cells). If the global marginal `muY` is given, the L1 error `errorMargY`
+    and the penalty `margY_score` = lam*KL(PYpi, muY) (unbalanced transport)
+    are tracked the same way. Per-basic-cell score terms (e.g. the transport 
+    and X marginal scores of MiniBatchIterateUnbalanced) are kept in 
+    `basic_scores`, together with their sums in `totals`.
+
+    Since updates accumulate rounding errors, `resync` recomputes everything
+    from the basic cell marginals; `maybe_resync` does so every 
+    `resync_every` updates.
+    """
+
+    def __init__(self, muY_basic_box, shapeY, muY=None, lam=None,
+                 basic_scores=None, resync_every=100):
+        self.shapeY = tuple(shapeY)
+        self.muY = None if muY is None else muY.reshape(-1)
+        self.lam = lam
+        self.basic_scores = dict() if basic_scores is None \
+            else dict(basic_scores)
+        self.resync_every = resync_every
+        self.resync(muY_basic_box)
+
+    def resync(self, muY_basic_box):
+        """
+        Recompute everything from the basic cell marginals `muY_basic_box`.
+        """
+        self.PYpi = get_current_Y_marginal(muY_basic_box, self.shapeY) \
+            .reshape(self.shapeY).contiguous()
+        self.totals = {name: score.sum() 
+                       for (name, score) in self.basic_scores.items()}
+        if self.muY is not None:
+            PYpi = self.PYpi.view(-1)
+            self.errorMargY = torch.sum(torch.abs(PYpi - self.muY))
+            if self.lam is not None:
+                self.margY_score = self.lam * \
+                    get_backend(PYpi).KL(PYpi, self.muY)
+        self.n_updates = 0
+
+    def maybe_resync(self, muY_basic_box):
+        """
+        Resync if there were `resync_every` updates since the last one.
+        """
+        if self.n_updates >= self.resync_every:
+            self.resync(muY_basic_box)
+
+    def get_delta(self, old_box, new_box, old_indices=None,
+                  new_indices=None):
+        """
+        Change of PYpi when the basic cells `old_indices` of `old_box` are 
+        replaced by the cells `new_indices` of `new_box` (all by default), as
+        flat positions and the change at each of them.
+        """
+        index_old, values_old = get_box_entries(old_box, old_indices)
+        index_new, values_new = get_box_entries(new_box, new_indices)
+        positions, inverse = torch.unique(
+            torch.cat((index_old, index_new)), return_inverse=True)
+        delta = torch.zeros(positions.shape[0], dtype=self.PYpi.dtype,
+                            device=self.PYpi.device)
+        delta.index_add_(0, inverse, torch.cat((-values_old, values_new)))
+        return positions, delta
+
+    def _get_Y_terms(self, delta, theta):
+        # errorMargY and margY_score after applying `delta`
+        positions, values = delta
+        PYpi = self.PYpi.view(-1)[positions]
+        new_PYpi = (PYpi + theta * values).clamp(min=0)
+        muY = self.muY[positions]
+        errorMargY = self.errorMargY + torch.sum(
+            torch.abs(new_PYpi - muY) - torch.abs(PYpi - muY))
+        margY_score = None
+        if self.lam is not None:
+            KL = get_backend(PYpi).KL
+            margY_score = self.margY_score \
+                + self.lam * (KL(new_PYpi, muY) - KL(PYpi, muY))
+        return errorMargY, margY_score
+
+    def get_score_terms(self, delta=None, basic_idx=None, basic_scores=None,
+                        theta=1.0):
+        """
+        Sums of the basic score terms and `margY_score` (if tracked), as they
+        would be after `update` with the same arguments.
+        """
+        terms = dict(self.totals)
+        if basic_scores is not None:
+            for (name, score) in basic_scores.items():
+                terms[name] = terms[name] + score.sum() \
+                    - self.basic_scores[name][basic_idx].sum()
+        if self.lam is not None:
+            terms["margY"] = self.margY_score if delta is None \
+                else self._get_Y_terms(delta, theta)[1]
+        return terms
+
+    def update(self, delta, theta=1.0, basic_idx=None, basic_scores=None):
+        """
+        Apply `delta` (see get_delta), scaled by `theta`, and replace the 
+        basic score terms of cells `basic_idx` by `basic_scores`.
+        """
+        positions, values = delta
+        if self.muY is not None:
+            self.errorMargY, margY_score = self._get_Y_terms(delta, theta)
+            if self.lam is not None:
+                self.margY_score = margY_score
+        PYpi = self.PYpi.view(-1)
+        PYpi[positions] = (PYpi[positions] + theta * values).clamp(min=0)
+        if basic_scores is not None:
+            for (name, score) in basic_scores.items():
+                self.totals[name] = self.totals[name] + score.sum() \
+                    - self.basic_scores[name][basic_idx].sum()
+                self.basic_scores[name][basic_idx] = score
+        self.n_updates += 1
+
+def get_hierarchy_depth(shapeX):
     """
-    # TODO: Generalize for measures with sizes not powers of 2
-    assert len(shapeX) == 2, "only implemented for 2d tensors"
-    assert shapeX[0] == shapeX[1], "only implemented for square tensors"
-    muX_i = muX
-    depth_X = int(np.log2(shapeX[0]))
-    muX_layers = [muX]
-    for i in range(depth_X):
-        n = shapeX[0] // 2**(i+1)
-        muX_i = muX_i.view(n, 2, n, 2).sum((1, 3))
+    Number of coarsening steps until `shapeX` is reduced to a single point.
+    """
+    return int(np.ceil(np.log2(max(shapeX))))
+
+
+def get_multiscale_layers(muX, shapeX, depth=None):
+    """
+    Get multiscale layers of tensor muX, coarsest first. Each layer sums 
+    blocks of 2 points along every axis of the next finer one, so layer `l`
+    has shape `ceil(shapeX / 2**(depth - l))`. Axes of odd length are padded 
+    with zeros before coarsening, so shapeX need not be square or a power of 
+    2. `depth` defaults to get_hierarchy_depth(shapeX).
+    """
+    dim = len(shapeX)
+    if depth is None:
+        depth = get_hierarchy_depth(shapeX)
+    muX_i = muX.view(shapeX)
+    muX_layers = [muX_i]
+    for i in range(depth):
+        shape_i = tuple(-(-n // 2) for n in muX_i.shape)
+        muX_i = pad_to_shape(muX_i, [2*n for n in shape_i]) \
+            .view(get_children_shape(shape_i)) \
+            .sum(tuple(range(1, 2*dim, 2)))
         muX_layers.append(muX_i)
     muX_layers.reverse()
     return muX_layers
@@ -810,7 +1662,9 @@ def MiniBatchIterate(
     muY_basic_box, shapeY, partition,
     SinkhornError=1E-4, SinkhornErrorRel=False, SinkhornMaxIter=None,
     SinkhornInnerIter=100, batchsize=np.inf, clustering=False, N_clusters="smart",
-    balance = True
+    balance = True, workspace = None, clustering_method = "kmeans",
+    bucket_cache = None, streaming = False, memory_budget = np.inf,
+    precision = None, tracker = None
 ):
     """
     Perform a domain decomposition iteration on the composite cells given by 
@@ -822,10 +1676,37 @@ def MiniBatchIterate(
     `clustering` is `True`), or just making chunks of size `batchsize` (if it 
     this parameter is smaller than `np.inf`). `N_clusters` controls the number
     of clusters; it can also be set to "smart"; which adapts it to the 
-    resolution.
+    resolution. `clustering_method` is either "kmeans" (KMeans on the bounding
+    box extents) or "bucketing" (minimize the total padded area, see 
+    `get_minibatches_bucketing`). With bucketing the buckets of the previous
+    call are reused if a dictionary `bucket_cache` is given.
+
+    `muY_basic_box` can be a BoundingBox or a RaggedBoundingBox. With 
+    `streaming`, the results of each minibatch are appended to a 
+    RaggedBoundingBox as soon as it is finished, which is returned. `memory_budget` (in bytes, 
+    implies `streaming`) bounds the estimated memory of each minibatch, 
+    minibatches are split where necessary (see `split_minibatches`).
+
+    `precision` is a PrecisionPolicy (or its name) that sets the type in which
+    the returned marginals and `alphaJ` are stored, and in which the cell 
+    problems are solved. By default everything stays in the type of 
+    `muY_basic_box`. `validate_precision` compares a policy against float64.
+
+    If a YMarginalTracker `tracker` is given, it is updated with the change of 
+    the basic cells of each minibatch.
+
+    If a `workspace` is given, temporary tensors and the returned basic cell
+    marginals are stored in its buffers. The returned marginals alternate 
+    between two buffers, so they remain valid during the next call (where 
+    they are the input) but are overwritten by the call after that.
     """
 
-    torch_options = muY_basic_box.options
+    precision = get_precision_policy(precision, muY_basic_box.data)
+    torch_options = dict(device=muY_basic_box.data.device,
+                         dtype=precision.storage_dtype)
+    muY = precision.store(muY)
+    alphaJ = precision.store(alphaJ)
+    muY_basic_box = precision.store_box(muY_basic_box)
 
     t0 = time.perf_counter()
     N_problems = partition.shape[0]
@@ -837,8 +1718,14 @@ def MiniBatchIterate(
             print(f"N_clusters = {N_clusters}")
         else:
             N_clusters = min(N_clusters, N_problems)
-        minibatches = get_minibatches_clustering(muY_basic_box,
-                                                 partition, N_clusters)
+        if clustering_method == "kmeans":
+            minibatches = get_minibatches_clustering(muY_basic_box,
+                                                     partition, N_clusters)
+        elif clustering_method == "bucketing":
+            minibatches = get_minibatches_bucketing(muY_basic_box, partition,
+                                                    N_clusters, bucket_cache)
+        else:
+            raise ValueError(f"unknown clustering_method {clustering_method}")
     else:
         if batchsize == np.inf:
             batchsize = N_problems
@@ -851,14 +1738,38 @@ def MiniBatchIterate(
                          device=torch_options["device"], dtype=torch.int64)
             for i in range(N_batches)
         ]
+    streaming = streaming or memory_budget < np.inf
+    ragged_input = isinstance(muY_basic_box, RaggedBoundingBox)
+    if memory_budget < np.inf:
+        extents = get_composite_extents(muY_basic_box, partition)
+        itemsize = torch.finfo(torch_options["dtype"]).bits // 8
+        minibatches = split_minibatches(minibatches, extents, 
+                                        partition.shape[1], itemsize, 
+                                        memory_budget)
     time_clustering = time.perf_counter() - t0
     N_batches = len(minibatches)  # If some cluster was empty it was removed
 
     # Prepare for minibatch iterations
-    new_offsets = torch.zeros_like(muY_basic_box.offsets)
+    if workspace is not None:
+        slot = workspace.next_slot("muY_basic")
+    else:
+        slot = None
+    if streaming:
+        capacity = muY_basic_box.size if ragged_input else 0
+        muY_basic_ragged = RaggedBoundingBox.empty(
+            B, muY_basic_box.dim, shapeY, torch_options,
+            muY_basic_box.options_int, capacity, workspace, f"{slot}_ragged")
+        time_join_clusters = 0.0
+    else:
+        new_offsets = get_buffer(workspace, f"{slot}_offsets",
+                                 muY_basic_box.offsets.shape,
+                                 **muY_basic_box.options_int).zero_()
+    if tracker is not None:
+        tracker.maybe_resync(muY_basic_box)
+    time_tracker = 0.0
     batch_muY_basic_list = []
     info = None
-    dims_batch = np.zeros((N_batches, 2), dtype=np.int64)
+    dims_batch = np.zeros((N_batches, muY_basic_box.dim), dtype=np.int64)
     for (i, batch) in enumerate(minibatches):
         posXJ_batch = tuple(xi[batch] for xi in posXJ)
         alpha_batch, basic_idx_batch, muY_basic_box_batch, info_batch = \
@@ -867,56 +1778,209 @@ def MiniBatchIterate(
                 muXJ[batch], posXJ_batch, alphaJ[batch],
                 muY_basic_box, partition[batch],
                 SinkhornMaxIter, SinkhornInnerIter, 
-                balance = balance
+                balance = balance, workspace = workspace,
+                precision = precision
             )
         if info is None:
             info = info_batch
             info["solver"] = [info["solver"]]
             info["bounding_box"] =[info["bounding_box"]]
+            info["problem"] = [info["problem"]]
         else:
             for key in info_batch.keys():
                 if key[:4] == "time":
                     info[key] += info_batch[key]
             info["solver"].append(info_batch["solver"])
             info["bounding_box"].append(info_batch["bounding_box"])
+            info["problem"].append(info_batch["problem"])
+
+        if tracker is not None:
+            t0 = time.perf_counter()
+            delta = tracker.get_delta(muY_basic_box, muY_basic_box_batch,
+                                      old_indices=basic_idx_batch)
+            tracker.update(delta)
+            time_tracker += time.perf_counter() - t0
 
         # Slide marginals to corner to get the smallest bbox later
         t0 = time.perf_counter()
-        muY_basic_box_batch = slide_marginals_to_corner(muY_basic_box_batch)
+        muY_basic_box_batch = slide_marginals_to_corner(muY_basic_box_batch,
+                                                        workspace)
         info["time_bounding_box"] += time.perf_counter() - t0
 
         # Write results that are easy to overwrite
         # But do not modify previous tensors
         alphaJ[batch] = alpha_batch
+        if streaming:
+            # Store results right away, freeing the minibatch tensors
+            t0 = time.perf_counter()
+            muY_basic_ragged.append(basic_idx_batch, muY_basic_box_batch)
+            time_join_clusters += time.perf_counter() - t0
+            continue
         new_offsets[basic_idx_batch] = muY_basic_box_batch.offsets
         dims_batch[i, :] = muY_basic_box_batch.box_shape
 
         # Save basic cell marginals for combining them at the end
         batch_muY_basic_list.append((basic_idx_batch,muY_basic_box_batch.data))
     info["time_clustering"] = time_clustering
+    info["time_tracker"] = time_tracker
+    if streaming:
+        info["time_join_clusters"] = time_join_clusters
+        return alphaJ, muY_basic_ragged, info
     
     # Prepare combined bounding box
     t0 = time.perf_counter()
-    w, h = np.max(dims_batch, axis=0)
-    muY_basic = torch.zeros(B, w, h, **torch_options)
+    box_shape = tuple(np.max(dims_batch, axis=0))
+    muY_basic = get_buffer(workspace, slot, (B, *box_shape), **torch_options)
+    muY_basic.zero_()
     for (basic_idx, muY_batch), box in zip(batch_muY_basic_list, dims_batch):
-        w_i, h_i = box
-        muY_basic[basic_idx, :w_i, :h_i] = muY_batch
+        muY_basic[(basic_idx, *(slice(0, n) for n in box))] = muY_batch
     info["time_join_clusters"] = time.perf_counter() - t0
     # Create bounding box
     muY_basic_box = BoundingBox(muY_basic, new_offsets, shapeY)
     return alphaJ, muY_basic_box, info
 
+def get_X_marginal_error(info, eps):
+    """
+    L1 error of the X marginals of the cell problems solved in a 
+    MiniBatchIterate call, from its `info` dictionary.
+    """
+    error = 0.0
+    for solver in info["solver"]:
+        new_alpha = solver.get_new_alpha()
+        current_mu = solver.mu * torch.exp((solver.alpha - new_alpha)/eps)
+        error += torch.sum(torch.abs(solver.mu - current_mu)).item()
+    return error
+
+def get_primal_infos(info, eps, sample_fraction=None, generator=None):
+    """
+    Primal score, unregularized transport cost and X marginal error of the 
+    cell problems solved in a MiniBatchIterate call, from its `info` 
+    dictionary, as in DomDec.getPrimalInfos. The plans are never built: 
+    marginals and cost follow from separable logsumexp reductions (see 
+    LogSinkhornTorch.logsumexp_separable), one minibatch at a time.
+
+    With `sample_fraction`, only a random fraction of the problems of each
+    minibatch (drawn with torch.Generator `generator`) is evaluated and the 
+    sums are extrapolated, for cheap monitoring. The Y marginal error is not
+    included, it follows from the returned basic cell marginals with 
+    get_current_Y_marginal.
+    """
+    result = {"scorePrimal": 0.0, "scorePrimalUnreg": 0.0, "errorMargX": 0.0}
+    for solver, (posX, posY, nuref) in zip(info["solver"], info["problem"]):
+        alpha, beta, mu = solver.alpha, solver.beta, solver.mu
+        B = alpha.shape[0]
+        scale = 1.0
+        if sample_fraction is not None:
+            n = max(1, min(B, int(np.ceil(sample_fraction * B))))
+            index = torch.randperm(B, generator=generator)[:n] \
+                .to(alpha.device)
+            alpha, beta, mu, nuref = (x[index] 
+                                      for x in (alpha, beta, mu, nuref))
+            posX = tuple(xi[index] for xi in posX)
+            posY = tuple(yj[index] for yj in posY)
+            scale = B / n
+        hX = alpha / eps + LogSinkhornTorch.log_dens(mu)
+        hY = beta / eps + LogSinkhornTorch.log_dens(nuref)
+        log_kernels_XY = LogSinkhornTorch.get_log_kernels(posY, posX, eps)
+        log_kernels_YX = LogSinkhornTorch.get_log_kernels(posX, posY, eps)
+        margX = torch.exp(
+            hX + LogSinkhornTorch.logsumexp_separable(hY, log_kernels_XY))
+        margY = torch.exp(
+            hY + LogSinkhornTorch.logsumexp_separable(hX, log_kernels_YX))
+        # Transport cost: on axis k the kernel is multiplied by the cost 
+        # along that axis
+        cost = 0.0
+        for k in range(len(log_kernels_XY)):
+            log_kernels_k = list(log_kernels_XY)
+            log_kernels_k[k] = log_kernels_XY[k] \
+                + torch.log(-eps * log_kernels_XY[k])
+            cost += torch.sum(torch.exp(
+                hX + LogSinkhornTorch.logsumexp_separable(hY, log_kernels_k)
+            )).item()
+        score = torch.sum(margX * alpha) + torch.sum(margY * beta) \
+            - eps * torch.sum(margX)
+        result["scorePrimal"] += scale * score.item()
+        result["scorePrimalUnreg"] += scale * cost
+        result["errorMargX"] += scale * torch.sum(torch.abs(margX - mu)).item()
+    return result
+
+def validate_precision(precision, muY, posY, dxs_dys, eps,
+                       muXJ, posXJ, alphaJ, muY_basic_box, shapeY, partition,
+                       **kwargs):
+    """
+    Validate PrecisionPolicy `precision` against the float64 path: run one 
+    MiniBatchIterate with each policy from the same state (`kwargs` are 
+    passed on) and report the marginal errors. Inputs are not modified.
+
+    Returns
+    -------
+    report : dict
+        `errorMargX` and `errorMargY` are the L1 errors of the X and Y 
+        marginals with `precision`, `errorMargX_reference` and 
+        `errorMargY_reference` those of the float64 path. `diffMargY` is the 
+        L1 distance between both Y marginals and `diffAlpha` the maximal 
+        difference between both duals.
+    """
+    kwargs.pop("workspace", None)
+    policies = [("_reference", PrecisionPolicy.from_name("double")),
+                ("", get_precision_policy(precision, muY_basic_box.data))]
+    report = dict()
+    results = []
+    for (suffix, policy) in policies:
+        alpha, box, info = MiniBatchIterate(
+            muY, posY, dxs_dys, eps, muXJ, posXJ, alphaJ.clone(),
+            muY_basic_box, shapeY, partition, precision=policy, **kwargs)
+        current_muY = get_current_Y_marginal(box, shapeY).double()
+        report["errorMargX" + suffix] = get_X_marginal_error(info, eps)
+        report["errorMargY" + suffix] = torch.abs(
+            current_muY.ravel() - muY.double().ravel()).sum().item()
+        results.append((alpha.double(), current_muY))
+    (alpha_ref, muY_ref), (alpha, current_muY) = results
+    report["diffMargY"] = torch.abs(current_muY - muY_ref).sum().item()
+    report["diffAlpha"] = torch.abs(alpha - alpha_ref).max().item()
+    return report
+
+def estimate_problem_memory(box_shape, C, itemsize):
+    """
+    Rough estimate of the memory in bytes that MiniBatchDomDecIteration_CUDA 
+    needs per composite problem with a bounding box of shape `box_shape` and 
+    C basic cells: the dense basic cells of the input and output and the 
+    intermediate basic marginals, plus a few composite sized tensors in the 
+    solver.
+    """
+    return (3*C + 6) * int(np.prod(box_shape)) * itemsize
+
+def split_minibatches(minibatches, extents, C, itemsize, memory_budget):
+    """
+    Split `minibatches` into chunks whose estimated memory is at most 
+    `memory_budget`, where each problem is padded to the largest `extents` 
+    (one tensor per axis, see get_composite_extents) within its minibatch 
+    (see estimate_problem_memory). 
+    """
+    result = []
+    for batch in minibatches:
+        box_shape = [extent[batch].max().item() for extent in extents]
+        problem_memory = estimate_problem_memory(box_shape, C, itemsize)
+        size = max(1, int(memory_budget // problem_memory))
+        if size >= len(batch):
+            result.append(batch)
+        else:
+            result += list(torch.split(batch, size))
+    return result
+
 def MiniBatchDomDecIteration_CUDA(
         SinkhornError, SinkhornErrorRel, muY, posYCell, dxs_dys, eps, shapeY,
         # partitionDataCompCellIndices,
         muXCell, posXCell, alphaCell,
         muY_basic_box, partition,
-        SinkhornMaxIter, SinkhornInnerIter, balance=True):
+        SinkhornMaxIter, SinkhornInnerIter, balance=True, workspace=None,
+        precision=None):
 
     """
     Performs a GPU Sinkhorn iteration on the minibatch given by `partition`.
+    See PrecisionPolicy for `precision`.
     """
+    precision = get_precision_policy(precision, muY_basic_box.data)
     info = dict()
     # 1: compute composite cell marginals
     # Get basic shape size
@@ -927,13 +1991,12 @@ def MiniBatchDomDecIteration_CUDA(
 
     # Get composite marginals as well as new left and right
     muYCell_box = basic_to_composite_minibatch_CUDA_2D(
-        muY_basic_box, partition)
+        muY_basic_box, partition, workspace)
 
     # Get subMuY
-    subMuY = crop_measure_to_box(muYCell_box, muY)
+    subMuY = crop_measure_to_box(muYCell_box, muY, workspace)
     # 2. Get bounding box dimensions
-    w, h = muYCell_box.box_shape
-    info["bounding_box"] = (w, h)
+    info["bounding_box"] = tuple(muYCell_box.box_shape)
 
     # 3: get physical coordinates of bounding box for each batched problem
     posYCell = get_grid_cartesian_coordinates(
@@ -948,12 +2011,14 @@ def MiniBatchDomDecIteration_CUDA(
         BatchSolveOnCell_CUDA(  # TODO: solve balancing problems in BatchSolveOnCell_CUDA
             muXCell, muYCell_box.data, posXCell, posYCell, eps, alphaCell, subMuY,
             SinkhornError, SinkhornErrorRel, SinkhornMaxIter=SinkhornMaxIter,
-            SinkhornInnerIter=SinkhornInnerIter
+            SinkhornInnerIter=SinkhornInnerIter, precision=precision
         )
 
     # Renormalize muY_basic_batch
     # Here muY_basic_batch is still in form (ncomp, C, *geom_shape)
-    muY_basic_batch *= (muYCell_box.data / (muY_basic_batch.sum(dim=1) + 1e-40))[:, None, :, :]
+    mass_basic = muY_basic_batch.sum(dim=1, dtype=precision.compute_dtype)
+    muY_basic_batch *= precision.store(
+        muYCell_box.data / (mass_basic + 1e-40))[:, None]
     info["time_sinkhorn"] = time.perf_counter() - t0
 
     # NOTE: balancing needs muY_basic_batch in this precise shape. But for outputting
@@ -962,7 +2027,7 @@ def MiniBatchDomDecIteration_CUDA(
     # 5. CUDA balance
     t0 = time.perf_counter()
     if balance:
-        CUDA_balance(muXCell, muY_basic_batch)
+        CUDA_balance(muXCell, muY_basic_batch, precision)
     info["time_balance"] = time.perf_counter() - t0
 
     # 7. Truncate
@@ -973,8 +2038,8 @@ def MiniBatchDomDecIteration_CUDA(
 
     # Build bounding box for muY_basic_batch
     t0 = time.perf_counter()
-    B, C, w, h = muY_basic_batch.shape
-    muY_basic_batch = muY_basic_batch.view(B*C, w, h)
+    B, C = muY_basic_batch.shape[:2]
+    muY_basic_batch = muY_basic_batch.view(B*C, *muY_basic_batch.shape[2:])
     # Copy left and bottom for beta
     offsets_comp = muYCell_box.offsets.reshape(B, 1, -1)
     offsets_basic = (offsets_comp.expand(-1, C, -1)).reshape(B*C, -1)
@@ -994,14 +2059,17 @@ def MiniBatchDomDecIteration_CUDA(
     return resultAlpha, basic_indices, muY_basic_batch_box, info
 
 
-def basic_to_composite_minibatch_CUDA_2D(muY_basic_box, partition):
+def basic_to_composite_minibatch_CUDA_2D(muY_basic_box, partition,
+                                         workspace=None):
     """
     Combines basic cells into composite cells according to the minibatch
     specified by `partition`.
     """
     # muY_basic is of shape (B, s1, ..., sd)
     B, C = partition.shape
-    sum_indices = partition.clone()
+    sum_indices = get_buffer(workspace, "partition_sum_indices",
+                             partition.shape, partition.dtype, partition.device)
+    sum_indices.copy_(partition)
     # There may be -1's in the first position, which `combine_cells` doesn't like
     # To avoid that we set them to whatever the max is in that slice and
     # set the weight to zero
@@ -1010,9 +2078,10 @@ def basic_to_composite_minibatch_CUDA_2D(muY_basic_box, partition):
     mask = sum_indices < 0
     sum_indices[mask] = max_slices[mask]
 
-    weights = torch.ones(sum_indices.shape, **muY_basic_box.options)
+    weights = get_buffer(workspace, "partition_weights", sum_indices.shape,
+                         **muY_basic_box.options).fill_(1.0)
     weights[mask] = 0.0
-    return combine_cells(muY_basic_box, sum_indices, weights)
+    return combine_cells(muY_basic_box, sum_indices, weights, workspace)
 
 
 
@@ -1020,7 +2089,6 @@ def basic_to_composite_minibatch_CUDA_2D(muY_basic_box, partition):
 # Global balance
 # For warm-starting with Sinkhorn solution without compromising marginal
 #######################
-from ortools.graph.python import min_cost_flow
 
 def get_edges_2D(basic_shape):
     sb1, sb2 = basic_shape
@@ -1038,6 +2106,7 @@ def get_edges_2D(basic_shape):
     return edges
 
 def solve_grid_flow_problem(size, supply):
+    from ortools.graph.python import min_cost_flow
     n1, n2 = size
     N = n1*n2
     
@@ -1103,6 +2172,56 @@ def solve_grid_flow_problem(size, supply):
     # w = flows.astype(np.float64) * (max_cap / res_cap)
     return w
 
+def get_grid_potential(supply):
+    """
+    Solve L phi = `supply` for the graph Laplacian L of the grid with the 
+    shape of `supply` (4-neighbourhood in 2D, 2*dim in general), up to the 
+    mean of `supply`, which is removed. The 1D path Laplacians are 
+    diagonalized by the DCT-II basis, so this is an exact direct solve in 
+    O(N*(n1 + ... + nd)), without any sparse factorization.
+    """
+    phi = supply - supply.mean()
+    bases = []
+    eigenvalues = 0.0
+    for (axis, n) in enumerate(supply.shape):
+        k = np.arange(n)
+        # Orthonormal DCT-II basis: columns are the eigenvectors
+        V = np.cos(np.pi * np.outer(np.arange(n) + 0.5, k) / n)
+        V /= np.linalg.norm(V, axis=0)
+        shape = [1]*supply.ndim
+        shape[axis] = n
+        eigenvalues = eigenvalues \
+            + (2 - 2*np.cos(np.pi * k / n)).reshape(shape)
+        phi = np.moveaxis(np.tensordot(V.T, phi, axes=(1, axis)), 0, axis)
+        bases.append(V)
+    # The constant mode is in the kernel, phi has zero mean
+    eigenvalues.flat[0] = 1.0
+    phi = phi / eigenvalues
+    phi.flat[0] = 0.0
+    for (axis, V) in enumerate(bases):
+        phi = np.moveaxis(np.tensordot(V, phi, axes=(1, axis)), 0, axis)
+    return phi
+
+def solve_grid_flow_L2(size, supply):
+    """
+    Minimal L2 norm flow on the 2D grid of basic cells of shape `size`, 
+    with net outflow `supply` at every node. Returns non-negative edge flows
+    in the layout of `solve_grid_flow_problem` (up, right, down and left 
+    edges), as needed by `implement_flow_CUDA`.
+
+    The optimal flow is the gradient of the potential solving L phi = supply,
+    which is computed directly in floating point by `get_grid_potential`. 
+    Only the total imbalance of `supply` is removed.
+    """
+    n1, n2 = size
+    phi = get_grid_potential(np.asarray(supply, dtype=np.float64)
+                             .reshape(n1, n2))
+    # Net flow along up and right edges
+    up = (phi[:, :-1] - phi[:, 1:]).ravel()
+    right = (phi[:-1, :] - phi[1:, :]).ravel()
+    return np.hstack((np.maximum(up, 0), np.maximum(right, 0),
+                      np.maximum(-up, 0), np.maximum(-right, 0)))
+
 def implement_flow_CUDA(Nu_basic_box, flow, basic_mass, basic_shape, PXpi_basic = None):
     # TODO: generalize for 3D
     b1, b2 = basic_shape
@@ -1125,7 +2244,7 @@ def implement_flow_CUDA(Nu_basic_box, flow, basic_mass, basic_shape, PXpi_basic
 
     flow = torch.tensor(flow, **torch_options)
 
-    if flow[B:].sum() == 0:
+    if flow.sum() == 0:
         return Nu_basic_box
     else: 
         # Capacity edges
@@ -1177,13 +2296,27 @@ def implement_flow_CUDA(Nu_basic_box, flow, basic_mass, basic_shape, PXpi_basic
         Nu_basic_box = combine_cells(Nu_basic_box, sum_indices, weights)
         return Nu_basic_box
 
-def global_balance_CUDA(Nu_basic_box, basic_mass, basic_shape):
+def global_balance_CUDA(Nu_basic_box, basic_mass, basic_shape, method = "L2"):
+    """
+    Move mass between neighbouring basic cells so that every cell marginal 
+    has mass `basic_mass`. The flow is the minimal L2 flow of 
+    `solve_grid_flow_L2` for `method` = "L2", or the (integer rescaled) 
+    minimal cost flow of `solve_grid_flow_problem` for "mincostflow", 
+    which requires OR-Tools.
+    """
     # Get induced edge costs
     PXpi_basic = Nu_basic_box.data.sum((1,2))
-    mass_delta = basic_mass - PXpi_basic
-
-    # Solve min cost flow problem
-    flow = solve_grid_flow_problem(basic_shape, mass_delta.ravel().cpu().numpy())
+    # Cells with surplus send it to their neighbours: implement_flow_CUDA 
+    # gives every cell mass basic_mass, so its net outflow must be the surplus
+    supply = (PXpi_basic - basic_mass).ravel().cpu().numpy()
+
+    # Solve flow problem
+    if method == "L2":
+        flow = solve_grid_flow_L2(basic_shape, supply)
+    elif method == "mincostflow":
+        flow = solve_grid_flow_problem(basic_shape, supply)
+    else:
+        raise NotImplementedError(f"Unknown balancing method {method}")
     # Implement flow
     Nu_basic_box = implement_flow_CUDA(Nu_basic_box, flow, basic_mass, basic_shape, PXpi_basic = PXpi_basic)
     return flow, Nu_basic_box
@@ -1195,8 +2328,9 @@ def sinkhorn_to_domdec(solver, s, balance = True):
     """
     xs, ys = solver.xs, solver.ys
     eps = solver.eps
-    M1, M2 = LogSinkhornGPU.geom_dims(solver.muref)
-    N1, N2 = LogSinkhornGPU.geom_dims(solver.nuref)
+    backend = get_backend(solver.muref)
+    M1, M2 = backend.geom_dims(solver.muref)
+    N1, N2 = backend.geom_dims(solver.nuref)
     b1, b2 = M1//s, M2//s
     muY_basic = get_cell_marginals(solver.muref, solver.nuref, 
                                         solver.alpha, solver.beta,
@@ -1220,9 +2354,9 @@ def sinkhorn_to_domdec(solver, s, balance = True):
     beta_score = (solver.beta * muY_basic).sum((1,2))
     transport_score = alpha_score + beta_score
     # 2. KL penalties
-    margX_score = solver.lam * LogSinkhornGPU.KL(
+    margX_score = solver.lam * backend.KL(
         PXpi.view(b1, s, b2, s), solver.mu.view(b1, s, b2, s), axis = (1,3)).ravel()
-    margY_score = solver.lam * LogSinkhornGPU.KL(PYpi, solver.nu)
+    margY_score = solver.lam * backend.KL(PYpi, solver.nu)
     # Wrap in tuple
     basic_cell_score = (transport_score, margX_score, margY_score)
 
@@ -1232,7 +2366,7 @@ def sinkhorn_to_domdec(solver, s, balance = True):
     
     # Initialize bounding box object
     offsets = torch.zeros((len(muY_basic), 2), 
-                      dtype = torch.int32, device = "cuda")
+                      dtype = torch.int32, device = muY_basic.device)
     muY_basic_box = BoundingBox(muY_basic, offsets, (N1, N2))
 
     # Compress
@@ -1297,14 +2431,14 @@ def get_axis_composite_extent(muY_basic, global_minus, axis, sum_indices):
     n = geom_shape[axis]
     # Put in the position of every point with mass its index along axis
     index_axis = torch.arange(n, device=muY_basic.device, dtype=torch.int32)
-    axis_sum = 2 if axis == 0 else 1 # TODO: generalize for higher dim
+    axis_sum = tuple(k+1 for k in range(len(geom_shape)) if k != axis)
     mask = muY_basic.sum(axis_sum) > 0
     mask_index = mask * index_axis.view(1, -1) # mask_index has shape (B, -1)
     # Get positive extreme
     basic_plus = mask_index.amax(-1)
     # Turn zeros to upper bound so that we can get the minimum
     mask_index[~mask] = n
-    basic_minus = mask_index.amin(-1)
+    basic_minus = torch.minimum(mask_index.amin(-1), basic_plus)
     # Add global offsets
     global_basic_minus = global_minus + basic_minus
     global_basic_plus = global_minus + basic_plus
@@ -1324,11 +2458,10 @@ def get_axis_composite_extent(muY_basic, global_minus, axis, sum_indices):
     return composite_extent
 
 
-def get_minibatches_clustering(muY_basic_box,
-                               partition, N_problems):
+def get_composite_extents(muY_basic_box, partition):
     """
-    Clusters the partition indices according to the size of the 
-    composite problem marginal. 
+    Get the extents along each axis of the bounding box of each composite 
+    problem in `partition`, as a tuple of tensors of shape (B,).
     """
 
     # Remove -1's
@@ -1339,19 +2472,36 @@ def get_minibatches_clustering(muY_basic_box,
     max_slices = max_slices.repeat((1, C))
     sum_indices[mask_ind] = max_slices[mask_ind]
 
+    if isinstance(muY_basic_box, RaggedBoundingBox):
+        sum_indices = sum_indices.long()
+        minus, plus = get_ragged_bounds(muY_basic_box)
+        offsets = muY_basic_box.offsets.long()
+        global_minus = (offsets + minus)[sum_indices].amin(1)
+        global_plus = (offsets + plus)[sum_indices].amax(1)
+        extent = global_plus - global_minus + 1
+        return tuple(extent.unbind(1))
+
     # Get extents
     muY_basic = muY_basic_box.data
-    global_left = muY_basic_box.offsets[:,0]
-    global_bottom = muY_basic_box.offsets[:,1]
     # mask = muY_basic > 0.0
 
-    x = get_axis_composite_extent(muY_basic, global_left, 0, sum_indices)
+    return tuple(
+        get_axis_composite_extent(muY_basic, muY_basic_box.offsets[:,axis],
+                                  axis, sum_indices)
+        for axis in range(muY_basic_box.dim))
+
 
-    y = get_axis_composite_extent(muY_basic, global_bottom,
-                                  1, sum_indices)
+def get_minibatches_clustering(muY_basic_box,
+                               partition, N_problems):
+    """
+    Clusters the partition indices according to the size of the 
+    composite problem marginal. 
+    """
+    B = partition.shape[0]
+    extents = get_composite_extents(muY_basic_box, partition)
 
-    z = torch.concat((x.view(-1, 1), y.view(-1, 1)), dim=1).double()
-    z += torch.rand((B, 2), dtype=torch.float64, device=x.device)
+    z = torch.stack(extents, dim=1).double()
+    z += torch.rand(z.shape, dtype=torch.float64, device=z.device)
     # Cluster
     cl, _ = KMeans(z, N_problems)
     minibatches = [torch.where(cl == i)[0] for i in range(N_problems)]
@@ -1359,3 +2509,107 @@ def get_minibatches_clustering(muY_basic_box,
     minibatches = [batch for batch in minibatches if len(batch) > 0]
 
     return minibatches
+
+
+def merge_buckets(extents, N_buckets, max_groups=256):
+    """
+    Group the problems with bounding box extents `extents`, an integer array
+    of shape (B, dim), into `N_buckets` buckets, trying to minimize the total 
+    padded area, i.e. the sum over buckets of the number of problems times the
+    area of the largest bounding box in the bucket.
+
+    Starting from the distinct extents, the two buckets whose merge increases
+    the padded area least are merged until `N_buckets` remain. If there are 
+    more than `max_groups` distinct extents, they are first rounded up to a 
+    coarser resolution. Returns the bounds of the buckets, of shape (K, dim).
+    """
+    groups, counts = np.unique(extents, axis=0, return_counts=True)
+    q = 1
+    while groups.shape[0] > max_groups:
+        q *= 2
+        groups, counts = np.unique(-(-extents // q) * q, axis=0,
+                                   return_counts=True)
+    bounds = groups.astype(np.int64)
+    counts = counts.astype(np.int64)
+    alive = np.ones(bounds.shape[0], dtype=bool)
+
+    def get_merge_cost(i):
+        # Increase of padded area when merging bucket i with each other one
+        area = counts * np.prod(bounds, axis=1)
+        merged = (counts[i] + counts) * \
+            np.prod(np.maximum(bounds[i], bounds), axis=1)
+        cost = (merged - area[i] - area).astype(np.float64)
+        cost[i] = np.inf
+        cost[~alive] = np.inf
+        return cost
+
+    n = bounds.shape[0]
+    cost = np.full((n, n), np.inf)
+    for i in range(n):
+        cost[i] = get_merge_cost(i)
+    for _ in range(n - max(N_buckets, 1)):
+        i, j = np.unravel_index(np.argmin(cost), cost.shape)
+        # Merge j into i
+        bounds[i] = np.maximum(bounds[i], bounds[j])
+        counts[i] += counts[j]
+        alive[j] = False
+        cost[j, :] = cost[:, j] = np.inf
+        cost[i] = get_merge_cost(i)
+        cost[:, i] = cost[i]
+    return bounds[alive]
+
+def assign_to_buckets(extents, bounds):
+    """
+    Assign each problem with extents `extents` (shape (B, dim)) to the bucket
+    of smallest area in `bounds` (shape (K, dim)) that contains it.
+    Returns the bucket of each problem (-1 if it fits in none) and the padded
+    area of each bucket, after shrinking it to the largest problem assigned.
+    """
+    order = np.argsort(np.prod(bounds, axis=1), kind="stable")
+    fits = np.all(extents[:, None, :] <= bounds[None, order, :], axis=2)
+    assignment = np.where(fits.any(1), order[np.argmax(fits, axis=1)], -1)
+    K = bounds.shape[0]
+    padded_area = np.zeros(K, dtype=np.int64)
+    for k in range(K):
+        extents_k = extents[assignment == k]
+        if extents_k.shape[0] > 0:
+            padded_area[k] = extents_k.shape[0] * \
+                np.prod(np.max(extents_k, axis=0))
+    return assignment, padded_area
+
+def get_minibatches_bucketing(muY_basic_box, partition, N_buckets,
+                              bucket_cache=None, tolerance=0.05):
+    """
+    Groups the partition indices into at most `N_buckets` minibatches of 
+    composite problems with similar bounding boxes, minimizing the total
+    padded area of the minibatches (see `merge_buckets`).
+
+    If a dictionary `bucket_cache` is given, the bucket bounds are stored in it
+    and reused in the next call as long as all problems still fit in them and
+    the padding overhead has not grown by more than a factor 1 + `tolerance`.
+    Use one cache per partition.
+    """
+    extents = torch.stack(get_composite_extents(muY_basic_box, partition), 
+                          dim=1).cpu().numpy().astype(np.int64)
+    area = np.sum(np.prod(extents, axis=1))
+
+    assignment = None
+    if bucket_cache is not None and "bounds" in bucket_cache:
+        assignment, padded_area = assign_to_buckets(
+            extents, bucket_cache["bounds"])
+        overhead = np.sum(padded_area) / area
+        if np.any(assignment < 0) or \
+                overhead > bucket_cache["overhead"] * (1 + tolerance):
+            assignment = None
+    if assignment is None:
+        bounds = merge_buckets(extents, N_buckets)
+        assignment, padded_area = assign_to_buckets(extents, bounds)
+        overhead = np.sum(padded_area) / area
+        if bucket_cache is not None:
+            bucket_cache["bounds"] = bounds
+            bucket_cache["overhead"] = overhead
+
+    assignment = torch.tensor(assignment, device=partition.device)
+    minibatches = [torch.where(assignment == k)[0]
+                   for k in np.unique(assignment.cpu().numpy())]
+    return minibatches
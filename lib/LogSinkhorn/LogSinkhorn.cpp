@@ -364,14 +364,19 @@ py::tuple getEuclideanCost(py::array_t<double> &posX, py::array_t<double> &posY)
 	double* const datC=(double*) c.request().ptr;
 	double* const datCT=(double*) cT.request().ptr;
 
-	for(size_t x=0;x<xres;x++) {
-		for(size_t y=0;y<yres;y++) {
-			double result=0;
-			for(size_t d=0;d<dim;d++) {
-				result+=std::pow(datX[x*dim+d]-datY[y*dim+d],2);
+	{
+		// output arrays are allocated, release the GIL while filling them
+		py::gil_scoped_release release;
+
+		for(size_t x=0;x<xres;x++) {
+			for(size_t y=0;y<yres;y++) {
+				double result=0;
+				for(size_t d=0;d<dim;d++) {
+					result+=std::pow(datX[x*dim+d]-datY[y*dim+d],2);
+				}
+				datC[x*yres+y]=result;
+				datCT[y*xres+x]=result;
 			}
-			datC[x*yres+y]=result;
-			datCT[y*xres+x]=result;
 		}
 	}
 
@@ -403,6 +408,8 @@ void PyIterate(
 	size_t xres=getDataSize<double>(alpha);
 	size_t yres=getDataSize<double>(beta);
 
+	py::gil_scoped_release release;
+
 	iterate(
 			alphaP, betaP,
 			cP, cTP,
@@ -435,6 +442,9 @@ int PyIterateUntilError(
 	size_t xres=getDataSize<double>(alpha);
 	size_t yres=getDataSize<double>(beta);
 
+	// release the GIL during the iterations, such that several cells can be solved in parallel threads
+	py::gil_scoped_release release;
+
 	size_t n=0;
 	double error=maxError+1.;
 	while((n<nIterationsMax) && (error>=maxError)) {
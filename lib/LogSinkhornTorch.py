@@ -0,0 +1,411 @@
+import types
+import numpy as np
+import torch
+
+#########################################################
+# Pure PyTorch backend for DomainDecompositionGPU
+# Implements the parts of LogSinkhornGPU that are used by the bounding box
+# pipeline (Sinkhorn solver, softmin on grids, AddWithOffsets and balancing
+# kernels) with plain tensor operations, so that it runs on any device.
+# Function names and signatures follow LogSinkhornGPU, see the aliases at the
+# end of this file.
+#########################################################
+
+def geom_dims(x):
+    """
+    Geometric dimensions of batched tensor `x`.
+    """
+    return tuple(x.shape[1:])
+
+def batch_dim(x):
+    """
+    Batch dimension of batched tensor `x`.
+    """
+    return x.shape[0]
+
+def log_dens(a):
+    """
+    Log of density `a`, with a large negative value instead of -inf where
+    `a` is zero.
+    """
+    a_log = torch.log(a)
+    a_log[a <= 0] = -10000.0
+    return a_log
+
+def KL(a, b, axis=None):
+    """
+    Kullback-Leibler divergence of `a` with respect to `b`, summed over `axis`
+    (all axes by default).
+    """
+    result = a * (log_dens(a) - log_dens(b)) - a + b
+    if axis is None:
+        return result.sum()
+    return result.sum(axis)
+
+def logsumexp_separable(h, log_kernels):
+    """
+    For `h` of shape (B, m_1, ..., m_d) and per-axis log-kernels
+    `log_kernels[k]` of shape (B, n_k, m_k) or (n_k, m_k), return r of shape
+    (B, n_1, ..., n_d) with
+    r[b, x] = log(sum_y exp(h[b, y] + sum_k log_kernels[k][b, x_k, y_k])),
+    computed one axis at a time.
+    """
+    dim = len(log_kernels)
+    for k, log_K in enumerate(log_kernels):
+        if log_K.dim() == 2:
+            log_K = log_K.view(1, *log_K.shape)
+        # Put axis k last and insert singleton axes for the remaining ones
+        hk = h.movedim(k+1, -1)
+        log_K = log_K.view(log_K.shape[0], *([1]*(dim-1)), *log_K.shape[1:])
+        h = torch.logsumexp(hk.unsqueeze(-2) + log_K, dim=-1).movedim(-1, k+1)
+    return h
+
+def get_log_kernels(xs, ys, eps):
+    """
+    Per-axis batched log-kernels -(x-y)^2/eps of shape (B, n_k, m_k), for
+    input coordinates `xs[k]` of shape (B, m_k) and output coordinates `ys[k]`
+    of shape (B, n_k).
+    """
+    return [-(yk[:, :, None] - xk[:, None, :])**2 / eps
+            for (xk, yk) in zip(xs, ys)]
+
+#########################################################
+# Softmin on grids
+#########################################################
+
+def compute_offsets_sinkhorn_grid(xs, ys, eps):
+    """
+    Split the squared distance between the batched grids `xs` and `ys` into
+    a part depending only on the relative positions within each grid, which
+    is handled by `softmin_image`, and offsets for the grid origins.
+    Returns `offsetX` of shape (B, m_1, ..., m_d), `offsetY` of shape
+    (B, n_1, ..., n_d) and `offset_const` of shape (B, 1, ..., 1).
+    """
+    dim = len(xs)
+    B = xs[0].shape[0]
+    offsetX = 0
+    offsetY = 0
+    offset_const = 0
+    for k, (xk, yk) in enumerate(zip(xs, ys)):
+        shape_k = [B] + [1]*dim
+        shape_k[k+1] = -1
+        d = (xk[:, :1] - yk[:, :1])
+        offsetX = offsetX - 2*(d*(xk - xk[:, :1])).view(shape_k) / eps
+        offsetY = offsetY + 2*(d*(yk - yk[:, :1])).view(shape_k) / eps
+        offset_const = offset_const - d.view(B, *([1]*dim))**2 / eps
+    return offsetX, offsetY, offset_const
+
+def softmin_image(h, Ns, Ms, eps, dys, dxs):
+    """
+    For `h` of shape (B, *Ms) on a grid with spacing `dxs` and origin 0,
+    return log(sum_x exp(h[x] - |x-y|^2/eps)) on the grid of shape `Ns` with
+    spacing `dys` and origin 0.
+    """
+    options = dict(dtype=h.dtype, device=h.device)
+    log_kernels = []
+    for (n, m, dy, dx) in zip(Ns, Ms, dys, dxs):
+        x = torch.arange(m, **options) * float(dx)
+        y = torch.arange(n, **options) * float(dy)
+        log_kernels.append(-(y[:, None] - x[None, :])**2 / eps)
+    return logsumexp_separable(h.view(-1, *Ms), log_kernels)
+
+#########################################################
+# Sinkhorn solver
+#########################################################
+
+class LogSinkhornImageOffset:
+    """
+    Batched log-domain Sinkhorn solver for problems between grids that may be
+    displaced with respect to each other. Transport plans are
+    pi = muref x nuref * exp((alpha + beta - |x-y|^2)/eps).
+
+    Attributes
+    ----------
+    mu, nu : torch.Tensor of shape (B, *Ms) and (B, *Ns)
+        Marginals.
+    muref, nuref : torch.Tensor
+        Reference measures, default to `mu` and `nu`.
+    xs, ys : tuple of torch.Tensor
+        Coordinates along each axis, of shape (B, m_k) and (B, n_k).
+    alpha, beta : torch.Tensor
+        Dual potentials.
+    Niter : int
+        Number of iterations performed.
+    """
+
+    def __init__(self, mu, nu, C, eps, alpha_init=None, muref=None,
+                 nuref=None, max_error=1e-4, max_error_rel=False,
+                 max_iter=10000, inner_iter=10):
+        self.mu = mu
+        self.nu = nu
+        self.muref = mu if muref is None else muref
+        self.nuref = nu if nuref is None else nuref
+        self.xs, self.ys = C
+        self.eps = eps
+        self.max_error = max_error
+        self.max_error_rel = max_error_rel
+        self.max_iter = max_iter
+        self.inner_iter = inner_iter
+        self.Niter = 0
+
+        self.logmuref = log_dens(self.muref)
+        self.lognuref = log_dens(self.nuref)
+        self.logmu_rel = log_dens(self.mu) - self.logmuref
+        self.lognu_rel = log_dens(self.nu) - self.lognuref
+        self.log_kernels_XY = get_log_kernels(self.ys, self.xs, eps)
+        self.log_kernels_YX = get_log_kernels(self.xs, self.ys, eps)
+
+        if alpha_init is None:
+            self.alpha = torch.zeros_like(mu)
+        else:
+            self.alpha = alpha_init
+        self.beta = self.get_new_beta()
+
+    def get_new_alpha(self):
+        h = self.beta / self.eps + self.lognuref
+        return self.eps * (
+            self.logmu_rel - logsumexp_separable(h, self.log_kernels_XY))
+
+    def get_new_beta(self):
+        h = self.alpha / self.eps + self.logmuref
+        return self.eps * (
+            self.lognu_rel - logsumexp_separable(h, self.log_kernels_YX))
+
+    def update_alpha(self):
+        self.alpha = self.get_new_alpha()
+
+    def update_beta(self):
+        self.beta = self.get_new_beta()
+
+    def iterate(self, niter):
+        for _ in range(niter):
+            self.update_alpha()
+            self.update_beta()
+
+    def get_actual_X_marginal(self):
+        return self.mu * torch.exp((self.alpha - self.get_new_alpha())/self.eps)
+
+    def get_actual_Y_marginal(self):
+        return self.nu * torch.exp((self.beta - self.get_new_beta())/self.eps)
+
+    def get_current_error(self):
+        """
+        L1 error of the X marginal, summed over the batch.
+        """
+        return torch.sum(torch.abs(self.get_actual_X_marginal() - self.mu)).item()
+
+    def iterate_until_max_error(self):
+        """
+        Iterate in blocks of `inner_iter` iterations until the X marginal error
+        is below `max_error` (relative to the mass of `mu` if `max_error_rel`)
+        or `max_iter` is reached. Returns 0 on success, 1 otherwise.
+        """
+        max_error = self.max_error
+        if self.max_error_rel:
+            max_error *= torch.sum(self.mu).item()
+        error = self.get_current_error() if self.max_iter > 0 else np.inf
+        while (self.Niter < self.max_iter) and (error >= max_error):
+            self.iterate(self.inner_iter)
+            self.Niter += self.inner_iter
+            error = self.get_current_error()
+        if error < max_error:
+            return 0
+        return 1
+
+class LogSinkhornImage(LogSinkhornImageOffset):
+    """
+    Same as LogSinkhornImageOffset for `mu` and `nu` on the same grid with
+    spacing `dx` and origin 0.
+    """
+
+    def __init__(self, mu, nu, dx, eps, **kwargs):
+        options = dict(dtype=mu.dtype, device=mu.device)
+        xs = tuple(torch.arange(m, **options).view(1, -1) * dx
+                   for m in geom_dims(mu))
+        ys = tuple(torch.arange(n, **options).view(1, -1) * dx
+                   for n in geom_dims(nu))
+        super().__init__(mu, nu, (xs, ys), eps, **kwargs)
+
+#########################################################
+# Bounding box kernels
+#########################################################
+
+def add_boxes(nu_basic, C, shape, weights, comp_index, basic_index,
+              src_start, dst_start, extent):
+    """
+    Return tensor of shape (C, *shape), where for every pair p the box of 
+    size extent[p] starting at src_start[p] in nu_basic[basic_index[p]], 
+    multiplied by weights[p], is added at dst_start[p] to the result 
+    comp_index[p]. Entries outside of the source or output arrays are ignored.
+    `comp_index`, `basic_index` and `weights` are 1D tensors of the same 
+    length P, `src_start`, `dst_start` and `extent` have shape (P, dim).
+    """
+    shape = tuple(int(n) for n in shape)
+    dim = len(shape)
+    size = int(np.prod(shape))
+    result = torch.zeros(C*size, dtype=nu_basic.dtype, device=nu_basic.device)
+    if comp_index.numel() == 0:
+        return result.view(C, *shape)
+    src_shape = nu_basic.shape[1:]
+    options_int = dict(dtype=torch.int64, device=nu_basic.device)
+    P = comp_index.shape[0]
+    mask = torch.ones((P,) + (1,)*dim, dtype=torch.bool, 
+                      device=nu_basic.device)
+    src_index = [basic_index.long().view(-1, *([1]*dim))]
+    dst_index = comp_index.long().view(-1, *([1]*dim))
+    for k in range(dim):
+        n_max = max(int(extent[:, k].max().item()), 0)
+        view_k = [P] + [1]*dim
+        view_k[k+1] = n_max
+        ik = torch.arange(n_max, **options_int).view(1, -1)
+        src_k = src_start[:, k].long().view(-1, 1) + ik
+        dst_k = dst_start[:, k].long().view(-1, 1) + ik
+        mask_k = (ik < extent[:, k].long().view(-1, 1)) \
+            & (src_k >= 0) & (src_k < src_shape[k]) \
+            & (dst_k >= 0) & (dst_k < shape[k])
+        mask = mask & mask_k.view(view_k)
+        src_index.append(src_k.clamp(0, src_shape[k]-1).view(view_k))
+        dst_index = dst_index*shape[k] + dst_k.clamp(0, shape[k]-1).view(view_k)
+    values = nu_basic[tuple(src_index)]
+    values = values * weights.view(-1, *([1]*dim)) * mask
+    index = dst_index.expand(values.shape)
+    result.scatter_add_(0, index.reshape(-1), values.reshape(-1))
+    return result.view(C, *shape)
+
+def add_boxes_2D(nu_basic, C, w, h, weights, comp_index, basic_index,
+                 src_left, src_bottom, dst_left, dst_bottom, width, height):
+    """
+    2D version of `add_boxes`, with the starts and extents of the boxes given 
+    per axis.
+    """
+    return add_boxes(
+        nu_basic, C, (w, h), weights, comp_index, basic_index,
+        torch.stack((src_left, src_bottom), -1),
+        torch.stack((dst_left, dst_bottom), -1),
+        torch.stack((width, height), -1))
+
+def AddWithOffsets_ND(nu_basic, shape, weights, sum_indices,
+                      relative_basic_minus, basic_minus, basic_extent):
+    """
+    N-D version of AddWithOffsets_2D. Result has shape (C, *shape). The 
+    arguments `relative_basic_minus`, `basic_minus` and `basic_extent` are 
+    sequences with one tensor of the shape of `sum_indices` per axis.
+    """
+    C = sum_indices.shape[0]
+    mask = sum_indices >= 0
+    comp_index = torch.nonzero(mask)[:, 0]
+    return add_boxes(
+        nu_basic, C, shape, weights[mask], comp_index, sum_indices[mask],
+        torch.stack([x[mask] for x in basic_minus], -1),
+        torch.stack([x[mask] for x in relative_basic_minus], -1),
+        torch.stack([x[mask] for x in basic_extent], -1))
+
+def AddWithOffsets_2D(nu_basic, w, h, weights, sum_indices,
+                      relative_basic_left, basic_left, basic_width,
+                      relative_basic_bottom, basic_bottom, basic_height):
+    """
+    Result has shape (C, w, h) with C = sum_indices.shape[0]. For every j with
+    sum_indices[i, j] >= 0 the box of nu_basic[sum_indices[i, j]] starting at
+    (basic_left[i, j], basic_bottom[i, j]) of size
+    (basic_width[i, j], basic_height[i, j]) is multiplied with weights[i, j]
+    and added to result[i] at (relative_basic_left[i, j],
+    relative_basic_bottom[i, j]).
+    """
+    return AddWithOffsets_ND(
+        nu_basic, (w, h), weights, sum_indices,
+        (relative_basic_left, relative_basic_bottom),
+        (basic_left, basic_bottom), (basic_width, basic_height))
+
+def AddWithOffsets_ND_OutputSide(nu_basic, shape, weights, sum_indices,
+                                 offsets_comp, offsets_basic):
+    """
+    Result has shape (C, *shape) with C = sum_indices.shape[0]. result[i] is 
+    the sum of nu_basic[sum_indices[i, j]] multiplied with weights[i, j], over
+    j with sum_indices[i, j] >= 0, where the basic cells are placed at global
+    offsets `offsets_basic` and the result at global offsets `offsets_comp`.
+    """
+    C = sum_indices.shape[0]
+    mask = sum_indices >= 0
+    comp_index = torch.nonzero(mask)[:, 0]
+    basic_index = sum_indices[mask].long()
+    shift = offsets_basic[basic_index] - offsets_comp[comp_index]
+    extent = torch.tensor(nu_basic.shape[1:], device=shift.device) \
+        .expand(shift.shape)
+    return add_boxes(
+        nu_basic, C, shape, weights[mask], comp_index, basic_index,
+        torch.zeros_like(shift), shift, extent)
+
+def AddWithOffsets_2D_OutputSide(nu_basic, w, h, weights, sum_indices,
+                                 offsets_comp, offsets_basic):
+    """
+    2D version of AddWithOffsets_ND_OutputSide, with output shape (C, w, h).
+    """
+    return AddWithOffsets_ND_OutputSide(nu_basic, (w, h), weights, 
+                                        sum_indices, offsets_comp, 
+                                        offsets_basic)
+
+#########################################################
+# Balancing
+#########################################################
+
+def transfer_mass(src, dst, amount, threshold):
+    """
+    Move mass `amount[b]` from src[b] to dst[b] in place, first only on entries
+    where the destination is at least `threshold` (to not create new support),
+    then on all entries. Returns the mass that could not be moved.
+    """
+    remaining = amount.clone()
+    for t in [threshold, 0.0]:
+        available = torch.where(dst >= t, src, torch.zeros_like(src))
+        cum_available = torch.cumsum(available, -1) - available
+        take = torch.minimum(
+            torch.clamp(remaining.view(-1, 1) - cum_available, min=0.0),
+            available)
+        src -= take
+        dst += take
+        remaining -= take.sum(-1)
+    return torch.clamp(remaining, min=0.0)
+
+def Balance(nu_basic, mass_delta, threshold):
+    """
+    Transfer mass between the C basic cells of each composite cell, in place,
+    for `nu_basic` of shape (B, C, n) and `mass_delta` of shape (B, C), the
+    surplus of mass of each basic cell. Cells are balanced pairwise, as in
+    DomainDecomposition.BalanceMeasuresMulti.
+    """
+    threshold = float(threshold)
+    mass_delta = mass_delta.clone()
+    C = nu_basic.shape[1]
+    for i in range(C):
+        for j in range(i+1, C):
+            d_i = mass_delta[:, i]
+            d_j = mass_delta[:, j]
+            # Positive if mass goes from i to j
+            delta = torch.minimum(d_i.clamp(min=0), (-d_j).clamp(min=0)) \
+                - torch.minimum((-d_i).clamp(min=0), d_j.clamp(min=0))
+            forward = (delta > 0).view(-1, 1)
+            src = torch.where(forward, nu_basic[:, i], nu_basic[:, j])
+            dst = torch.where(forward, nu_basic[:, j], nu_basic[:, i])
+            amount = delta.abs()
+            moved = amount - transfer_mass(src, dst, amount, threshold)
+            nu_basic[:, i] = torch.where(forward, src, dst)
+            nu_basic[:, j] = torch.where(forward, dst, src)
+            moved = torch.where(delta > 0, moved, -moved)
+            mass_delta[:, i] -= moved
+            mass_delta[:, j] += moved
+    return nu_basic
+
+#########################################################
+# Aliases with the names of LogSinkhornGPU
+#########################################################
+
+softmin_cuda_image = softmin_image
+LogSinkhornCudaImageOffset = LogSinkhornImageOffset
+LogSinkhornCudaImage = LogSinkhornImage
+backend = types.SimpleNamespace(
+    AddWithOffsetsCUDA_2D=AddWithOffsets_2D,
+    AddWithOffsetsCUDA_2D_OutputSide=AddWithOffsets_2D_OutputSide,
+    AddWithOffsetsCUDA_ND=AddWithOffsets_ND,
+    AddWithOffsetsCUDA_ND_OutputSide=AddWithOffsets_ND_OutputSide,
+    BalanceCUDA=Balance
+)
@@ -1,4 +1,6 @@
 import time
+import pickle
+import numpy as np
 from mpi4py import MPI
 
 """
@@ -14,16 +16,221 @@ MSG_ROOT_new_job=1
 MSG_ROOT_set_func=3
 MSG_ROOT_set_args_global=4
 MSG_ROOT_new_job_list=5
+MSG_ROOT_set_static=6
+MSG_ROOT_clear_static=7
 
 MSG_WORKER_return_job=2
 
-def sendProblem(comm,workerId, probId, data,multiProblem=False):
+# number of message codes, in buffered transport the MPI tag is code+NMSG*(problem id+1), tag 0 is the pickled transport
+NMSG=8
+
+
+###############################################################################################################################
+# static data
+# data that stays constant over many maps (e.g. over one layer of the multiscale scheme) can be registered once.
+# it is kept on the workers in staticData under a key and can be read there by the mapped functions via getStaticData.
+# root keeps a registry of the keys, so registering can be skipped when the data is already resident.
+
+# on workers: key -> data
+staticData={}
+# on root: keys that are resident on the workers
+staticRegistry=set()
+
+
+def SetStaticData(comm,key,data):
+    """Sends data to all workers, where it is stored under key (must be hashable after transport, e.g. int, str
+    or tuples of those). Data is sent with the buffered transport."""
+    nWorkers=comm.Get_size()-1
+    for n in range(nWorkers):
+        sendBuffered(comm,n+1,MSG_ROOT_set_static,0,(key,data))
+    staticRegistry.add(key)
+
+
+def HasStaticData(key):
+    """Whether data has been registered under key (on root)."""
+    return key in staticRegistry
+
+
+def ClearStaticData(comm,keys=None):
+    """Evicts the data of the given keys on all workers, or all static data if keys is None."""
+    nWorkers=comm.Get_size()-1
+    if keys is not None:
+        keys=list(keys)
+    for n in range(nWorkers):
+        sendBuffered(comm,n+1,MSG_ROOT_clear_static,0,keys)
+    if keys is None:
+        staticRegistry.clear()
+    else:
+        staticRegistry.difference_update(keys)
+
+
+def getStaticData(key):
+    """Static data registered under key, for functions running on the workers."""
+    return staticData[key]
+
+
+###############################################################################################################################
+# buffered transport
+# a message consists of an int64 header that encodes the (nested) structure of the data
+# followed by one buffer-based (upper case) send per numpy array, all with the same tag.
+# objects that cannot be described by the header are pickled into a uint8 array.
+
+# header tokens
+HDR_NONE=0
+HDR_INT=1
+HDR_FLOAT=2
+HDR_BOOL=3
+HDR_LIST=4
+HDR_TUPLE=5
+HDR_ARRAY=6
+HDR_PICKLE=7
+
+# dtypes that are sent as raw buffers, identified by position in this list
+BUFFER_DTYPES=[np.dtype(d) for d in [np.float64,np.float32,np.int64,np.int32,np.int16,np.int8,\
+        np.uint64,np.uint32,np.uint16,np.uint8,np.bool_,np.complex128]]
+
+
+def encodeData(data,header,arrays):
+    """Appends the description of data to header (list of ints) and its arrays to arrays."""
+    if data is None:
+        header.append(HDR_NONE)
+    elif isinstance(data,(bool,np.bool_)):
+        header+=[HDR_BOOL,int(data)]
+    elif isinstance(data,(int,np.integer)) and (-2**63<=data<2**63):
+        header+=[HDR_INT,int(data)]
+    elif isinstance(data,(float,np.floating)):
+        header+=[HDR_FLOAT,int(np.array(data,dtype=np.float64).view(np.int64))]
+    elif isinstance(data,(list,tuple)):
+        header+=[HDR_LIST if isinstance(data,list) else HDR_TUPLE,len(data)]
+        for item in data:
+            encodeData(item,header,arrays)
+    elif isinstance(data,np.ndarray) and (data.dtype in BUFFER_DTYPES):
+        header+=[HDR_ARRAY,BUFFER_DTYPES.index(data.dtype),data.ndim]+list(data.shape)
+        arrays.append(np.ascontiguousarray(data))
+    else:
+        buffer=np.frombuffer(pickle.dumps(data,protocol=pickle.HIGHEST_PROTOCOL),dtype=np.uint8)
+        header+=[HDR_PICKLE,buffer.shape[0]]
+        arrays.append(buffer)
+
+
+def decodeData(header,pos,arrays):
+    """Inverse of encodeData. arrays is an iterator over the received arrays. Returns (data,new position in header)."""
+    token=header[pos]
+    if token==HDR_NONE:
+        return (None,pos+1)
+    if token==HDR_BOOL:
+        return (bool(header[pos+1]),pos+2)
+    if token==HDR_INT:
+        return (int(header[pos+1]),pos+2)
+    if token==HDR_FLOAT:
+        return (float(header[pos+1:pos+2].view(np.float64)[0]),pos+2)
+    if token in (HDR_LIST,HDR_TUPLE):
+        length=header[pos+1]
+        pos+=2
+        result=[]
+        for i in range(length):
+            item,pos=decodeData(header,pos,arrays)
+            result.append(item)
+        if token==HDR_TUPLE:
+            result=tuple(result)
+        return (result,pos)
+    if token==HDR_ARRAY:
+        return (next(arrays),pos+3+header[pos+2])
+    if token==HDR_PICKLE:
+        return (pickle.loads(next(arrays).tobytes()),pos+2)
+    raise ValueError("invalid message header")
+
+
+def getArrayShapes(header):
+    """Shapes and dtypes of the arrays announced in a header, in order."""
+    result=[]
+    pos=0
+    while pos<header.shape[0]:
+        token=header[pos]
+        if token in (HDR_INT,HDR_FLOAT,HDR_BOOL,HDR_LIST,HDR_TUPLE):
+            pos+=2
+        elif token==HDR_NONE:
+            pos+=1
+        elif token==HDR_ARRAY:
+            ndim=header[pos+2]
+            result.append((tuple(header[pos+3:pos+3+ndim]),BUFFER_DTYPES[header[pos+1]]))
+            pos+=3+ndim
+        elif token==HDR_PICKLE:
+            result.append(((header[pos+1],),np.dtype(np.uint8)))
+            pos+=2
+        else:
+            raise ValueError("invalid message header")
+    return result
+
+
+def getTag(comm,code,probId):
+    tag=code+NMSG*(probId+1)
+    if tag>comm.Get_attr(MPI.TAG_UB):
+        raise ValueError("problem id {:d} exceeds the range of MPI tags".format(probId))
+    return tag
+
+
+# maximal length of a header, larger structures are pickled as a whole. allows receiving headers into fixed buffers.
+HEADER_CAPACITY=4096
+
+
+def isendBuffered(comm,dest,code,probId,data):
+    """Non-blocking version of sendBuffered.
+    Returns (requests,buffers), the buffers must be kept alive until all requests are completed."""
+    tag=getTag(comm,code,probId)
+    header=[]
+    arrays=[]
+    encodeData(data,header,arrays)
+    if len(header)>HEADER_CAPACITY:
+        header=[]
+        arrays=[]
+        buffer=np.frombuffer(pickle.dumps(data,protocol=pickle.HIGHEST_PROTOCOL),dtype=np.uint8)
+        header=[HDR_PICKLE,buffer.shape[0]]
+        arrays=[buffer]
+    header=np.array(header,dtype=np.int64)
+    requests=[comm.Isend([header,MPI.INT64_T],dest=dest,tag=tag)]
+    for a in arrays:
+        requests.append(comm.Isend(a,dest=dest,tag=tag))
+    return (requests,[header]+arrays)
+
+
+def sendBuffered(comm,dest,code,probId,data):
+    """Sends data with header and buffer-based sends. The message code and problem id are encoded in the tag."""
+    requests,buffers=isendBuffered(comm,dest,code,probId,data)
+    MPI.Request.Waitall(requests)
+
+
+def receiveBuffered(comm,source,tag,header=None):
+    """Receives a message sent by sendBuffered with the given tag. Returns (code,probId,data).
+    If the header has already been received, it can be passed as header."""
+    if header is None:
+        status=MPI.Status()
+        comm.Probe(source=source,tag=tag,status=status)
+        header=np.empty(status.Get_count(MPI.INT64_T),dtype=np.int64)
+        comm.Recv([header,MPI.INT64_T],source=source,tag=tag)
+    arrays=[]
+    for shape,dtype in getArrayShapes(header):
+        a=np.empty(shape,dtype=dtype)
+        comm.Recv(a,source=source,tag=tag)
+        arrays.append(a)
+    data,_=decodeData(header,0,iter(arrays))
+    return (tag%NMSG,tag//NMSG-1,data)
+
+
+###############################################################################################################################
+# pickled transport
+
+def sendProblem(comm,workerId, probId, data,multiProblem=False,buffered=False):
     """Master sends a problem to a worker.
     comm: MPI communication object
     workerId: rank of the worker
     probId: number of the problem in argument list
-    data: arguments for the problem"""
+    data: arguments for the problem
+    buffered: whether to use the buffered transport"""
 
+    if buffered:
+        sendBuffered(comm,workerId,MSG_ROOT_new_job_list if multiProblem else MSG_ROOT_new_job,probId,data)
+        return
     # send "new problem msg" first
     if multiProblem:
         comm.send(MSG_ROOT_new_job_list,workerId)
@@ -46,8 +253,13 @@ def receiveSolution(comm):
     data: result data"""
 
     status=MPI.Status()
-    msg=comm.recv(status=status)
+    comm.Probe(source=MPI.ANY_SOURCE,tag=MPI.ANY_TAG,status=status)
     workerId=status.Get_source()
+    if status.Get_tag()!=0:
+        _,problemId,data=receiveBuffered(comm,workerId,status.Get_tag())
+        return (workerId,problemId,data)
+
+    msg=comm.recv(source=workerId)
     problemId=comm.recv(source=workerId)
     data=comm.recv(source=workerId)
     
@@ -60,8 +272,11 @@ def receiveProblem(comm):
     return (probId,data)
 
 
-def sendSolution(comm,probId,data):
+def sendSolution(comm,probId,data,buffered=False):
     """Worker sends solution of finished job back to master."""
+    if buffered:
+        sendBuffered(comm,0,MSG_WORKER_return_job,probId,data)
+        return
     comm.send(MSG_WORKER_return_job, 0)
     comm.send(probId, 0)
     comm.send(data, 0)
@@ -69,7 +284,8 @@ def sendSolution(comm,probId,data):
 
 
 def ParallelMap(comm,func,argList,argsGlobal=None,chunksize=1,probetime=None,\
-        callableArgList=False,callableArgListLen=None,callableReturn=None):
+        callableArgList=False,callableArgListLen=None,callableReturn=None,transport="pickle",prefetch=1,\
+        workerBounds=None,costs=None):
     """Parallel map implementation with MPI.
     
     comm: MPI communication object
@@ -84,6 +300,17 @@ def ParallelMap(comm,func,argList,argsGlobal=None,chunksize=1,probetime=None,\
     callableArgListLen: length of abstract callable arg list
     callableReturn: if not None, for each returned job the master process will call callableReturn(jobId,jobResult).
         Can be used to avoid having to store all results before final post-processing.
+    transport: "pickle" sends each job as pickled python objects (three messages per job),
+        "buffer" sends one message per job whose MPI tag encodes message code and job id, with a small header describing
+        the structure of the data, and numpy arrays sent as raw buffers, without pickling (see sendBuffered).
+    prefetch: number of chunks that are kept outstanding at each worker. If larger than 1, a non-blocking scheduler is used
+        (requires transport="buffer"): jobs are sent with Isend, result headers are received with pre-posted Irecv and
+        Waitany, and the next chunk of a worker is sent before the results of its previous chunk are processed.
+        So assembling arguments and processing results on the master overlaps with computation on the workers.
+    workerBounds: if not None, static scheduling: worker w (w=1,...,nWorkers) processes exactly the jobs
+        workerBounds[w-1] to workerBounds[w]-1 (see DomDecParallelMPI.LocalityScheduler). Requires transport="buffer".
+    costs: if not None, an array of length nJobs, into which the time spent on each job is written (measured on the master
+        between results of a worker, so it includes communication). Requires transport="buffer".
     
     This returns:
     [f(*argsGlobal,*data) for data in argList]
@@ -100,6 +327,15 @@ def ParallelMap(comm,func,argList,argsGlobal=None,chunksize=1,probetime=None,\
     nJobsSent=0
     nJobsDone=0
 
+    if transport=="buffer":
+        buffered=True
+        # check in advance that all job ids fit into the tag
+        getTag(comm,NMSG-1,max(nJobs-1,0))
+    elif transport=="pickle":
+        buffered=False
+    else:
+        raise ValueError("unknown transport: "+str(transport))
+
     if callableReturn is None:
         # empty list to store results in
         result=[None for i in range(nJobs)]
@@ -125,6 +361,32 @@ def ParallelMap(comm,func,argList,argsGlobal=None,chunksize=1,probetime=None,\
             comm.send(0,n+1)
         
 
+    if (prefetch>1) or (workerBounds is not None) or (costs is not None):
+        if not buffered:
+            raise ValueError("prefetch>1, workerBounds and costs require transport=\"buffer\"")
+        if (workerBounds is not None) and ((len(workerBounds)!=nWorkers+1) or (workerBounds[-1]!=nJobs)):
+            raise ValueError("workerBounds must have nWorkers+1 entries and end at the number of jobs")
+        def getJobData(curJob,curChunkSize):
+            if chunksize==1:
+                if not callableArgList:
+                    return argList[curJob]
+                return argList(curJob)
+            if not callableArgList:
+                return argList[curJob:curJob+curChunkSize]
+            return [argList(i) for i in range(curJob,curJob+curChunkSize)]
+        def processResult(curJob,data):
+            if chunksize==1:
+                data=[data]
+            if callableReturn is None:
+                result[curJob:curJob+len(data)]=data
+            else:
+                for i,dat in enumerate(data):
+                    callableReturn(curJob+i,dat)
+        PipelinedSchedule(comm,nJobs,chunksize,prefetch,getJobData,processResult,workerBounds=workerBounds,costs=costs)
+        if callableReturn is None:
+            return result
+        return
+
     # main master loop
     contLoop=True
     while contLoop:
@@ -136,18 +398,19 @@ def ParallelMap(comm,func,argList,argsGlobal=None,chunksize=1,probetime=None,\
             if chunksize==1:
                 # send single job to worker
                 if not callableArgList:
-                    sendProblem(comm,curWorker,curJob,argList[curJob])
+                    sendProblem(comm,curWorker,curJob,argList[curJob],buffered=buffered)
                 else:
-                    sendProblem(comm,curWorker,curJob,argList(curJob))                    
+                    sendProblem(comm,curWorker,curJob,argList(curJob),buffered=buffered)
                 nJobsSent+=1
             else:
                 # send multiple jobs to worker
                 curChunkSize=min(chunksize,nJobs-nJobsSent)
                 if not callableArgList:
-                    sendProblem(comm,curWorker,curJob,argList[curJob:curJob+curChunkSize],multiProblem=True)
+                    sendProblem(comm,curWorker,curJob,argList[curJob:curJob+curChunkSize],multiProblem=True,\
+                            buffered=buffered)
                 else:
                     probData=[argList(i) for i in range(curJob,curJob+curChunkSize)]
-                    sendProblem(comm,curWorker,curJob,probData,multiProblem=True)
+                    sendProblem(comm,curWorker,curJob,probData,multiProblem=True,buffered=buffered)
                 nJobsSent+=curChunkSize
             
         elif nJobsDone<nJobs:
@@ -187,6 +450,86 @@ def ParallelMap(comm,func,argList,argsGlobal=None,chunksize=1,probetime=None,\
     if callableReturn is None:
         return result
 
+def PipelinedSchedule(comm,nJobs,chunksize,prefetch,getJobData,processResult,workerBounds=None,costs=None):
+    """Non-blocking master loop of ParallelMap with buffered transport (used for prefetch>1 and static scheduling).
+    getJobData(curJob,curChunkSize) returns the data to be sent for a chunk of jobs,
+    processResult(curJob,data) is called for each returned chunk.
+    If workerBounds is given, worker w only gets the jobs workerBounds[w-1] to workerBounds[w]-1,
+    otherwise the next chunk goes to the next worker that reports back.
+    If costs is given, costs[job] is set to the measured time of the job."""
+    nWorkers=comm.Get_size()-1
+    code=MSG_ROOT_new_job if chunksize==1 else MSG_ROOT_new_job_list
+    if workerBounds is None:
+        # one queue shared by all workers
+        nextJob=np.zeros(1,dtype=np.int64)
+        endJob=np.full(1,nJobs,dtype=np.int64)
+        queueOfWorker=np.zeros(nWorkers+1,dtype=np.int64)
+    else:
+        nextJob=np.array(workerBounds[:-1],dtype=np.int64)
+        endJob=np.array(workerBounds[1:],dtype=np.int64)
+        queueOfWorker=np.arange(-1,nWorkers,dtype=np.int64)
+    nJobsDone=0
+    # number of chunks currently assigned to each worker
+    nOutstanding=np.zeros(nWorkers+1,dtype=np.int64)
+    # pending non-blocking sends, with their buffers
+    sends=[]
+    # pre-posted receives of result headers, one per worker (index worker-1)
+    headerBuffers=[np.empty(HEADER_CAPACITY,dtype=np.int64) for n in range(nWorkers)]
+    headerRequests=[MPI.REQUEST_NULL for n in range(nWorkers)]
+    # for measuring costs: time at which a chunk was sent and time of the last result of each worker
+    sendTime={}
+    lastArrival=np.zeros(nWorkers+1)
+
+    def hasJobs(worker):
+        queue=queueOfWorker[worker]
+        return nextJob[queue]<endJob[queue]
+
+    def dispatch(worker):
+        queue=queueOfWorker[worker]
+        curJob=nextJob[queue]
+        curChunkSize=min(chunksize,endJob[queue]-curJob)
+        sends.append(isendBuffered(comm,worker,code,int(curJob),getJobData(int(curJob),int(curChunkSize))))
+        nextJob[queue]+=curChunkSize
+        nOutstanding[worker]+=1
+        if costs is not None:
+            sendTime[int(curJob)]=MPI.Wtime()
+        if headerRequests[worker-1]==MPI.REQUEST_NULL:
+            headerRequests[worker-1]=comm.Irecv([headerBuffers[worker-1],MPI.INT64_T],source=worker,tag=MPI.ANY_TAG)
+
+    # fill the queues of all workers, round robin
+    for depth in range(prefetch):
+        for worker in range(1,nWorkers+1):
+            if hasJobs(worker):
+                dispatch(worker)
+
+    status=MPI.Status()
+    while nJobsDone<nJobs:
+        index=MPI.Request.Waitany(headerRequests,status)
+        worker=index+1
+        header=headerBuffers[index][:status.Get_count(MPI.INT64_T)].copy()
+        _,curJob,data=receiveBuffered(comm,worker,status.Get_tag(),header=header)
+        nOutstanding[worker]-=1
+        headerRequests[index]=MPI.REQUEST_NULL
+        nData=(1 if chunksize==1 else len(data))
+        if costs is not None:
+            # the worker started on this chunk when it was received or when the previous chunk was finished
+            arrival=MPI.Wtime()
+            costs[curJob:curJob+nData]=(arrival-max(sendTime.pop(curJob),lastArrival[worker]))/nData
+            lastArrival[worker]=arrival
+        # keep the worker busy before processing the result
+        if hasJobs(worker):
+            dispatch(worker)
+        elif nOutstanding[worker]>0:
+            headerRequests[index]=comm.Irecv([headerBuffers[index],MPI.INT64_T],source=worker,tag=MPI.ANY_TAG)
+        processResult(curJob,data)
+        nJobsDone+=nData
+        # release buffers of completed sends
+        sends=[s for s in sends if not MPI.Request.Testall(s[0])]
+
+    for s in sends:
+        MPI.Request.Waitall(s[0])
+
+
 def Close(comm):
     """Before the master process terminates it must send the "done"-signal to all workers for the programm to terminate successfully."""
     nWorkers=comm.Get_size()-1
@@ -199,9 +542,18 @@ def Worker(comm):
     contLoop=True
     nArgsInGlobal=0
     
+    status=MPI.Status()
+    
     while contLoop:
         # wait for a msg from the main process
-        msg=comm.recv(source=0)
+        # tag 0: pickled transport, code and job are sent in separate messages
+        # otherwise: buffered transport, code and job id are encoded in the tag
+        comm.Probe(source=0,tag=MPI.ANY_TAG,status=status)
+        buffered=(status.Get_tag()!=0)
+        if buffered:
+            msg,probId,data=receiveBuffered(comm,0,status.Get_tag())
+        else:
+            msg=comm.recv(source=0)
         
         # then parse the msg code:
         if msg==MSG_ROOT_all_done:
@@ -209,24 +561,36 @@ def Worker(comm):
             contLoop=False
         elif msg==MSG_ROOT_new_job:
             # new job: parse the job data, apply function to data and return result
-            probId,data=receiveProblem(comm)
+            if not buffered:
+                probId,data=receiveProblem(comm)
             if nArgsInGlobal==0:
                 # if no global arguments used
                 sol=funcLocal(*data)
             else:
                 # if global arguments used
                 sol=funcLocal(*dataGlobal,*data)
-            sendSolution(comm,probId,sol)
+            sendSolution(comm,probId,sol,buffered=buffered)
         elif msg==MSG_ROOT_new_job_list:
             # multiple new jobs
-            probId,data=receiveProblem(comm)
+            if not buffered:
+                probId,data=receiveProblem(comm)
             if nArgsInGlobal==0:
                 # if no global arguments used
                 sol=[funcLocal(*dat) for dat in data]
             else:
                 # if global arguments used
                 sol=[funcLocal(*dataGlobal,*dat) for dat in data]
-            sendSolution(comm,probId,sol)            
+            sendSolution(comm,probId,sol,buffered=buffered)
+        elif msg==MSG_ROOT_set_static:
+            # static data is always sent buffered
+            key,value=data
+            staticData[key]=value
+        elif msg==MSG_ROOT_clear_static:
+            if data is None:
+                staticData.clear()
+            else:
+                for key in data:
+                    staticData.pop(key,None)
         elif msg==MSG_ROOT_set_func:
             # set function on which to apply data
             funcLocal=comm.recv(source=0)
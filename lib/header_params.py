@@ -36,6 +36,9 @@ def getDefaultParams():
 
     params["MPI_chunksize"]=10
     params["MPI_probetime"]=1E-3
+    params["MPI_static_scheduling"]=False
+    params["MPI_static_data"]=False
+    params["MPI_fused_halfstep"]=False
 
 
     params["aux_printLayerConsistency"]=False
@@ -98,6 +101,9 @@ paramsListCFGFile={\
         #
         "MPI_chunksize" : ptype.integer,\
         "MPI_probetime" : ptype.real,\
+        "MPI_static_scheduling" : ptype.boolean,\
+        "MPI_static_data" : ptype.boolean,\
+        "MPI_fused_halfstep" : ptype.boolean,\
         #
         "aux_printLayerConsistency" : ptype.boolean,\
         "aux_dump_finest" : ptype.boolean,\
@@ -38,51 +38,8 @@ file_params = json.load(open(config_file,"r"))
 print("imports")
 
 def getPrimalInfos(muY,posY,posXList,muXList,alphaList,betaDataList,betaIndexList,eps,getMuYList=True):
-
-    scorePrimalUnreg=0.
-    scorePrimal=0.
-    errorMargX=0.
-    errorMargY=0.
-
-    if getMuYList:
-        muYList=[]
-
-    margY=np.zeros_like(muY)
-    cellPlans = []
-    for i in range(len(muXList)):
-        posYcell=posY[betaIndexList[i]].copy()
-        xresCell=posXList[i].shape[0]
-        yresCell=posYcell.shape[0]
-        c,cT=DomDec.LogSinkhorn.getEuclideanCost(posXList[i],posYcell)
-        #cEff=c.reshape((xresCell,yresCell))\
-        #        -np.einsum(alphaList[i],[0],np.ones((yresCell,),dtype=np.double),[1],[0,1])\
-        #        -np.einsum(np.ones((xresCell,),dtype=np.double),[0],betaDataList[i],[1],[0,1])
-
-        cEff=c.reshape((xresCell,yresCell))-alphaList[i].reshape((-1,1))-betaDataList[i].reshape((1,-1))
-
-        piCell=np.einsum(np.exp(-cEff/eps),[0,1],muXList[i],[0],muY[betaIndexList[i]],[1],[0,1])
-        cellPlans.append(piCell)
-
-        scorePrimalUnreg+=np.sum(piCell.ravel()*c)
-
-        scorePrimal+=np.einsum(piCell,[0,1],alphaList[i],[0],[])\
-                +np.einsum(piCell,[0,1],betaDataList[i],[1],[])\
-                -eps*np.sum(piCell)
-
-        errorMargX+=np.sum(np.abs(np.sum(piCell,axis=1)-muXList[i]))
-        margY[betaIndexList[i]]+=np.sum(piCell,axis=0)
-
-        if getMuYList:
-            muYList.append(np.sum(piCell,axis=0))
-
-    errorMargY=np.sum(np.abs(muY-margY))
-
-    result={"scorePrimal":scorePrimal, "scorePrimalUnreg":scorePrimalUnreg,"errorMargX":errorMargX,"errorMargY":errorMargY}
-
-    if getMuYList:
-        return (result,muYList)
-
-    return result
+    # evaluated in batches, without keeping the cell plans
+    return DomDec.getPrimalInfos(muY,posY,posXList,muXList,alphaList,betaDataList,betaIndexList,eps,getMuYList=getMuYList)
 
 def benchmark2D(file1,dump1,dump2,file_params,testID,error = 0.0001):
 
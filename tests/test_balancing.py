@@ -0,0 +1,62 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+import pytest
+
+import lib.DomainDecomposition as DomDec
+
+
+def get_balancing_problem(seed, variableSizes, nGroups=16384, res=20):
+    # groups of 4 (or 1 to 4) atomic cells sharing a support of res points,
+    # with target masses that are a permutation of the masses within each 
+    # group, so that they balance each group exactly
+    rng = np.random.default_rng(seed)
+    if variableSizes:
+        groupSizes = rng.integers(1, 5, size=nGroups)
+    else:
+        groupSizes = np.full(nGroups, 4)
+    groups = np.repeat(np.arange(nGroups), groupSizes)
+    nCells = groups.shape[0]
+    data = rng.random(nCells*res)*1E-6
+    cellStarts = np.arange(nCells, dtype=np.int64)*res
+    cellLengths = np.full(nCells, res, dtype=np.int64)
+    masses = data.reshape(nCells, res).sum(1)
+    targetMasses = masses.copy()
+    groupStarts = np.cumsum(groupSizes)-groupSizes
+    for i in np.flatnonzero(groupSizes > 1):
+        cells = slice(groupStarts[i], groupStarts[i]+groupSizes[i])
+        targetMasses[cells] = rng.permutation(masses[cells])
+    return data, cellStarts, cellLengths, groups, nGroups, masses, targetMasses
+
+
+@pytest.mark.parametrize("variableSizes", [False, True])
+@pytest.mark.parametrize("seed", range(8))
+def test_balance_shared_support_many_groups(seed, variableSizes):
+    data, cellStarts, cellLengths, groups, nGroups, masses, targetMasses = \
+        get_balancing_problem(seed, variableSizes)
+    groupMassBefore = np.bincount(groups, weights=masses, minlength=nGroups)
+
+    residual = DomDec.BalanceSharedSupport(data, cellStarts, cellLengths,
+            groups, nGroups, masses, targetMasses)
+
+    newMasses = data.reshape(groups.shape[0], -1).sum(1)
+    groupMassAfter = np.bincount(groups, weights=newMasses, minlength=nGroups)
+    # no mass is moved between groups
+    assert np.max(np.abs(groupMassAfter-groupMassBefore)) < 1E-18
+    # transfers below threshStep=1E-16 are skipped
+    assert np.max(residual) < 1E-15
+    assert np.max(np.abs(newMasses-targetMasses)) < 1E-15
+    assert np.all(data >= 0.)
+
+
+def test_transfer_pairs_stay_in_group():
+    _, _, _, groups, nGroups, masses, targetMasses = get_balancing_problem(5, False)
+    surplus = np.maximum(masses-targetMasses, 0.)
+    deficit = np.maximum(targetMasses-masses, 0.)
+    src, dst, amount, rank = DomDec.getTransferPairs(surplus, deficit,
+            groups, nGroups)
+    assert np.all(groups[src] == groups[dst])
+    assert np.all(surplus[src] > 0.)
+    assert np.all(deficit[dst] > 0.)
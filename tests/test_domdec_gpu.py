@@ -0,0 +1,206 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+import pytest
+import torch
+
+import lib.Common as Common
+import lib.DomainDecompositionGPU as DomDecGPU
+
+
+def get_density(shape, center, width):
+    x = torch.arange(shape[0], dtype=torch.float64)[:, None]/shape[0]
+    y = torch.arange(shape[1], dtype=torch.float64)[None, :]/shape[1]
+    rho = torch.exp(-((x-center[0])**2+(y-center[1])**2)/width**2)+1E-3
+    return rho/rho.sum()
+
+
+def get_partition_data(muX, cellsize, offset):
+    # X marginals, coordinates and basic cells of the composite cells of
+    # partition A (offset 0) or B (offset 1), as set up in
+    # examples/example-domdec-gpu.py
+    b1, b2 = (n//cellsize for n in muX.shape)
+    s = 2*cellsize
+    if offset == 1:
+        muX = DomDecGPU.pad_tensor(muX, cellsize, pad_value=1e-40)
+    c1, c2 = (n//s for n in muX.shape)
+    muXJ = muX.view(c1, s, c2, s).permute(0, 2, 1, 3).reshape(-1, s, s)
+    corner = torch.arange(c1*c2).view(c1, c2)
+    offsets = torch.stack(((corner // c2)*s, (corner % c2)*s), -1) \
+        .view(-1, 2).int() - offset*cellsize
+    muXJ_box = DomDecGPU.BoundingBox(muXJ, offsets, muX.shape)
+    posXJ = tuple(DomDecGPU.get_grid_cartesian_coordinates(
+        muXJ_box, torch.tensor([1., 1.])))
+    basic_index = torch.arange(b1*b2, dtype=torch.int32).view(b1, b2)
+    if offset == 1:
+        basic_index = DomDecGPU.pad_tensor(basic_index, 1, pad_value=-1)
+    partition = basic_index.view(c1, 2, c2, 2).permute(0, 2, 1, 3) \
+        .reshape(-1, 4)
+    return muXJ, posXJ, partition
+
+
+def run_domdec(shape=(16, 16), cellsize=2, eps=2., nIterations=2, ragged=False,
+               **kwargs):
+    # a few A and B half-iterations of MiniBatchIterate on one layer, with
+    # a tight Sinkhorn error, so results barely depend on the minibatches
+    muX = get_density(shape, (0.3, 0.4), 0.2)
+    muY = get_density(shape, (0.6, 0.5), 0.25)
+    posY = Common.getPoslistNCube(shape)
+    dxs_dys = (torch.tensor([1., 1.]), torch.tensor([1., 1.]))
+    b1, b2 = (n//cellsize for n in shape)
+    basic_mass = muX.view(b1, cellsize, b2, cellsize).sum((1, 3))
+    muY_basic = basic_mass.view(-1, 1, 1) * muY.view(1, *shape)
+    offsets = torch.zeros((b1*b2, 2), dtype=torch.int32)
+    muY_basic_box = DomDecGPU.BoundingBox(muY_basic, offsets, shape)
+    if ragged:
+        muY_basic_box = DomDecGPU.RaggedBoundingBox.from_bounding_box(
+            muY_basic_box)
+    partitions = [get_partition_data(muX, cellsize, k) for k in [0, 1]]
+    alphas = [torch.zeros_like(muXJ) for (muXJ, _, _) in partitions]
+    for _ in range(nIterations):
+        for k, (muXJ, posXJ, partition) in enumerate(partitions):
+            alphas[k], muY_basic_box, info = DomDecGPU.MiniBatchIterate(
+                muY, posY, dxs_dys, eps, muXJ, posXJ, alphas[k],
+                muY_basic_box, shape, partition, SinkhornError=1E-12,
+                SinkhornMaxIter=10000, SinkhornInnerIter=10, clustering=True,
+                N_clusters=4, clustering_method="bucketing", **kwargs)
+    muY_current = DomDecGPU.get_current_Y_marginal(muY_basic_box, shape)
+    return alphas, muY_current, muY_basic_box
+
+
+@pytest.mark.parametrize("options", [
+    dict(streaming=True),
+    dict(memory_budget=20000),
+])
+def test_streamed_minibatches_match_dense(options):
+    alphas, muY, _ = run_domdec()
+    alphasStreamed, muYStreamed, box = run_domdec(**options)
+    assert isinstance(box, DomDecGPU.RaggedBoundingBox)
+    # split minibatches stop at different Sinkhorn iterations, which shows
+    # most on X points of small mass, such as the padding of partition B
+    for a, b in zip(alphas, alphasStreamed):
+        assert torch.allclose(a, b, rtol=0., atol=1E-6)
+    assert torch.allclose(muY, muYStreamed, rtol=0., atol=1E-13)
+
+
+def get_global_cells(box, shape):
+    # cells of a (ragged) bounding box written into the global grid
+    box = DomDecGPU.as_bounding_box(box)
+    result = torch.zeros((box.B, *shape), dtype=box.data.dtype)
+    for i in range(box.B):
+        (o1, o2) = box.offsets[i].tolist()
+        data = box.data[i]
+        assert data[shape[0]-o1:].sum() == 0 and data[:, shape[1]-o2:].sum() == 0
+        result[i, o1:o1+data.shape[0], o2:o2+data.shape[1]] = \
+            data[:shape[0]-o1, :shape[1]-o2]
+    return result
+
+
+def test_ragged_cells_match_dense_cells():
+    torch.manual_seed(0)
+    shape = (32, 32)
+    data = torch.rand(16, 7, 6, dtype=torch.float64)
+    data[data < 0.5] = 0
+    # a cell without mass, and one with a single entry
+    data[3] = 0
+    data[5] = 0
+    data[5, 2, 3] = 1.
+    offsets = torch.randint(0, 20, (16, 2), dtype=torch.int32)
+    box = DomDecGPU.BoundingBox(data, offsets, shape)
+    ragged = DomDecGPU.RaggedBoundingBox.from_bounding_box(box)
+
+    # composite cells from a subset of the basic cells
+    sum_indices = torch.tensor([[0, 5, 7, 2], [9, 3, -1, -1], [5, 11, 1, 4]],
+                               dtype=torch.int32)
+    weights = torch.rand(sum_indices.shape, dtype=torch.float64)
+    combined = DomDecGPU.combine_cells(box, sum_indices, weights)
+    combinedRagged = DomDecGPU.combine_cells(ragged, sum_indices, weights)
+    assert torch.allclose(get_global_cells(combined, shape),
+                          get_global_cells(combinedRagged, shape),
+                          rtol=0., atol=1E-15)
+
+    slid = DomDecGPU.slide_marginals_to_corner(box)
+    slidRagged = DomDecGPU.slide_marginals_to_corner(ragged)
+    assert isinstance(slidRagged, DomDecGPU.RaggedBoundingBox)
+    assert torch.equal(get_global_cells(slid, shape),
+                       get_global_cells(slidRagged, shape))
+    assert torch.equal(get_global_cells(box, shape),
+                       get_global_cells(slidRagged, shape))
+
+
+def test_ragged_input_matches_dense_input():
+    alphas, muY, _ = run_domdec()
+    alphasRagged, muYRagged, _ = run_domdec(ragged=True)
+    for a, b in zip(alphas, alphasRagged):
+        assert torch.allclose(a, b, rtol=0., atol=1E-6)
+    assert torch.allclose(muY, muYRagged, rtol=0., atol=1E-13)
+
+
+@pytest.mark.parametrize("size", [(4, 4), (7, 5), (1, 6)])
+def test_grid_flow_divergence_matches_supply(size):
+    rng = np.random.default_rng(0)
+    supply = rng.normal(size=size).ravel()
+    supply -= supply.mean()
+    flow = DomDecGPU.solve_grid_flow_L2(size, supply)
+    edges = DomDecGPU.get_edges_2D(size)
+    assert flow.shape == (edges.shape[0],)
+    assert np.all(flow >= 0.)
+    N = np.prod(size)
+    divergence = np.bincount(edges[:, 0], weights=flow, minlength=N) \
+        - np.bincount(edges[:, 1], weights=flow, minlength=N)
+    assert np.allclose(divergence, supply, rtol=0., atol=1E-12)
+
+
+def test_alpha_stitching_rejects_3d():
+    alpha = torch.zeros((1, 4, 4, 4), dtype=torch.float64)
+    with pytest.raises(NotImplementedError):
+        DomDecGPU.get_alpha_field_even_gpu(alpha, alpha, (4, 4, 4), (8, 8, 8),
+                                           2, (2, 2, 2))
+
+
+def test_padded_layers_refine_to_cropped_marginals():
+    # multiscale layers of a non-dyadic grid, padded to whole composite cells
+    # as in examples/example-domdec-gpu.py; the refined cell marginals must
+    # be cropped back to the basic cells and Y points of the finer layer
+    shape = (48, 40)
+    cellsize = 2
+    muX = get_density(shape, (0.3, 0.4), 0.2)
+    muY = get_density(shape, (0.6, 0.5), 0.25)
+    muX_layers = DomDecGPU.get_multiscale_layers(muX, shape)
+    muY_layers = DomDecGPU.get_multiscale_layers(muY, shape)
+    assert [tuple(m.shape) for m in muX_layers] == \
+        [(1, 1), (2, 2), (3, 3), (6, 5), (12, 10), (24, 20), (48, 40)]
+    assert DomDecGPU.get_padded_shape((6, 5), 2*cellsize) == (8, 8)
+    assert DomDecGPU.get_padded_shape(shape, 2*cellsize) == shape
+
+    boxes = [None, None]
+    for muXL, muYL in zip(muX_layers[2:], muY_layers[2:]):
+        shapeXL = DomDecGPU.get_padded_shape(muXL.shape, 2*cellsize)
+        muXL_pad = DomDecGPU.pad_to_shape(muXL, shapeXL, pad_value=1e-40)
+        assert torch.equal(
+            muXL_pad[tuple(slice(0, n) for n in muXL.shape)], muXL)
+        b1, b2 = (n//cellsize for n in shapeXL)
+        basic_mass = muXL_pad.view(b1, cellsize, b2, cellsize).sum((1, 3))
+        if boxes[0] is None:
+            muY_basic = basic_mass.view(-1, 1, 1) * muYL.view(1, *muYL.shape)
+            offsets = torch.zeros((b1*b2, 2), dtype=torch.int32)
+            box = DomDecGPU.BoundingBox(muY_basic, offsets, muYL.shape)
+            boxes = [box, DomDecGPU.RaggedBoundingBox.from_bounding_box(box)]
+        else:
+            boxes = [DomDecGPU.refine_marginals_CUDA(
+                box, basic_mass_old, basic_mass, muYL_old, muYL)
+                for box in boxes]
+        for box in boxes:
+            assert tuple(box.global_shape) == tuple(muYL.shape)
+            assert box.B == b1*b2
+            masses = DomDecGPU.as_bounding_box(box).data.sum((1, 2))
+            assert torch.allclose(masses, basic_mass.ravel(),
+                                  rtol=1E-12, atol=1E-15)
+            muY_current = DomDecGPU.get_current_Y_marginal(box, muYL.shape)
+            assert torch.allclose(muY_current, muYL, rtol=1E-12, atol=1E-15)
+        assert torch.allclose(get_global_cells(boxes[0], muYL.shape),
+                              get_global_cells(boxes[1], muYL.shape),
+                              rtol=0., atol=1E-15)
+        basic_mass_old, muYL_old = basic_mass, muYL
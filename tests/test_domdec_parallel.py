@@ -0,0 +1,68 @@
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+
+import lib.Common as Common
+import lib.DomainDecomposition as DomDec
+import lib.DomDecParallel as DomDecParallel
+
+
+def get_density(shape, center, width):
+    x = np.arange(shape[0])[:, None]/shape[0]
+    y = np.arange(shape[1])[None, :]/shape[1]
+    rho = np.exp(-((x-center[0])**2+(y-center[1])**2)/width**2)+1E-3
+    return (rho/rho.sum()).ravel()
+
+
+def run_domdec(nWorkers=None, shape=(16, 16), cellsize=4, nIterations=2):
+    # a few iterations of domdec on one layer, either serial or with the
+    # shared memory iterator on nWorkers processes
+    muX = get_density(shape, (0.3, 0.4), 0.2)
+    muY = get_density(shape, (0.6, 0.5), 0.25)
+    posX = Common.getPoslistNCube(shape)
+    posY = posX.copy()
+    eps = 2.
+    partitions = [DomDec.GetGridPartition(shape, cellsize, k) for k in [0, 1]]
+    masses = partitions[0].getAtomicCellMasses(muX)
+    store = DomDec.AtomicMarginalStore.fromProduct(muY, masses)
+    iterator = None
+    if nWorkers is not None:
+        iterator = DomDecParallel.DomainDecompositionParallelIterator(
+            nWorkers, muY, posY)
+    cells = []
+    for k, partition in enumerate(partitions):
+        muXJ = partition.gatherCells(muX)
+        posXJ = partition.gatherCells(posX)
+        if iterator is not None:
+            iterator.setPartition(k, partition, None, muXJ, posXJ)
+        alpha = DomDec.PackedArrayList(np.zeros_like(muXJ.data), muXJ.indptr)
+        cells.append((partition, muXJ, posXJ, alpha,
+                      [None]*len(muXJ), [None]*len(muXJ)))
+    for _ in range(nIterations):
+        for k, (partition, muXJ, posXJ, alpha, betaData, betaIndex) \
+                in enumerate(cells):
+            if iterator is None:
+                DomDec.Iterate(muY, posY, eps, partition, None, store, None,
+                               muXJ, posXJ, alpha, betaData, betaIndex)
+            else:
+                iterator.iterate(k, eps, store, alpha, betaData, betaIndex)
+            DomDec.BalanceMeasuresMultiAll(store, masses, partition)
+            DomDec.TruncateMeasures(store, None, 1E-15)
+    if iterator is not None:
+        iterator.close()
+    return store, cells
+
+
+def test_shared_memory_iterate_matches_serial_iterate():
+    store, cells = run_domdec()
+    storeParallel, cellsParallel = run_domdec(nWorkers=2)
+    assert np.array_equal(storeParallel.indptr, store.indptr)
+    assert np.array_equal(storeParallel.indices, store.indices)
+    assert np.allclose(storeParallel.data, store.data, rtol=0., atol=1E-15)
+    for c, cParallel in zip(cells, cellsParallel):
+        for a, b in zip(c[3], cParallel[3]):
+            assert np.allclose(a, b, rtol=0., atol=1E-10)
+        for a, b in zip(c[5], cParallel[5]):
+            assert np.array_equal(a, b)
@@ -0,0 +1,78 @@
+import functools
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import numpy as np
+import pytest
+
+import lib.Common as Common
+import lib.DomainDecomposition as DomDec
+
+
+def get_density(shape, center, width):
+    x = np.arange(shape[0])[:, None]/shape[0]
+    y = np.arange(shape[1])[None, :]/shape[1]
+    rho = np.exp(-((x-center[0])**2+(y-center[1])**2)/width**2)+1E-3
+    return (rho/rho.sum()).ravel()
+
+
+def run_domdec(SinkhornSubSolver, shape=(16, 16), cellsize=4, nIterations=2):
+    # a few iterations of domdec on one layer, with default solver parameters
+    muX = get_density(shape, (0.3, 0.4), 0.2)
+    muY = get_density(shape, (0.6, 0.5), 0.25)
+    posX = Common.getPoslistNCube(shape)
+    posY = posX.copy()
+    eps = 2.
+    partitions = [DomDec.GetGridPartition(shape, cellsize, k) for k in [0, 1]]
+    masses = partitions[0].getAtomicCellMasses(muX)
+    store = DomDec.AtomicMarginalStore.fromProduct(muY, masses)
+    cells = []
+    for partition in partitions:
+        muXJ = partition.gatherCells(muX)
+        alpha = DomDec.PackedArrayList(np.zeros_like(muXJ.data), muXJ.indptr)
+        cells.append((partition, muXJ, partition.gatherCells(posX), alpha,
+                      [None]*len(muXJ), [None]*len(muXJ)))
+    for _ in range(nIterations):
+        for (partition, muXJ, posXJ, alpha, betaData, betaIndex) in cells:
+            DomDec.Iterate(muY, posY, eps, partition, None, store, None,
+                           muXJ, posXJ, alpha, betaData, betaIndex,
+                           SinkhornSubSolver=SinkhornSubSolver)
+            DomDec.BalanceMeasuresMultiAll(store, masses, partition)
+            DomDec.TruncateMeasures(store, None, 1E-15)
+    (_, muXA, posXA, alphaA, betaDataA, betaIndexA) = cells[0]
+    info = DomDec.getPrimalInfos(muY, posY, posXA, muXA, alphaA, betaDataA,
+                                 betaIndexA, eps)
+    return info, alphaA
+
+
+def test_batched_solver_matches_per_cell_solver():
+    info, alpha = run_domdec("LogSinkhorn")
+    infoBatched, alphaBatched = run_domdec("BatchedLogSinkhorn")
+    assert abs(infoBatched["scorePrimal"]-info["scorePrimal"]) \
+        < 1E-10*abs(info["scorePrimal"])
+    for a, b in zip(alpha, alphaBatched):
+        assert np.allclose(a, b, rtol=0., atol=1E-8)
+
+
+def test_separable_solver_matches_dense_solver():
+    dense = functools.partial(DomDec.SolveOnCell_LogSinkhorn, separable=False)
+    info, alpha = run_domdec(dense)
+    infoSeparable, alphaSeparable = run_domdec("LogSinkhorn")
+    assert abs(infoSeparable["scorePrimal"]-info["scorePrimal"]) \
+        < 1E-10*abs(info["scorePrimal"])
+    for a, b in zip(alpha, alphaSeparable):
+        assert np.allclose(a, b, rtol=0., atol=1E-8)
+
+
+def test_separable_kernel_on_sparse_grid_support():
+    # "auto" uses the grid of all Y points, also for supports with uneven gaps
+    posX = Common.getPoslistNCube((4, 4))
+    posY = Common.getPoslistNCube((16, 16))
+    subY = np.array([0, 2, 5, 16*3+1, 16*7+15])
+    gridX, gridY = DomDec.UseSeparableKernel(posX, posY, subY)
+    assert gridY[1] == (8, 16)
+    assert np.array_equal(gridY[2], [0, 2, 5, 16*3+1, 16*7+15])
+    with pytest.raises(ValueError):
+        DomDec.UseSeparableKernel(posX, np.random.default_rng(0).random((5, 2)),
+                                  separable=True)